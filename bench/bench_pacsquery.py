@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+    NAME
+
+        bench_pacsquery.py
+
+    SYNOPSIS
+
+        bench_pacsquery.py      [--hits <N>]                            \\
+                                [--seriesPerStudy <N>]                  \\
+                                [--latency <seconds>]                   \\
+                                [--response <responseFile>]             \\
+                                [--queries <N>]                         \\
+                                [--scenarios <s1,s2,...>]               \\
+                                [--appArgs <argString>]                 \\
+                                [--jsonFile <jsonFile>]
+
+    DESCRIPTION
+
+    End to end benchmark of 'PacsQueryApp.run' against a local mock 
+    'pfdcm' (see 'mock_pfdcm.py') replaying canned query responses of
+    configurable size and latency.
+
+    Each scenario exercises one output path:
+
+        o results   --resultFile
+        o summary   --summaryKeys/--summaryFile
+        o hits      --numberOfHitsFile
+        o all       all of the above
+
+    Every scenario runs in a fresh subprocess and issues <queries> queries
+    (each for a different PatientID, each through a new PacsQueryApp), 
+    and reports the wall time, throughput (queries/s), peak RSS and the
+    tracemalloc peak of a single (traced) query.
+
+    Any <argString> is appended to the plugin arguments of every query,
+    for example "--resultFormat ndjson" or "--summaryFormat csv".
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import tempfile
+import subprocess
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_appDir      = os.path.join(os.path.dirname(str_selfDir), 'pacsquery')
+
+str_summaryKeys = 'PatientID,PatientAge,StudyDescription,StudyInstanceUID,' \
+                  'SeriesDescription,SeriesInstanceUID,NumberOfSeriesRelatedInstances'
+
+d_scenario      = {
+    'results':  ['--resultFile', 'results.json'],
+    'summary':  ['--summaryKeys', str_summaryKeys, '--summaryFile', 'summary.txt'],
+    'hits':     ['--numberOfHitsFile', 'hits.txt'],
+}
+d_scenario['all']   = d_scenario['results'] + d_scenario['summary'] + d_scenario['hits']
+
+
+def query_run(pacsquery, l_argv):
+    """
+    Run one query end to end through a new PacsQueryApp.
+    """
+    app     = pacsquery.PacsQueryApp()
+    options = app.parse_args(l_argv)
+    return app.run(options)
+
+
+def worker(args):
+    """
+    Run the queries of a single scenario in this process, and print a
+    JSON line of the measurements.
+    """
+    import resource
+    import tracemalloc
+
+    sys.path.insert(0, str_appDir)
+    import pacsquery
+
+    str_outputDir   = tempfile.mkdtemp(prefix = 'pacsquery-bench-')
+    l_base          = ['--pfdcm', args.pfdcm, '--pfurlQuiet'] +             \
+                      d_scenario[args.worker] + shlex.split(args.appArgs)
+
+    def argv_get(i):
+        return l_base + ['--PatientID', 'BENCH-%05d' % i, str_outputDir]
+
+    # Silence the plugin's own logging on stdout
+    stdout      = sys.stdout
+    sys.stdout  = open(os.devnull, 'w')
+    try:
+        startTime   = time.perf_counter()
+        for i in range(args.queries):
+            query_run(pacsquery, argv_get(i))
+        wallTime    = time.perf_counter() - startTime
+        peakRSS     = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        tracemalloc.start()
+        query_run(pacsquery, argv_get(args.queries))
+        tracedPeak  = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout  = stdout
+
+    d_files     = {
+        str_file: os.path.getsize(os.path.join(str_outputDir, str_file))
+        for str_file in sorted(os.listdir(str_outputDir))
+    }
+    print(json.dumps({
+        'scenario':         args.worker,
+        'queries':          args.queries,
+        'wallTime':         wallTime,
+        'queriesPerSec':    args.queries / wallTime if wallTime else 0,
+        'peakRSSKiB':       peakRSS,
+        'tracemallocPeak':  tracedPeak,
+        'outputBytes':      d_files
+    }))
+    return 0
+
+
+def scenario_run(args, str_scenario, str_pfdcm):
+    """
+    Run a scenario in a fresh subprocess and return its measurements.
+    """
+    l_cmd   = [ sys.executable, os.path.abspath(__file__),
+                '--worker',     str_scenario,
+                '--pfdcm',      str_pfdcm,
+                '--queries',    str(args.queries),
+                '--appArgs',    args.appArgs ]
+    proc    = subprocess.run(l_cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                             universal_newlines = True)
+    if proc.returncode:
+        raise RuntimeError('scenario %s failed:\n%s' % (str_scenario, proc.stderr))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser  = argparse.ArgumentParser(description = 'pacsquery.py end to end benchmark')
+    parser.add_argument('--hits', type = int, default = 1000,
+                        help = 'number of series hits in each mock reply')
+    parser.add_argument('--seriesPerStudy', type = int, default = 10)
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'seconds the mock pfdcm delays each reply')
+    parser.add_argument('--response', default = '',
+                        help = 'replay this recorded pfdcm response instead')
+    parser.add_argument('--queries', type = int, default = 10,
+                        help = 'number of queries per scenario')
+    parser.add_argument('--scenarios', default = 'results,summary,hits,all')
+    parser.add_argument('--appArgs', default = '',
+                        help = 'extra arguments passed to every query')
+    parser.add_argument('--jsonFile', default = '',
+                        help = 'also save the measurements to this file')
+    parser.add_argument('--worker', default = '', help = argparse.SUPPRESS)
+    parser.add_argument('--pfdcm', default = '', help = argparse.SUPPRESS)
+    args    = parser.parse_args()
+
+    if len(args.worker):
+        return worker(args)
+
+    import mock_pfdcm
+
+    server  = mock_pfdcm.server_start(
+                    hits            = args.hits,
+                    seriesPerStudy  = args.seriesPerStudy,
+                    latency         = args.latency,
+                    response        = args.response)
+    str_pfdcm   = '%s:%d' % server.server_address
+
+    l_result    = []
+    print('%-10s %8s %10s %10s %12s %16s' %
+            ('scenario', 'queries', 'wall (s)', 'queries/s', 'peak RSS MiB', 'tracemalloc MiB'))
+    for str_scenario in args.scenarios.split(','):
+        d_result    = scenario_run(args, str_scenario, str_pfdcm)
+        l_result.append(d_result)
+        print('%-10s %8d %10.3f %10.2f %12.1f %16.1f' % (
+                str_scenario,
+                d_result['queries'],
+                d_result['wallTime'],
+                d_result['queriesPerSec'],
+                d_result['peakRSSKiB'] / 1024,
+                d_result['tracemallocPeak'] / (1024 * 1024)))
+    server.shutdown()
+
+    if len(args.jsonFile):
+        with open(args.jsonFile, 'w') as f:
+            json.dump({'hits': args.hits, 'latency': args.latency, 'results': l_result}, f, indent = 4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
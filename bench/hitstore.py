@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+    NAME
+
+        hitstore.py
+
+    SYNOPSIS
+
+        hitstore.py     [--hits <N>]                            \\
+                        [--seriesPerStudy <N>]                  \\
+                        [--keys <k1,k2,...>]                    \\
+                        [--repeat <N>]
+
+    DESCRIPTION
+
+    Compare the ways of holding the <N> hits of a decoded 'pfdcm' query
+    response:
+
+        list of dicts       the plain list returned by the JSON decoder;
+        decode, HitStore    the list, then compacted into a 'HitStore';
+        orjson, HitStore    the same, decoded by 'orjson' (if installed);
+        streaming HitStore  the 'HitStore' built hit by hit as the body
+                            is decoded by the standard 'json' (what
+                            'pacsquery.py' does, with or without 'orjson').
+
+    For each, report the peak and the retained memory (by 'tracemalloc'),
+    the time to decode (and build), the time to read the summary columns,
+    and the time to write the hits out as JSON (each the best of --repeat
+    runs).
+
+    The hits are synthetic (see 'mock_pfdcm.py'), and are decoded from a
+    raw response body so that, like a real response, no values are shared.
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_appDir      = os.path.join(os.path.dirname(str_selfDir), 'pacsquery')
+
+
+def traced(fn):
+    """
+    Return (result of fn(), bytes still allocated by it, peak bytes).
+    """
+    tracemalloc.start()
+    result      = fn()
+    size, peak  = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, peak
+
+
+def timed(fn, repeat):
+    """
+    Return (result of fn(), best seconds taken over <repeat> runs), 
+    untraced.
+    """
+    l_time      = []
+    for i in range(repeat):
+        result      = None
+        gc.collect()
+        startTime   = time.perf_counter()
+        result      = fn()
+        l_time.append(time.perf_counter() - startTime)
+    return result, min(l_time)
+
+
+def main():
+    parser  = argparse.ArgumentParser(description = 'HitStore memory benchmark')
+    parser.add_argument('--hits', type = int, default = 50000)
+    parser.add_argument('--seriesPerStudy', type = int, default = 10)
+    parser.add_argument('--keys', default = 'PatientID,StudyDate,Modality,SeriesDescription',
+                        help = 'summary columns to read')
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = 'report the best time of this many runs')
+    args    = parser.parse_args()
+
+    sys.path.insert(0, str_appDir)
+    import mock_pfdcm
+    from pacsquery import HitStore, hits_decode
+
+    body    = json.dumps(mock_pfdcm.response_make(
+                    {'meta': {'on': {'PatientID': 'PAT'}}}, args.hits, args.seriesPerStudy
+              )).encode('utf-8')
+    l_keys  = args.keys.split(',')
+
+    d_way   = {
+        'list of dicts':        lambda: json.loads(body)['query']['data'],
+        'decode, HitStore':     lambda: HitStore(json.loads(body)['query']['data']),
+        'streaming HitStore':   lambda: hits_decode(body)[0]['query']['data']
+    }
+    try:
+        import orjson
+        d_way['orjson, HitStore']   = lambda: HitStore(orjson.loads(body)['query']['data'])
+    except ImportError:
+        pass
+
+    print('%d hits, %d bytes of JSON' % (args.hits, len(body)))
+    print('%-20s %10s %10s %12s %12s %12s' % (
+            '', 'peak MiB', 'kept MiB', 'decode (s)', 'columns (s)', 'write (s)'))
+    for str_way, fn in d_way.items():
+        l_data, size, peak  = traced(fn)
+        del l_data
+        l_data, decodeTime  = timed(fn, args.repeat)
+        if isinstance(l_data, HitStore):
+            columns         = lambda: [l_data.column_get(key) for key in l_keys]
+        else:
+            columns         = lambda: [[d_hit.get(key, {}).get('value', '') for d_hit in l_data]
+                                        for key in l_keys]
+        columnTime          = timed(columns, args.repeat)[1]
+        writeTime           = timed(lambda: json.dumps(list(l_data)), args.repeat)[1]
+        print('%-20s %10.1f %10.1f %12.3f %12.3f %12.3f' % (
+                str_way, peak / 2**20, size / 2**20, decodeTime, columnTime, writeTime))
+        del l_data
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
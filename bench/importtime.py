@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+    NAME
+
+        importtime.py
+
+    SYNOPSIS
+
+        importtime.py   [--repeat <N>]                          \\
+                        [--budgetMs <ms>]                       \\
+                        [--full]
+
+    DESCRIPTION
+
+    Measure the startup cost of 'pacsquery.py' using 'python -X importtime'
+    and gate regressions.
+
+    By default the '--version' fast path is measured: this must not import
+    the ChrisApp machinery nor any of the service client modules, and its
+    (median) cumulative import time must stay under <budgetMs>.
+
+    With '--full', the plain import of the module is also checked to not
+    pull in any of the modules that are only needed on specific code paths.
+    This requires the plugin dependencies to be installed.
+
+    Exits with a non-zero status if any gate fails.
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_appDir      = os.path.join(os.path.dirname(str_selfDir), 'pacsquery')
+str_app         = os.path.join(str_appDir, 'pacsquery.py')
+
+# Modules that must never be imported by the --version/--man fast path
+l_fastPathForbidden = [
+    'chrisapp', 'pfurl', 'pfmisc', 'pudb', 'pypx', 'json',
+    'http.client', 'concurrent.futures', 'csv', 'orjson'
+]
+
+# Modules that must never be imported by a plain import of the module
+l_importForbidden   = [
+    'pfurl', 'pudb', 'pypx', 'http.client', 'concurrent.futures', 'csv', 'orjson'
+]
+
+re_importtime   = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$')
+
+
+def importtime_parse(str_stderr):
+    """
+    Parse the stderr of 'python -X importtime' and return a tuple of
+    (total cumulative microseconds over top level imports, set of modules).
+    """
+    totalUs     = 0
+    s_module    = set()
+    for str_line in str_stderr.splitlines():
+        match   = re_importtime.match(str_line)
+        if not match:
+            continue
+        str_module  = match.group(4)
+        s_module.add(str_module)
+        if len(match.group(3)) <= 1:
+            totalUs += int(match.group(2))
+    return totalUs, s_module
+
+
+def importtime_measure(l_cmd, repeat):
+    """
+    Run <l_cmd> under '-X importtime' <repeat> times, and return a dict
+    of the median import and wall times, and the union of imported modules.
+    """
+    l_importUs  = []
+    l_wallMs    = []
+    s_module    = set()
+    for i in range(repeat):
+        startTime   = time.perf_counter()
+        proc        = subprocess.run(
+                            [sys.executable, '-X', 'importtime'] + l_cmd,
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE,
+                            universal_newlines = True,
+                            cwd = str_appDir)
+        l_wallMs.append((time.perf_counter() - startTime) * 1000)
+        if proc.returncode:
+            raise RuntimeError('%s failed:\n%s' % (' '.join(l_cmd), proc.stderr))
+        importUs, s_run = importtime_parse(proc.stderr)
+        l_importUs.append(importUs)
+        s_module   |= s_run
+    return {
+        'importMs': statistics.median(l_importUs) / 1000,
+        'wallMs':   statistics.median(l_wallMs),
+        'modules':  s_module
+    }
+
+
+def forbidden_check(str_label, s_module, l_forbidden):
+    """
+    Report any forbidden modules that were imported. Return True if none.
+    """
+    l_found = sorted(m for m in l_forbidden if m in s_module)
+    if len(l_found):
+        print('FAIL  %-20s imported %s' % (str_label, ', '.join(l_found)))
+        return False
+    print('PASS  %-20s imports none of %s' % (str_label, ', '.join(l_forbidden)))
+    return True
+
+
+def main():
+    parser  = argparse.ArgumentParser(description = 'pacsquery.py import time gate')
+    parser.add_argument('--repeat', type = int, default = 5,
+                        help = 'number of runs to take the median over')
+    parser.add_argument('--budgetMs', type = float, default = 50.0,
+                        help = 'maximum median import time of the --version fast path')
+    parser.add_argument('--full', action = 'store_true', default = False,
+                        help = 'also check a plain import of the module')
+    args    = parser.parse_args()
+
+    b_pass  = True
+
+    d_fast  = importtime_measure([str_app, '--version'], args.repeat)
+    print('      %-20s import %8.2f ms   wall %8.2f ms' %
+            ('--version', d_fast['importMs'], d_fast['wallMs']))
+    b_pass &= forbidden_check('--version', d_fast['modules'], l_fastPathForbidden)
+    if d_fast['importMs'] > args.budgetMs:
+        print('FAIL  %-20s import time %.2f ms exceeds budget %.2f ms' %
+                ('--version', d_fast['importMs'], args.budgetMs))
+        b_pass  = False
+    else:
+        print('PASS  %-20s import time within %.2f ms budget' % ('--version', args.budgetMs))
+
+    if args.full:
+        d_full  = importtime_measure(['-c', 'import pacsquery'], args.repeat)
+        print('      %-20s import %8.2f ms   wall %8.2f ms' %
+                ('import', d_full['importMs'], d_full['wallMs']))
+        b_pass &= forbidden_check('import', d_full['modules'], l_importForbidden)
+
+    return 0 if b_pass else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
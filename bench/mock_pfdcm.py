@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+    NAME
+
+        mock_pfdcm.py
+
+    SYNOPSIS
+
+        mock_pfdcm.py   [--port <port>]                         \\
+                        [--hits <N>]                            \\
+                        [--seriesPerStudy <N>]                  \\
+                        [--latency <seconds>]                   \\
+                        [--response <responseFile>]             \\
+                        [--failStudyDate <YYYYMMDD>]            \\
+                        [--failPACS <PACSservice>]
+
+    DESCRIPTION
+
+    A local stand-in for 'pfdcm' that answers 'PACSinteract' messages
+    (POSTed in the pfurl 'payload' wrapper) with a canned 'query' response.
+
+    The response is either a recorded 'pfdcm' reply read from 
+    <responseFile>, or a synthetic one of <hits> series hits. Synthetic
+    hits carry the PatientID of the query, and are filtered by any 
+    StudyDate (range) and Modality in the query. Every reply is delayed by 
+    <latency> seconds to model the PACS C-FIND time. A query whose 
+    StudyDate (range) covers <failStudyDate> is answered with an HTTP 500,
+    to model a PACS failing on part of a chunked query, as is any query of
+    the PACS <failPACS>, to model one of several PACS being down.
+
+    The server speaks HTTP/1.1 with keep-alive, and can also be started
+    in a background thread with 'server_start()'.
+"""
+
+import sys
+import json
+import zlib
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# The DICOM tags in each synthetic hit, in the pypx/pfdcm reply layout
+d_tag   = {
+    'PatientID':                        '0x0010,0x0020',
+    'PatientName':                      '0x0010,0x0010',
+    'PatientBirthDate':                 '0x0010,0x0030',
+    'PatientAge':                       '0x0010,0x1010',
+    'PatientSex':                       '0x0010,0x0040',
+    'AccessionNumber':                  '0x0008,0x0050',
+    'StudyDate':                        '0x0008,0x0020',
+    'StudyDescription':                 '0x0008,0x1030',
+    'StudyInstanceUID':                 '0x0020,0x000d',
+    'SeriesDate':                       '0x0008,0x0021',
+    'SeriesDescription':                '0x0008,0x103e',
+    'SeriesInstanceUID':                '0x0020,0x000e',
+    'Modality':                         '0x0008,0x0060',
+    'NumberOfSeriesRelatedInstances':   '0x0020,0x1209',
+    'QueryRetrieveLevel':               '0x0008,0x0052'
+}
+l_modality      = ['MR', 'CT', 'US', 'CR', 'DX']
+
+
+def hit_make(str_patientID, i, seriesPerStudy):
+    """
+    Return a synthetic series level hit.
+    """
+    study       = i // seriesPerStudy
+    uidRoot     = zlib.crc32(str_patientID.encode('utf-8')) % 100000
+    str_date    = '%04d%02d%02d' % (2000 + study % 20, 1 + study % 12, 1 + study % 28)
+    d_value     = {
+        'PatientID':                        str_patientID,
+        'PatientName':                      'Anon^%s' % str_patientID,
+        'PatientBirthDate':                 '19800101',
+        'PatientAge':                       '%03dY' % (20 + study % 60),
+        'PatientSex':                       'MF'[i % 2],
+        'AccessionNumber':                  '%08d' % study,
+        'StudyDate':                        str_date,
+        'StudyDescription':                 'Study %d of %s' % (study, str_patientID),
+        'StudyInstanceUID':                 '1.2.840.113619.2.%d.%d' % (uidRoot, study),
+        'SeriesDate':                       str_date,
+        'SeriesDescription':                'Series %d %s' % (i, l_modality[study % len(l_modality)]),
+        'SeriesInstanceUID':                '1.2.840.113619.2.%d.%d.%d' % (uidRoot, study, i),
+        'Modality':                         l_modality[study % len(l_modality)],
+        'NumberOfSeriesRelatedInstances':   str(1 + (i * 37) % 300),
+        'QueryRetrieveLevel':               'SERIES'
+    }
+    return {
+        str_key: {'tag': d_tag[str_key], 'value': value, 'label': str_key}
+        for str_key, value in d_value.items()
+    }
+
+
+def studyDate_covers(d_on, str_date):
+    """
+    Return True if the StudyDate (range) matching key of a query, if any,
+    covers <str_date>.
+    """
+    str_range       = d_on.get('StudyDate', '')
+    if not len(str_range):
+        return True
+    str_start, str_sep, str_end = str_range.partition('-')
+    if not len(str_sep):
+        str_end = str_start
+    return str_start <= str_date and (not len(str_end) or str_date <= str_end)
+
+
+def response_make(d_msg, hits, seriesPerStudy):
+    """
+    Return a synthetic 'pfdcm' query response for the message <d_msg>.
+    """
+    d_on            = d_msg.get('meta', {}).get('on', {})
+    str_patientID   = d_on.get('PatientID', 'ANON')
+    l_data          = [hit_make(str_patientID, i, seriesPerStudy) for i in range(hits)]
+
+    # Honour the StudyDate (range) and Modality matching keys, if any
+    l_data          = [d_hit for d_hit in l_data
+                        if studyDate_covers(d_on, d_hit['StudyDate']['value'])]
+    if len(d_on.get('Modality', '')):
+        l_data      = [d_hit for d_hit in l_data
+                        if d_hit['Modality']['value'] == d_on['Modality']]
+    return {
+        'status':   True,
+        'query': {
+            'status':   True,
+            'command':  'findscu (mock)',
+            'data':     l_data
+        }
+    }
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class MockPfdcmHandler(BaseHTTPRequestHandler):
+    '''
+    Answer POSTed 'pfdcm' messages with the server's canned response.
+
+    The headers and body of a reply go out in two writes, so Nagle is 
+    turned off: otherwise each keep-alive request waits on a delayed ACK.
+    '''
+    protocol_version        = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length      = int(self.headers.get('Content-Length', 0))
+        d_request   = json.loads(self.rfile.read(length).decode('utf-8'))
+        d_msg       = d_request.get('payload', d_request)
+        self.server.requests   += 1
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        d_meta      = d_msg.get('meta', {})
+        str_fail    = self.server.failStudyDate
+        if len(str_fail) and studyDate_covers(d_meta.get('on', {}), str_fail) or \
+                len(self.server.failPACS) and d_meta.get('PACS') == self.server.failPACS:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.server.body is not None:
+            body    = self.server.body
+        else:
+            body    = json.dumps(response_make(
+                                    d_msg,
+                                    self.server.hits,
+                                    self.server.seriesPerStudy)).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def server_start(*args, **kwargs):
+    """
+    Start a mock 'pfdcm' in a background thread and return the server.
+    The listening address is server.server_address; pass port = 0 to
+    pick a free port.
+    """
+    port            = 0
+    hits            = 100
+    seriesPerStudy  = 10
+    latency         = 0.0
+    str_response    = ''
+    str_failStudyDate   = ''
+    str_failPACS        = ''
+    for k, v in kwargs.items():
+        if k == 'port':             port            = v
+        if k == 'hits':             hits            = v
+        if k == 'seriesPerStudy':   seriesPerStudy  = v
+        if k == 'latency':          latency         = v
+        if k == 'response':         str_response    = v
+        if k == 'failStudyDate':    str_failStudyDate   = v
+        if k == 'failPACS':         str_failPACS        = v
+
+    server                  = ThreadingHTTPServer(('127.0.0.1', port), MockPfdcmHandler)
+    server.hits             = hits
+    server.seriesPerStudy   = max(1, seriesPerStudy)
+    server.latency          = latency
+    server.requests         = 0
+    server.failStudyDate    = str_failStudyDate
+    server.failPACS         = str_failPACS
+    server.body             = None
+    if len(str_response):
+        with open(str_response, 'rb') as f:
+            server.body     = f.read()
+
+    thread          = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+
+def main():
+    parser  = argparse.ArgumentParser(description = 'A mock pfdcm service')
+    parser.add_argument('--port', type = int, default = 5015)
+    parser.add_argument('--hits', type = int, default = 100,
+                        help = 'number of synthetic series hits per query')
+    parser.add_argument('--seriesPerStudy', type = int, default = 10,
+                        help = 'number of synthetic series per study')
+    parser.add_argument('--latency', type = float, default = 0.0,
+                        help = 'seconds to delay each reply')
+    parser.add_argument('--response', default = '',
+                        help = 'replay this recorded pfdcm response instead')
+    parser.add_argument('--failStudyDate', default = '',
+                        help = 'answer the queries covering this StudyDate with an HTTP 500')
+    parser.add_argument('--failPACS', default = '',
+                        help = 'answer the queries of this PACS service with an HTTP 500')
+    args    = parser.parse_args()
+
+    server  = server_start(
+                    port            = args.port,
+                    hits            = args.hits,
+                    seriesPerStudy  = args.seriesPerStudy,
+                    latency         = args.latency,
+                    response        = args.response,
+                    failStudyDate   = args.failStudyDate,
+                    failPACS        = args.failPACS)
+    print('mock pfdcm listening on %s:%d' % server.server_address)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
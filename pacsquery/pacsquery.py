@@ -22,12 +22,56 @@ str_synposis = """
         pacsquery.py    --pfdcm <PACserviceIP:port>             \\
                         [--version]                             \\
                         [--msg <jsonMsgString>]                 \\
-                        [--patientID <patientID>]               \\
-                        [--PACSservice <PACSservice>]           \\
+                        [--patientID <patientID>[,<patientID>...]] \\
+                        [--PatientIDFile <patientIDFile>]       \\
+                        [--Modality <modalityList>]             \\
+                        [--StudyDate <YYYYMMDD-YYYYMMDD>]       \\
+                        [--SeriesDescription <regex>]           \\
+                        [--jobs <N>]                            \\
+                        [--async]                               \\
+                        [--poolSize <N>]                        \\
+                        [--timeout <seconds>]                   \\
+                        [--deadline <seconds>]                  \\
+                        [--retries <N>]                         \\
+                        [--backoff <seconds>]                   \\
+                        [--hedgePercentile <P>]                 \\
+                        [--rateLimit <callsPerSecond>]          \\
+                        [--rateBurst <N>]                       \\
+                        [--maxInFlight <N>]                     \\
+                        [--priority <interactive|bulk>]         \\
+                        [--schedulerDir <schedulerDir>]         \\
+                        [--coalesceDir <coalesceDir>]           \\
+                        [--cacheDir <cacheDir>]                 \\
+                        [--cacheTTL <seconds>]                  \\
+                        [--cacheMaxBytes <bytes>]               \\
+                        [--chunkDays <N>]                       \\
+                        [--chunkStudyDate <YYYYMMDD-YYYYMMDD>]  \\
+                        [--chunkModalities <modalityList>]      \\
+                        [--maxChunkHits <N>]                    \\
+                        [--PACSservice <PACSserviceList>]       \\
+                        [--PACSfirstComplete]                   \\
                         [--summaryKeys <keylist>]               \\
                         [--summaryFile <summaryFile>]           \\
+                        [--summaryFormat <fixed|csv|tsv>]       \\
+                        [--studySummaryFile <studySummaryFile>] \\
+                        [--returnKeys <keylist>]                \\
                         [--resultFile <resultFile>]             \\
+                        [--resultFormat <json|ndjson>]          \\
+                        [--resultSortKeys]                      \\
+                        [--resultIndent <N>]                    \\
+                        [--resultRaw]                           \\
+                        [--compress <gzip|zstd>]                \\
+                        [--compressLevel <N>]                   \\
                         [--numberOfHitsFile <numberOfHitsFile>] \\
+                        [--countsFile <countsFile>]             \\
+                        [--incremental --stateDir <stateDir>]   \\
+                        [--mergedResultFile <mergedResultFile>] \\
+                        [--indexDB <indexDB>]                   \\
+                        [--indexLookup]                         \\
+                        [--lookupSeriesDescription <pattern>]   \\
+                        [--metricsFile <metricsFile>]           \\
+                        [--serve <socketPath|->]                \\
+                        [--submit <socketPath>]                 \\
                         <outputdir>
 """
 str_description = """
@@ -71,6 +115,8 @@ str_results = """
         o summary file of the hits, using <keyList>, <summaryFile>
         o JSON formatted results from 'pfdcm', <resultFile>
         o hit file containing number of hits, <numberOfHitsFile>
+        o counts file of the hits, studies and series, <countsFile>
+        o summary file of the studies hit, <studySummaryFile>
 """
 str_args = """
 
@@ -89,15 +135,208 @@ str_args = """
 
         USE WITH CARE.
 
-    --patientID <patientID>] 
+    --patientID <patientID>[,<patientID>...]] 
 
-        The <patientID> string to query.
+        The <patientID> string to query. A comma separated list of
+        IDs queries each patient in turn (see also '--jobs').
 
-    --PACSservice <PACSservice>] 
+    --PatientIDFile <patientIDFile>]
+
+        A file containing one <patientID> per line to query. Blank lines
+        and lines starting with '#' are ignored. IDs from this file are
+        added to any passed with '--patientID'.
+
+    --Modality <modalityList>]
+
+        If specified, only return the hits of one of the (comma separated)
+        modalities in <modalityList>. A single modality is also passed on
+        to 'pfdcm' to match, as are the modalities of a chunked query (see 
+        '--chunkModalities').
+
+    --StudyDate <YYYYMMDD-YYYYMMDD>]
+
+        If specified, only return the hits of a StudyDate in this range. 
+        Either end may be left open, and a single date matches that day.
+        The range is passed on to 'pfdcm' to match.
+
+    --SeriesDescription <regex>]
+
+        If specified, only return the hits of a SeriesDescription that
+        matches (anywhere) the Python regular expression <regex>.
+
+        The '--Modality', '--StudyDate' and '--SeriesDescription' criteria
+        are also checked against the hits returned, in one pass before any
+        output is written, including the hits of a '--msg' or an 
+        '--indexLookup'. A hit that does not have a tag filtered on is 
+        dropped. Note that an '--incremental' state is kept per PatientID
+        and PACS service, whatever the criteria.
+
+    --jobs <N>]
+
+        The number of queries to dispatch concurrently to 'pfdcm' when
+        more than one <patientID> is specified. Defaults to 1 (serial).
+        Results from all patients are merged into the output files, and
+        the per-patient status is recorded in the <resultFile>.
+
+    --async]
+
+        If specified, dispatch the queries of a multi-patient query from a
+        single thread with an asyncio 'pfdcm' client, instead of a pool of
+        '--jobs' threads. Up to '--jobs' queries are then outstanding at
+        once, which can be set to hundreds at little memory per query. 
+        Attempts are not hedged (see '--hedgePercentile'), and chunked 
+        queries (see '--chunkDays') still use threads.
+
+    --poolSize <N>]
+
+        If specified, talk to 'pfdcm' over a persistent (keep-alive)
+        HTTP session holding up to <N> pooled connections, rather than
+        opening a new connection per message. Multi-patient queries
+        always use a session, sized to at least '--jobs'. The pool 
+        hit/miss counters are logged and saved in the output meta.
+
+    --timeout <seconds>]
+
+        If specified, the time limit of each attempt at a 'pfdcm' call. 
+        An attempt that does not answer in time is abandoned.
+
+    --deadline <seconds>]
+
+        If specified, the total time limit of a 'pfdcm' call, over all of
+        its attempts and backoff delays.
+
+    --retries <N>]
+
+        The number of times to retry a 'pfdcm' call that failed with a
+        transient error: a timeout, a connection error, an unparsable 
+        response, or an HTTP 5xx/429 status. Defaults to 0. Only read-only
+        queries are retried: any other message (a '--msg' that may change
+        'pfdcm' state) is only retried if its request could not be sent.
+
+    --backoff <seconds>]
+
+        The base of the exponential backoff between retries. The delay
+        before retry <n> is drawn uniformly from [0, <seconds> * 2^n]
+        (capped at 30s). Defaults to 0.5.
+
+    --hedgePercentile <P>]
+
+        If specified, once a query has taken longer than the <P>th 
+        percentile of the latencies seen so far (after at least 10 
+        calls), a duplicate request is sent, and whichever answers first
+        is used. Only read-only queries are hedged.
+
+        The retry and latency statistics are logged and saved in the 
+        output meta.
+
+    --rateLimit <callsPerSecond>]
+
+        If specified, limit the calls to 'pfdcm' for each PACS service to
+        <callsPerSecond> (a token bucket, see '--rateBurst'). Retries and
+        hedged calls count against the limit.
+
+    --rateBurst <N>]
+
+        The number of calls to a PACS service that may be made at once 
+        under the '--rateLimit' after an idle period. Defaults to 1.
+
+    --maxInFlight <N>]
+
+        If specified, the maximum number of calls outstanding on each PACS
+        service at any one time.
+
+    --priority <interactive|bulk>]
+
+        The priority class of the calls of this run: waiting 'interactive'
+        calls are admitted before any waiting 'bulk' call. By default, a 
+        query of a single <patientID> that is not chunked is interactive,
+        and any other is bulk.
+
+    --schedulerDir <schedulerDir>]
+
+        If specified, the '--rateLimit', '--maxInFlight' and '--priority'
+        scheduling is shared by all the runs (processes) using the same 
+        <schedulerDir> on this host, rather than within this run only.
+        The time calls waited to be admitted is logged and saved in the
+        output meta apart from the time they took.
+
+    --coalesceDir <coalesceDir>]
+
+        Identical queries (messages with "do": "query") made at the same
+        time by this run are coalesced into a single 'pfdcm' call whose
+        response they share. If <coalesceDir> is specified, so are those
+        made by all the runs (processes) using the same <coalesceDir> on
+        this host. The number of coalesced calls is logged and saved in
+        the output meta. A call in flight holds a '.lock' file in the
+        <coalesceDir>, removed when it is done. Its '.result' file is
+        kept for the runs waiting on it, and removed once over a minute
+        old.
+
+    --cacheDir <cacheDir>]
+
+        If specified, cache the 'pfdcm' responses to read-only queries
+        (messages with "do": "query") in <cacheDir>, keyed on the 
+        canonical JSON of the message. Repeated queries are answered 
+        from the cache. Any other message (for example a '--msg' that
+        changes 'pfdcm' state) always bypasses the cache.
+
+    --cacheTTL <seconds>]
+
+        The time in seconds for which a cached response is valid.
+        Defaults to 3600.
+
+    --cacheMaxBytes <bytes>]
+
+        The maximum total size of the cache. When exceeded, the least
+        recently used entries are evicted. Defaults to 268435456 (256MB).
+
+    --chunkDays <N>]
+
+        If specified, split each query into StudyDate windows of <N> days
+        that are issued in turn (or concurrently, see '--jobs'). The hits
+        of each chunk are streamed to the output files as it completes,
+        so that memory use depends on the chunk size rather than on the
+        patient history. The returned result then records the status of 
+        each chunk instead of holding all the hits.
+
+    --chunkStudyDate <YYYYMMDD-YYYYMMDD>]
+
+        The StudyDate range split by '--chunkDays'. Either end may be left
+        open; an open end date means today. An open start is split from 
+        19900101 on, and all the studies before that are queried as one 
+        more chunk. Defaults to '-' (both ends open). Note that studies 
+        with no StudyDate are matched by no chunk, and so are not found by
+        a chunked query.
+
+    --chunkModalities <modalityList>]
+
+        If specified, further split each '--chunkDays' window into one
+        query per Modality in the comma separated <modalityList>. Note 
+        that series of any other modality are then not queried.
+
+    --maxChunkHits <N>]
+
+        If specified, any chunk returning more than <N> hits is split 
+        again, by halving its StudyDate window, and re-queried.
+
+    --PACSservice <PACSserviceList>] 
 
         The "name" of the PACS to query within 'pfdcm'. This is 
         used to look up the PACS IP, port, AETitle, etc.
 
+        A comma separated list queries all of the PACS concurrently and
+        merges their hits, dropping the duplicates of a StudyInstanceUID/
+        SeriesInstanceUID already returned. The PACS holding each hit are
+        recorded in its 'PACSservice' entry (which can be used as a
+        '--summaryKeys' key).
+
+    --PACSfirstComplete]
+
+        If specified with a list of '--PACSservice', use the hits of the 
+        first PACS to answer a query, without waiting for the others. With
+        '--incremental', the state is then not saved (unless every PACS
+        happened to answer), so the next run asks again.
+
     --summaryKeys <keylist>]
     
         A comma separated list of 'keys' to include in the 
@@ -109,13 +348,153 @@ str_args = """
 
         The name of the file in the <outputdir> to contain the summary report.
 
+    --summaryFormat <fixed|csv|tsv>]
+
+        The format of the <summaryFile>. 'fixed' (the default) pads each
+        column to its widest entry; 'csv' and 'tsv' write comma or tab 
+        separated values. Keys missing from a hit are left empty.
+
+    --studySummaryFile <studySummaryFile>]
+
+        If specified, the name of the file in the <outputdir> to contain a
+        summary report of the studies hit (in the '--summaryFormat'): one
+        row per StudyInstanceUID, with its PatientID, StudyDate and
+        StudyDescription, and the rollups of the series hit in the study,
+        ModalitiesInStudy, NumberOfStudyRelatedSeries and the total of 
+        their NumberOfSeriesRelatedInstances as NumberOfStudyRelatedInstances.
+
+    --returnKeys <keylist>]
+
+        A comma separated list of the only tags 'pfdcm' needs to return for
+        each hit, passed in the query 'meta'. If 'pfdcm' returns more, the 
+        hits are trimmed to these tags on receipt. By default, when neither
+        a '--resultFile' nor a '--mergedResultFile' is asked for, only the
+        '--summaryKeys' are returned. Pass '*' to always return all tags.
+
     --resultFile <resultFile>]
 
         The name of the file in the <outputdir> to contain the results.Misc utilities for FNNDSC python repos
-    
+
+    --resultFormat <json|ndjson>]
+
+        The format of the <resultFile>. 'json' (the default) writes the
+        whole 'pfdcm' response as a single JSON document; 'ndjson' writes
+        only the query hits, one JSON object per line. In both cases the
+        output is streamed to file rather than built in memory (the 'json'
+        hits of a chunked query are spooled to a temporary file until the
+        rest of the response is known).
+
+    --resultSortKeys]
+
+        If specified, sort the keys of the JSON objects in the <resultFile>.
+
+    --resultIndent <N>]
+
+        If specified, pretty-print the 'json' <resultFile> with an indent
+        of <N> spaces.
+
+    --resultRaw]
+
+        If specified, write the 'pfdcm' response to the <resultFile> as the
+        raw bytes received, instead of re-encoding the decoded hits (the 
+        '--resultFormat', '--resultSortKeys' and '--resultIndent' are then
+        ignored). This only applies to a single query of a single PACS that
+        is neither chunked nor incremental.
+
+    --compress <gzip|zstd>]
+
+        If specified, compress the <resultFile>, <summaryFile> and 
+        <mergedResultFile> as they are written, adding a '.gz' or '.zst'
+        suffix to their names. The 'zstd' compression needs the 'zstandard'
+        package; without it, this is an error, and no query is sent. The 
+        compressed and original sizes and the compression time are recorded
+        in the run metrics.
+
+    --compressLevel <N>]
+
+        The '--compress' level, from 1 (fastest) to 9 for 'gzip' (default
+        6) or 22 for 'zstd' (default 3). A level out of this range is an
+        error, and no query is sent.
+
     --numberOfHitsFile <numberOfHitsFile>]
 
-        The name of the file in the <outputdir> to contain the number of hits.
+        The name of the file in the <outputdir> to contain the number of hits,
+        as a bare integer.
+
+    --countsFile <countsFile>]
+
+        The name of the file in the <outputdir> to contain the number of hits,
+        and of the distinct studies and series hit, one per line, as in
+
+            12 hits
+            3 studies
+            12 series
+
+    --incremental]
+
+        If specified, only query for, and report, hits that are new since
+        the last (incremental) run for the same <patientID> and <PACSservice>.
+        The latest StudyDate and the hits seen so far are kept in the 
+        <stateDir>; later runs ask 'pfdcm' only for studies on or after
+        that date, and drop any series (by SeriesInstanceUID) already seen.
+
+    --stateDir <stateDir>]
+
+        The (persistent) directory holding the '--incremental' state.
+
+    --mergedResultFile <mergedResultFile>]
+
+        If specified with '--incremental', save all the hits seen so far
+        (the full merged view) to <mergedResultFile> in the <outputdir>,
+        in the '--resultFormat'.
+
+    --indexDB <indexDB>]
+
+        If specified, also insert or update every hit in the (persistent) 
+        SQLite database <indexDB>, keyed on PatientID, StudyInstanceUID 
+        and SeriesInstanceUID. Like a '--resultFile', this keeps 'pfdcm'
+        returning all tags by default (see '--returnKeys').
+
+    --indexLookup]
+
+        If specified with '--indexDB', do not query 'pfdcm' at all: the 
+        hits of each '--PatientID' are instead looked up in the <indexDB>,
+        and reported in the same output files as a query.
+
+    --lookupSeriesDescription <pattern>]
+
+        If specified with '--indexLookup', only report the series whose 
+        SeriesDescription matches the SQL 'LIKE' <pattern> (where '%' is
+        any text and '_' any character, ignoring case).
+
+    --metricsFile <metricsFile>]
+
+        If specified, save the run metrics as JSON to <metricsFile> in the
+        <outputdir>. These are the per-phase wall times in seconds (argument
+        handling, message construction, 'pfdcm' network time, response 
+        decode, and each output file writer), the response payload bytes,
+        hit count and output file sizes, and any session/cache counters. 
+        The same metrics are saved in the output meta with '--saveoutputmeta'.
+
+    --serve <socketPath|->]
+
+        If specified, run as a long lived server of query jobs, listening on
+        the Unix socket <socketPath> (or reading jobs from stdin for '-'), 
+        one JSON job per line. A job is either {"args": [<flags>...]} or the
+        flags as a JSON object ({"PatientID": "...", "outputdir": "..."}), 
+        with an optional "cwd" for relative paths. Each job is run as this 
+        command line would be, but reusing the warm 'pfdcm' session, cache
+        and parsers of earlier jobs. The reply is one JSON line with the 
+        job status, hit count, <outputdir> and its files. A {"shutdown": 
+        true} job stops the server. The socket is only accessible to its
+        owner; a stale socket at <socketPath> is replaced, but any other
+        file there is an error.
+
+    --submit <socketPath>]
+
+        If specified, do not run the query here but submit the rest of the
+        command line as a job to the '--serve' server on <socketPath>, and 
+        print its reply. This skips the startup of the full plugin.
 
     <outputdir>
 
@@ -125,260 +504,4041 @@ str_args = """
 
 import os
 import sys
+
+
+def man_get():
+    """
+    return a simple man/usage paragraph.
+    """
+
+    d_ret = {
+        "man":  str_name + str_synposis + str_description + str_results + str_args,
+        "synopsis":     str_synposis,
+        "description":  str_description,
+        "results":      str_results,
+        "args":         str_args,
+        "overview": """
+        """,
+        "callingSyntax1": """
+            python3 pacsquery.py --pfdcm ${HOST_IP}:5015 --msg \
+            '{  
+                "action": "PACSinteract",
+                "meta": 
+                    {
+                        "do":  "query",
+                        "on" : 
+                        {
+                            "PatientID": "LILLA-9731"
+                        },
+                        "PACS" : "orthanc"
+                    }
+            }' /tmp
+        """,
+        "callingSyntax2": """
+            python3 pacsquery.py    --pfdcm ${HOST_IP}:5015         \\
+                                    --PatientID LILLA-9731          \\
+                                    --PACSservice orthanc
+        """,
+        "callingSyntax3": """
+            python3 pacsquery.py    --pfdcm ${HOST_IP}:5015         \\
+                                    --PatientID LILLA-9731          \\
+                                    --PACSservice orthanc           \\
+                                    --pfurlQuiet                    \\
+                                    --summaryKeys "PatientID,PatientAge,StudyDescription,StudyInstanceUID,SeriesDescription,SeriesInstanceUID,NumberOfSeriesRelatedInstances" \\
+                                    --summaryFile summary.txt       \\
+                                    --resultFile results.json       \\
+                                    --numberOfHitsFile hits.txt     \\
+                                    /tmp
+        """
+    }
+
+    return d_ret
+
+
+def manPage_show(str_man):
+    """
+    Print the inline help for the passed man key, or the list of keys
+    for 'entries'.
+    """
+
+    d_man = man_get()
+    if str_man in d_man:
+        print(d_man[str_man])
+    if str_man == 'entries':
+        print(d_man.keys())
+
+
+def fastPath_checkAndRun(l_argv):
+    """
+    Checks if the command line only asks for the --version and/or --man
+    help, and if so, show it without building the ChrisApp argument
+    machinery or importing any of the service client modules.
+
+    Return True/False accordingly
+    """
+
+    b_version   = False
+    str_man     = ''
+    i           = 0
+    while i < len(l_argv):
+        str_arg = l_argv[i]
+        if str_arg == '--version':
+            b_version   = True
+        elif str_arg == '--man' and i + 1 < len(l_argv):
+            i          += 1
+            str_man     = l_argv[i]
+        elif str_arg.startswith('--man='):
+            str_man     = str_arg[len('--man='):]
+        elif str_arg.startswith('-'):
+            # Anything else needs the full argument parser
+            return False
+        i  += 1
+
+    if b_version:
+        print(str_version)
+    if len(str_man):
+        manPage_show(str_man)
+    return b_version or len(str_man) > 0
+
+
+def job_submit(l_argv):
+    """
+    Submit the command line <l_argv> (without the '--submit <socketPath>')
+    as a job to a 'pacsquery.py --serve <socketPath>' server, print the 
+    reply, and return the exit status.
+    """
+    import json
+    import socket
+
+    str_socket  = ''
+    l_job       = []
+    i           = 0
+    while i < len(l_argv):
+        if l_argv[i] == '--submit' and i + 1 < len(l_argv):
+            i          += 1
+            str_socket  = l_argv[i]
+        elif l_argv[i].startswith('--submit='):
+            str_socket  = l_argv[i][len('--submit='):]
+        else:
+            l_job.append(l_argv[i])
+        i  += 1
+
+    d_reply     = {'status': False}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str_socket)
+            sock.sendall(json.dumps({'args': l_job, 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+            str_reply   = sock.makefile('rb').readline()
+        d_reply     = json.loads(str_reply)
+    except (OSError, ValueError) as e:
+        d_reply['error']    = '%s: %s' % (type(e).__name__, e)
+    print(json.dumps(d_reply))
+    return 0 if d_reply.get('status') else 1
+
+
+# Short-circuit --version/--man before paying for the remaining imports.
+if __name__ == "__main__" and fastPath_checkAndRun(sys.argv[1:]):
+    sys.exit(0)
+
+# A --submit client only needs to talk to the server.
+if __name__ == "__main__" and any(str_arg == '--submit' or str_arg.startswith('--submit=')
+                                  for str_arg in sys.argv[1:]):
+    sys.exit(job_submit(sys.argv[1:]))
+
+import io
 import json
 import pprint
-import pypx
-import pfurl
-import pfmisc
-import pudb
+import time
+import datetime
+import contextlib
+import queue
+import heapq
+import hashlib
+import threading
+import urllib.parse
 
 # import the Chris app superclass
 from chrisapp.base import ChrisApp
 
 
-class PacsQueryApp(ChrisApp):
-    '''
-    '''
-    AUTHORS = 'FNNDSC (dev@babyMRI.org)'
-    SELFPATH = os.path.dirname(os.path.abspath(__file__))
-    SELFEXEC = os.path.basename(__file__)
-    EXECSHELL = 'python3'
-    TITLE = 'Pacs Query'
-    CATEGORY = ''
-    TYPE = 'fs'
-    DESCRIPTION = 'An app to query a PACS using an intermediary REST service.'
-    DOCUMENTATION = 'http://wiki'
-    LICENSE = 'Opensource (MIT)'
-    VERSION = '0.99'
-    MAX_NUMBER_OF_WORKERS = 1  # Override with integer value
-    MIN_NUMBER_OF_WORKERS = 1  # Override with integer value
-    MAX_CPU_LIMIT = ''  # Override with millicore value as string, e.g. '2000m'
-    MIN_CPU_LIMIT = ''  # Override with millicore value as string, e.g. '2000m'
-    MAX_MEMORY_LIMIT = ''  # Override with string, e.g. '1Gi', '2000Mi'
-    MIN_MEMORY_LIMIT = ''  # Override with string, e.g. '1Gi', '2000Mi'
-    MIN_GPU_LIMIT = 0  # Override with the minimum number of GPUs, as an integer, for your plugin
-    MAX_GPU_LIMIT = 0  # Override with the maximum number of GPUs, as an integer, for your plugin
+# The JSON decoder, resolved on first use
+d_jsonBackend   = {}
+
+
+def json_loads(body):
+    """
+    Decode a JSON document (bytes) with the fastest decoder installed: 
+    'orjson' if available, else the standard 'json'. Query responses are
+    instead streamed into a HitStore by hits_decode.
+    """
+    if not len(d_jsonBackend):
+        try:
+            import orjson
+            d_jsonBackend.update(name = 'orjson', loads = orjson.loads)
+        except ImportError:
+            d_jsonBackend.update(name = 'json', loads = lambda body: json.loads(body.decode('utf-8')))
+    return d_jsonBackend['loads'](body)
+
+
+def message_isQuery(d_msg):
+    """
+    Return True if <d_msg> is a read-only (and so idempotent) 'pfdcm' query.
+    """
+    try:
+        return d_msg['action'] == 'PACSinteract' and d_msg['meta']['do'] == 'query'
+    except (KeyError, TypeError):
+        return False
+
+
+def message_PACSservice(d_msg):
+    """
+    Return the PACS service a 'pfdcm' message is for ('' if none).
+    """
+    try:
+        return str(d_msg['meta'].get('PACS', ''))
+    except (KeyError, TypeError, AttributeError):
+        return ''
+
+
+def message_key(d_msg):
+    """
+    Return the key of a 'pfdcm' message: the sha256 of its canonical JSON.
+    """
+    str_canonical   = json.dumps(d_msg, sort_keys = True, separators = (',', ':'))
+    return hashlib.sha256(str_canonical.encode('utf-8')).hexdigest()
+
+
+def thread_submit(fn, *args):
+    """
+    Run fn(*args) in a new daemon thread, and return a Future of its result.
+
+    Unlike an executor worker, a thread stuck in a stalled call can simply
+    be abandoned: it does not hold up interpreter exit.
+    """
+    import concurrent.futures
+
+    future  = concurrent.futures.Future()
+
+    def thread_run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target = thread_run, daemon = True).start()
+    return future
+
+
+# A --chunkStudyDate open start is windowed from chunkStart on, and the 
+# earlier studies are queried as one more chunk, with an open start (and
+# halved from chunkFirst on, should it need splitting)
+chunkStart      = datetime.date(1990, 1, 1)
+chunkFirst      = datetime.date(1900, 1, 1)
+
+
+def studyDate_parse(str_date):
+    """
+    Parse a DICOM 'YYYYMMDD' date string into a datetime.date.
+    """
+    return datetime.datetime.strptime(str_date.strip(), '%Y%m%d').date()
+
+
+def studyDateRange_parse(str_range, default = None):
+    """
+    Parse a DICOM date range, 'YYYYMMDD', 'YYYYMMDD-', '-YYYYMMDD' or
+    'YYYYMMDD-YYYYMMDD', into a (start, end) tuple of datetime.date, with
+    open ends taken from the <default> (start, end) tuple.
+    """
+    start, end  = default or (None, None)
+    if '-' in str_range:
+        str_start, str_end  = str_range.split('-', 1)
+        if len(str_start.strip()):  start   = studyDate_parse(str_start)
+        if len(str_end.strip()):    end     = studyDate_parse(str_end)
+    elif len(str_range.strip()):
+        start   = end   = studyDate_parse(str_range)
+    return start, end
+
+
+class QueryCache(object):
+    '''
+    An on-disk cache of 'pfdcm' query responses, keyed on the canonical
+    JSON of the query message.
+
+    Each entry is a single file holding a one line JSON header (with the
+    entry creation time) followed by the raw response body. Entries older
+    than the TTL are discarded on lookup. The file modification time 
+    tracks recency of use, and the least recently used entries are evicted
+    whenever the total cache size exceeds its byte limit.
+
+    The entries and their total size are indexed in recency order, so that
+    a put does not rescan the cache. The index is built from the directory
+    once, and only tracks the entries this process then uses or adds.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.str_cacheDir   = ''
+        self.TTL            = 3600
+        self.maxBytes       = 256 * 1024 * 1024
+        for k, v in kwargs.items():
+            if k == 'cacheDir':     self.str_cacheDir   = v
+            if k == 'TTL':          self.TTL            = v
+            if k == 'maxBytes':     self.maxBytes       = v
+
+        os.makedirs(self.str_cacheDir, exist_ok = True)
+        self.lock           = threading.Lock()
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self.index_build()
+
+    def index_build(self):
+        """
+        Index the entries in the cache directory (path: size), least 
+        recently used first, and their total size.
+        """
+        import collections
+
+        l_entry     = []
+        for entry in os.scandir(self.str_cacheDir):
+            if entry.name.endswith('.cache'):
+                try:
+                    st  = entry.stat()
+                except OSError:
+                    continue
+                l_entry.append((st.st_mtime, entry.path, st.st_size))
+        self.d_entry    = collections.OrderedDict(
+                                (str_path, size) for mtime, str_path, size in sorted(l_entry))
+        self.totalBytes = sum(self.d_entry.values())
+
+    def index_set(self, str_path, size):
+        """
+        Index an entry as the most recently used (or drop it, for a size of
+        None). Called with the lock held.
+        """
+        self.totalBytes    -= self.d_entry.pop(str_path, 0)
+        if size is not None:
+            self.d_entry[str_path]  = size
+            self.totalBytes        += size
+
+    @staticmethod
+    def isCacheable(d_msg):
+        """
+        Only read-only 'query' messages are cacheable.
+        """
+        return message_isQuery(d_msg)
+
+    @staticmethod
+    def key_get(d_msg):
+        """
+        Return the cache key of a message.
+        """
+        return message_key(d_msg)
+
+    def path_get(self, str_key):
+        return os.path.join(self.str_cacheDir, '%s.cache' % str_key)
+
+    def get(self, d_msg):
+        """
+        Return the cached raw response body (bytes) for a message, or None.
+        """
+        str_path    = self.path_get(self.key_get(d_msg))
+        body        = None
+        size        = None
+        try:
+            with open(str_path, 'rb') as f:
+                d_header    = json.loads(f.readline().decode('utf-8'))
+                if time.time() - d_header['created'] <= self.TTL:
+                    body    = f.read()
+                    size    = f.tell()
+            if body is None:
+                os.remove(str_path)
+            else:
+                os.utime(str_path)
+        except (OSError, ValueError, KeyError):
+            body    = None
+
+        with self.lock:
+            if body is None:    self.misses += 1
+            else:               self.hits   += 1
+            if body is not None or str_path in self.d_entry:
+                self.index_set(str_path, size)
+        return body
+
+    def put(self, d_msg, body):
+        """
+        Store the raw response body (bytes) for a message.
+        """
+        str_key     = self.key_get(d_msg)
+        str_path    = self.path_get(str_key)
+        str_tmp     = '%s.%d.%d.tmp' % (str_path, os.getpid(), threading.get_ident())
+        with open(str_tmp, 'wb') as f:
+            f.write(json.dumps({'created': time.time(), 'key': str_key}).encode('utf-8'))
+            f.write(b'\n')
+            f.write(body)
+            size    = f.tell()
+        os.replace(str_tmp, str_path)
+        with self.lock:
+            self.index_set(str_path, size)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        its byte limit.
+        """
+        l_evict     = []
+        with self.lock:
+            while self.totalBytes > self.maxBytes and len(self.d_entry):
+                str_path, size  = self.d_entry.popitem(last = False)
+                self.totalBytes    -= size
+                self.evictions     += 1
+                l_evict.append(str_path)
+        for str_path in l_evict:
+            try:
+                os.remove(str_path)
+            except OSError:
+                pass
+
+    def stats_get(self):
+        """
+        Return the cache counters.
+        """
+        with self.lock:
+            return {
+                'hits':         self.hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions
+            }
+
+
+class QueryState(object):
+    '''
+    Persisted per-(PatientID, PACSservice) state for incremental queries.
+
+    Each state is a JSON file in the state directory recording the latest
+    StudyDate seen, and all hits seen so far keyed on SeriesInstanceUID.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.str_stateDir   = ''
+        for k, v in kwargs.items():
+            if k == 'stateDir':     self.str_stateDir   = v
+
+        os.makedirs(self.str_stateDir, exist_ok = True)
+
+    def path_get(self, str_patientID, str_PACSservice):
+        str_key     = hashlib.sha256(
+                        json.dumps([str_patientID, str_PACSservice]).encode('utf-8')
+                        ).hexdigest()
+        return os.path.join(self.str_stateDir, '%s.state.json' % str_key)
+
+    def get(self, str_patientID, str_PACSservice):
+        """
+        Return the state for a PatientID on a PACS (empty if none yet).
+        """
+        try:
+            with open(self.path_get(str_patientID, str_PACSservice)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {
+                'PatientID':        str_patientID,
+                'PACSservice':      str_PACSservice,
+                'lastStudyDate':    '',
+                'hits':             {}
+            }
+
+    def put(self, d_state):
+        """
+        Atomically save a state.
+        """
+        str_path    = self.path_get(d_state['PatientID'], d_state['PACSservice'])
+        str_tmp     = '%s.%d.%d.tmp' % (str_path, os.getpid(), threading.get_ident())
+        with open(str_tmp, 'w') as f:
+            json.dump(d_state, f)
+        os.replace(str_tmp, str_path)
+
+
+class HitIndex(object):
+    '''
+    A persistent SQLite index of query hits, keyed on (PatientID, 
+    StudyInstanceUID, SeriesInstanceUID). The full hit is kept as JSON,
+    alongside indexed columns for the common lookups.
+
+    Hits are upserted in batched transactions of up to BATCH rows.
+    '''
+
+    BATCH       = 1000
+
+    # The indexed columns: the primary key, then the lookup columns
+    l_column    = [
+        'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID',
+        'StudyDate', 'Modality', 'SeriesDescription', 'PACSservice'
+    ]
+
+    def __init__(self, *args, **kwargs):
+        import sqlite3
+
+        self.str_indexDB    = ''
+        for k, v in kwargs.items():
+            if k == 'indexDB':      self.str_indexDB    = v
+
+        str_dir     = os.path.dirname(os.path.abspath(self.str_indexDB))
+        os.makedirs(str_dir, exist_ok = True)
+        self.db     = sqlite3.connect(self.str_indexDB, timeout = 60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS hits (%s, updated REAL, hit TEXT, '
+                'PRIMARY KEY (PatientID, StudyInstanceUID, SeriesInstanceUID))' %
+                ', '.join('%s TEXT' % str_column for str_column in self.l_column))
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS hits_description '
+                'ON hits (PatientID, SeriesDescription COLLATE NOCASE)')
+            self.db.execute(
+                'CREATE INDEX IF NOT EXISTS hits_studyDate ON hits (PatientID, StudyDate)')
+        self.rows   = 0
+
+    def put(self, l_hits):
+        """
+        Insert or update a list of hits (or a HitStore).
+        """
+        l_columnValue   = [
+            [str(value) for value in hits_column(l_hits, str_column)]
+            for str_column in self.l_column
+        ]
+        str_sql         = 'INSERT OR REPLACE INTO hits VALUES (%s)' % \
+                            ', '.join(['?'] * (len(self.l_column) + 2))
+        updated         = time.time()
+        l_row           = []
+        for d_hit, t_value in zip(l_hits, zip(*l_columnValue)):
+            l_row.append(t_value + (updated, json.dumps(d_hit)))
+            if len(l_row) >= self.BATCH:
+                with self.db:
+                    self.db.executemany(str_sql, l_row)
+                self.rows  += len(l_row)
+                l_row       = []
+        if len(l_row):
+            with self.db:
+                self.db.executemany(str_sql, l_row)
+            self.rows  += len(l_row)
+
+    def get(self, str_patientID, str_seriesDescription = ''):
+        """
+        Return the list of hits of a PatientID, optionally only those whose
+        SeriesDescription matches a (case insensitive) SQL LIKE pattern.
+        """
+        str_sql     = 'SELECT hit FROM hits WHERE PatientID = ?'
+        l_arg       = [str_patientID]
+        if len(str_seriesDescription):
+            str_sql    += ' AND SeriesDescription LIKE ?'
+            l_arg.append(str_seriesDescription)
+        str_sql    += ' ORDER BY StudyDate, StudyInstanceUID, SeriesInstanceUID'
+        return [json.loads(str_hit) for (str_hit,) in self.db.execute(str_sql, l_arg)]
+
+    def close(self):
+        self.db.close()
+
+
+class IndexStream(object):
+    '''
+    An output stream upserting the hits written to it into a HitIndex.
+    '''
+
+    def __init__(self, index):
+        self.index  = index
+
+    def write(self, l_hits):
+        if isinstance(l_hits, (list, HitStore)):
+            self.index.put(l_hits)
+
+    def close(self, d_results = None):
+        self.index.close()
+
+
+class RetryEngine(object):
+    '''
+    Call a function with per-attempt and total deadlines, retrying 
+    transient failures with exponential backoff and full jitter.
+
+    Optionally, idempotent calls are hedged: once an attempt has taken
+    longer than the given percentile of the latencies seen so far, a
+    duplicate call is issued and whichever answers first is used.
+
+    A call that is not idempotent is neither hedged nor, once its request
+    may have reached 'pfdcm', retried: only its failures to send the 
+    request (a PfdcmNotSentError) are retried.
+    '''
+
+    BACKOFF_MAX         = 30.0
+    HEDGE_MINSAMPLES    = 10
+    LATENCY_SAMPLES     = 1000
+
+    def __init__(self, *args, **kwargs):
+        self.timeout            = 0
+        self.deadline           = 0
+        self.retries            = 0
+        self.backoff            = 0.5
+        self.hedgePercentile    = 0
+        for k, v in kwargs.items():
+            if k == 'timeout':          self.timeout            = v
+            if k == 'deadline':         self.deadline           = v
+            if k == 'retries':          self.retries            = v
+            if k == 'backoff':          self.backoff            = v
+            if k == 'hedgePercentile':  self.hedgePercentile    = v
+
+        self.lock           = threading.Lock()
+        self.l_latency      = []
+        self.d_stats        = {
+            'calls':        0,
+            'attempts':     0,
+            'retries':      0,
+            'timeouts':     0,
+            'failures':     0,
+            'hedges':       0,
+            'hedgeWins':    0
+        }
+
+    @staticmethod
+    def isTransient(e):
+        """
+        Return True if the exception <e> is worth retrying.
+        """
+        import http.client
+
+        if isinstance(e, PfdcmHTTPError):
+            return e.status >= 500 or e.status == 429
+        return isinstance(e, (OSError, http.client.HTTPException, ValueError))
+
+    def stat_add(self, str_stat, value = 1):
+        with self.lock:
+            self.d_stats[str_stat] += value
+
+    def latency_add(self, latency):
+        with self.lock:
+            self.l_latency.append(latency)
+            if len(self.l_latency) > 2 * self.LATENCY_SAMPLES:
+                del self.l_latency[:-self.LATENCY_SAMPLES]
+
+    def latency_percentile(self, percentile):
+        """
+        Return the <percentile> of the recent latencies, or None if there
+        are too few samples.
+        """
+        with self.lock:
+            l_latency   = sorted(self.l_latency[-self.LATENCY_SAMPLES:])
+        if len(l_latency) < self.HEDGE_MINSAMPLES:
+            return None
+        index   = int(round((len(l_latency) - 1) * percentile / 100.0))
+        return l_latency[min(len(l_latency) - 1, max(0, index))]
+
+    def attempt(self, fn, timeout, b_hedge):
+        """
+        Make a single (possibly hedged) attempt at fn(), waiting at most
+        <timeout> seconds (None for no limit).
+        """
+        import concurrent.futures
+
+        hedgeDelay  = None
+        if b_hedge and self.hedgePercentile > 0:
+            hedgeDelay  = self.latency_percentile(self.hedgePercentile)
+        if timeout is None and hedgeDelay is None:
+            return fn()
+
+        startTime   = time.perf_counter()
+        l_future    = [thread_submit(fn)]
+        hedge       = None
+        while True:
+            waitTime    = None
+            if timeout is not None:
+                waitTime    = max(0, timeout - (time.perf_counter() - startTime))
+            if hedge is None and hedgeDelay is not None:
+                hedgeWait   = max(0, hedgeDelay - (time.perf_counter() - startTime))
+                if waitTime is None or hedgeWait < waitTime:
+                    waitTime    = hedgeWait
+            s_done, s_pending   = concurrent.futures.wait(
+                                    l_future,
+                                    timeout     = waitTime,
+                                    return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in s_done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.stat_add('hedgeWins')
+                    return future.result()
+            if len(s_done) and not len(s_pending):
+                raise list(s_done)[0].exception()
+            l_future    = list(s_pending)
+
+            if timeout is not None and time.perf_counter() - startTime >= timeout:
+                raise TimeoutError('no response within %.3fs' % timeout)
+            if hedge is None and hedgeDelay is not None and \
+                    time.perf_counter() - startTime >= hedgeDelay:
+                hedge   = thread_submit(fn)
+                l_future.append(hedge)
+                self.stat_add('hedges')
+
+    def call(self, fn, b_idempotent = False):
+        """
+        Return fn(), retrying transient failures within the deadlines. 
+        Only read-only (idempotent) calls may pass <b_idempotent>.
+        """
+        self.stat_add('calls')
+        startTime   = time.perf_counter()
+        attempt     = 0
+        while True:
+            timeout     = self.timeout_get(startTime)
+            attemptTime = time.perf_counter()
+            self.stat_add('attempts')
+            try:
+                ret     = self.attempt(fn, timeout, b_idempotent)
+                self.latency_add(time.perf_counter() - attemptTime)
+                return ret
+            except Exception as e:
+                sleepTime   = self.retry_backoff(e, attempt, startTime, b_idempotent)
+                if sleepTime is None:
+                    raise
+                time.sleep(sleepTime)
+                attempt    += 1
+
+    async def acall(self, fn, b_idempotent = False):
+        """
+        The asyncio form of call(): return await fn(), where fn returns a 
+        coroutine, retrying transient failures within the deadlines. The
+        attempts are not hedged.
+        """
+        import asyncio
+
+        self.stat_add('calls')
+        startTime   = time.perf_counter()
+        attempt     = 0
+        while True:
+            timeout     = self.timeout_get(startTime)
+            attemptTime = time.perf_counter()
+            self.stat_add('attempts')
+            try:
+                try:
+                    ret     = await asyncio.wait_for(fn(), timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError('no response within %.3fs' % timeout)
+                self.latency_add(time.perf_counter() - attemptTime)
+                return ret
+            except Exception as e:
+                sleepTime   = self.retry_backoff(e, attempt, startTime, b_idempotent)
+                if sleepTime is None:
+                    raise
+                await asyncio.sleep(sleepTime)
+                attempt    += 1
+
+    def timeout_get(self, startTime):
+        """
+        Return the timeout (None for none) of an attempt of a call started
+        at <startTime>.
+        """
+        timeout     = self.timeout or None
+        if self.deadline:
+            remaining   = self.deadline - (time.perf_counter() - startTime)
+            timeout     = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def retry_backoff(self, e, attempt, startTime, b_idempotent):
+        """
+        Return the (jittered) backoff in seconds before retrying the failed
+        <attempt> (from 0) of a call started at <startTime>, or None if it
+        is not to be retried.
+        """
+        import random
+
+        if isinstance(e, TimeoutError):
+            self.stat_add('timeouts')
+        if attempt >= self.retries or not self.isTransient(e) or \
+                not (b_idempotent or isinstance(e, PfdcmNotSentError)):
+            self.stat_add('failures')
+            return None
+        sleepTime   = random.uniform(0, min(self.BACKOFF_MAX, self.backoff * 2 ** attempt))
+        if self.deadline and \
+                time.perf_counter() - startTime + sleepTime >= self.deadline:
+            self.stat_add('failures')
+            return None
+        self.stat_add('retries')
+        return sleepTime
+
+    def stats_get(self):
+        """
+        Return the retry counters and latency percentiles (in seconds).
+        """
+        with self.lock:
+            d_stats     = dict(self.d_stats)
+            l_latency   = sorted(self.l_latency[-self.LATENCY_SAMPLES:])
+        if len(l_latency):
+            for percentile in [50, 95, 99]:
+                index   = int(round((len(l_latency) - 1) * percentile / 100.0))
+                d_stats['latencyP%d' % percentile]  = l_latency[index]
+            d_stats['latencyMax']   = l_latency[-1]
+        return d_stats
+
+
+class QueryScheduler(object):
+    '''
+    Admission control of the calls to each PACS service: a token bucket
+    rate limit of <rate> calls per second (up to <burst> at once), and a
+    cap of <maxInFlight> calls outstanding. Waiting calls are admitted by
+    priority class (see d_priority), and then in arrival order.
+
+    The scheduling state of each PACS service is kept in memory, or if a
+    <schedulerDir> is given, in a (locked) JSON file there so that it is
+    shared by all the processes using it. The time calls waited to be 
+    admitted and the time they then took are counted per priority class.
+    '''
+
+    d_priority  = {'interactive': 0, 'bulk': 1}
+
+    # Polling interval for waits that are not notified (across processes)
+    POLL        = 0.005
+
+    def __init__(self, *args, **kwargs):
+        self.rate               = 0
+        self.burst              = 1
+        self.maxInFlight        = 0
+        self.str_schedulerDir   = ''
+        for k, v in kwargs.items():
+            if k == 'rate':             self.rate               = v
+            if k == 'burst':            self.burst              = max(1, v)
+            if k == 'maxInFlight':      self.maxInFlight        = v
+            if k == 'schedulerDir':     self.str_schedulerDir   = v
+
+        if len(self.str_schedulerDir):
+            os.makedirs(self.str_schedulerDir, exist_ok = True)
+        self.str_pid    = str(os.getpid())
+        self.lock       = threading.Condition()
+        # The (event loop, asyncio.Event) of each waiting asyncio call
+        self.s_awaiter  = set()
+        self.d_PACS     = {}
+        self.d_queue    = {}
+        self.seq        = 0
+        self.d_stats    = {
+            str_class: {
+                'calls':            0,
+                'queueWait':        0.0,
+                'queueWaitMax':     0.0,
+                'serviceTime':      0.0
+            }
+            for str_class in self.d_priority
+        }
+
+    @contextlib.contextmanager
+    def state_open(self, str_PACSservice):
+        """
+        Context manager yielding the (mutable) scheduling state of a PACS
+        service, saved back on exit. Called with the lock held.
+        """
+        if not len(self.str_schedulerDir):
+            d_state = self.d_PACS.setdefault(str_PACSservice, {
+                'tokens':   self.burst,
+                'time':     time.time(),
+                'inFlight': {},
+                'waiting':  {}
+            })
+            yield d_state
+            return
+
+        import fcntl
+
+        str_key     = hashlib.sha256(str_PACSservice.encode('utf-8')).hexdigest()
+        str_path    = os.path.join(self.str_schedulerDir, '%s.scheduler.json' % str_key)
+        with open(os.open(str_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                d_state = json.loads(f.read() or 'null') or {
+                    'tokens':   self.burst,
+                    'time':     time.time(),
+                    'inFlight': {},
+                    'waiting':  {}
+                }
+            except ValueError:
+                d_state = {'tokens': self.burst, 'time': time.time(), 'inFlight': {}, 'waiting': {}}
+            self.state_clean(d_state)
+            yield d_state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(d_state))
+
+    def state_clean(self, d_state):
+        """
+        Drop the in-flight and waiting calls of processes that have died.
+        """
+        s_pid   = set(d_state['inFlight'])
+        for d_waiting in d_state['waiting'].values():
+            s_pid.update(d_waiting)
+        for str_pid in s_pid - {self.str_pid}:
+            try:
+                os.kill(int(str_pid), 0)
+            except ProcessLookupError:
+                d_state['inFlight'].pop(str_pid, None)
+                for d_waiting in d_state['waiting'].values():
+                    d_waiting.pop(str_pid, None)
+            except (OSError, ValueError):
+                pass
+
+    def count_add(self, d_count, str_key, value):
+        d_count[str_key]    = d_count.get(str_key, 0) + value
+        if d_count[str_key] <= 0:
+            del d_count[str_key]
+
+    def enqueue(self, str_PACSservice, priority):
+        """
+        Queue a call, returning its ticket. Called with the lock held.
+        """
+        self.seq   += 1
+        ticket      = (priority, self.seq)
+        heapq.heappush(self.d_queue.setdefault(str_PACSservice, []), ticket)
+        with self.state_open(str_PACSservice) as d_state:
+            self.count_add(d_state['waiting'].setdefault(str(priority), {}), self.str_pid, 1)
+        return ticket
+
+    def dequeue(self, str_PACSservice, ticket):
+        """
+        Drop a queued call that gave up waiting. Called with the lock held.
+        """
+        l_queue     = self.d_queue[str_PACSservice]
+        if ticket in l_queue:
+            l_queue.remove(ticket)
+            heapq.heapify(l_queue)
+            with self.state_open(str_PACSservice) as d_state:
+                self.count_add(d_state['waiting'].setdefault(str(ticket[0]), {}), self.str_pid, -1)
+        self.notify()
+
+    def admit(self, str_PACSservice, ticket):
+        """
+        Try to admit a queued call: return 0 if admitted, or else how long
+        to wait (None until notified) before trying again. Called with the
+        lock held.
+        """
+        if self.d_queue[str_PACSservice][0] != ticket:
+            return None if not len(self.str_schedulerDir) else self.POLL
+        priority    = ticket[0]
+        with self.state_open(str_PACSservice) as d_state:
+            now     = time.time()
+            if self.rate:
+                d_state['tokens']   = min(self.burst,
+                                          d_state['tokens'] + (now - d_state['time']) * self.rate)
+            d_state['time']     = now
+
+            # Calls of a higher priority class waiting in other processes
+            for str_priority, d_waiting in d_state['waiting'].items():
+                if int(str_priority) < priority and \
+                        any(str_pid != self.str_pid for str_pid in d_waiting):
+                    return self.POLL
+            if self.maxInFlight and sum(d_state['inFlight'].values()) >= self.maxInFlight:
+                return None if not len(self.str_schedulerDir) else self.POLL
+            if self.rate and d_state['tokens'] < 1:
+                return (1 - d_state['tokens']) / self.rate
+
+            if self.rate:
+                d_state['tokens']  -= 1
+            self.count_add(d_state['inFlight'], self.str_pid, 1)
+            self.count_add(d_state['waiting'].setdefault(str(priority), {}), self.str_pid, -1)
+        heapq.heappop(self.d_queue[str_PACSservice])
+        self.notify()
+        return 0
+
+    def notify(self):
+        """
+        Wake all the calls waiting to be admitted, in threads and asyncio
+        tasks alike. Called with the lock held.
+        """
+        self.lock.notify_all()
+        for loop, event in self.s_awaiter:
+            loop.call_soon_threadsafe(event.set)
+
+    def release(self, str_PACSservice):
+        """
+        Release the in-flight slot of an admitted call.
+        """
+        with self.lock:
+            with self.state_open(str_PACSservice) as d_state:
+                self.count_add(d_state['inFlight'], self.str_pid, -1)
+            self.notify()
+
+    def stats_add(self, str_class, queueWait, serviceTime):
+        with self.lock:
+            d_stats                 = self.d_stats[str_class]
+            d_stats['calls']       += 1
+            d_stats['queueWait']   += queueWait
+            d_stats['queueWaitMax'] = max(d_stats['queueWaitMax'], queueWait)
+            d_stats['serviceTime'] += serviceTime
+
+    @contextlib.contextmanager
+    def slot(self, str_PACSservice, str_class = 'bulk'):
+        """
+        Context manager holding an admitted call to a PACS service for the
+        duration of the block.
+        """
+        startTime   = time.perf_counter()
+        with self.lock:
+            ticket  = self.enqueue(str_PACSservice, self.d_priority[str_class])
+            try:
+                while True:
+                    wait    = self.admit(str_PACSservice, ticket)
+                    if wait == 0:
+                        break
+                    self.lock.wait(wait)
+            except BaseException:
+                self.dequeue(str_PACSservice, ticket)
+                raise
+        admitTime   = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(str_PACSservice)
+            self.stats_add(str_class, admitTime - startTime, time.perf_counter() - admitTime)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, str_PACSservice, str_class = 'bulk'):
+        """
+        The asyncio form of slot(): a waiting call sleeps until it is 
+        notified (see notify), or until its next token is due.
+        """
+        import asyncio
+
+        startTime   = time.perf_counter()
+        waiter      = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            ticket  = self.enqueue(str_PACSservice, self.d_priority[str_class])
+            self.s_awaiter.add(waiter)
+        try:
+            while True:
+                with self.lock:
+                    waiter[1].clear()
+                    wait    = self.admit(str_PACSservice, ticket)
+                if wait == 0:
+                    break
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self.lock:
+                self.dequeue(str_PACSservice, ticket)
+            raise
+        finally:
+            with self.lock:
+                self.s_awaiter.discard(waiter)
+        admitTime   = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(str_PACSservice)
+            self.stats_add(str_class, admitTime - startTime, time.perf_counter() - admitTime)
+
+    def stats_get(self):
+        """
+        Return the per priority class call counts, and queue wait and 
+        service times (in seconds).
+        """
+        with self.lock:
+            return {
+                str_class: dict(d_stats)
+                for str_class, d_stats in self.d_stats.items()
+                if d_stats['calls']
+            }
+
+
+class SingleFlight(object):
+    '''
+    Coalesce concurrent identical calls: the first call of a key (the
+    leader) runs, and any call of the same key made while it is in flight
+    waits for and shares its result (bytes) rather than running again.
+
+    Within this process, duplicates wait on the leader's future (or its 
+    asyncio future). If a <flightDir> is given, duplicates in the other 
+    processes using it are coalesced too: the leader holds a lock file on
+    the key while it runs, and saves its result next to it for the 
+    processes blocked on the lock. The lock file is removed when the
+    leader is done, and old results are swept at most once every STALE
+    seconds.
+    '''
+
+    # Age in seconds after which saved results are removed
+    STALE       = 60
+
+    def __init__(self, *args, **kwargs):
+        self.str_flightDir  = ''
+        for k, v in kwargs.items():
+            if k == 'flightDir':    self.str_flightDir  = v
+
+        if len(self.str_flightDir):
+            os.makedirs(self.str_flightDir, exist_ok = True)
+        self.lock           = threading.Lock()
+        self.d_flight       = {}
+        self.d_aflight      = {}
+        self.sweepTime      = time.time()
+        self.d_stats        = {
+            'leaders':          0,
+            'coalesced':        0,
+            'crossProcess':     0
+        }
+
+    def stat_add(self, str_stat):
+        with self.lock:
+            self.d_stats[str_stat]  += 1
+
+    def flight_join(self, d_flight, str_key, future_make):
+        """
+        Return (future, True) if the caller leads the call of <str_key>, or
+        the in-flight (future, False) to wait on.
+        """
+        with self.lock:
+            future  = d_flight.get(str_key)
+            if future is not None:
+                self.d_stats['coalesced']   += 1
+                return future, False
+            future              = future_make()
+            d_flight[str_key]   = future
+            return future, True
+
+    def flight_end(self, d_flight, str_key):
+        with self.lock:
+            d_flight.pop(str_key, None)
+
+    def call(self, str_key, fn):
+        """
+        Return fn(), or the result of the identical call in flight.
+        """
+        import concurrent.futures
+
+        future, b_leader    = self.flight_join(self.d_flight, str_key, concurrent.futures.Future)
+        if not b_leader:
+            return future.result()
+        try:
+            f, result   = self.lock_acquire(str_key)
+            try:
+                if result is None:
+                    self.stat_add('leaders')
+                    result  = fn()
+                    self.result_save(str_key, f, result)
+            finally:
+                self.lock_release(str_key, f)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.flight_end(self.d_flight, str_key)
+
+    async def acall(self, str_key, fn):
+        """
+        The asyncio form of call, for a coroutine function <fn>. Waits on
+        the lock file are made in a worker thread.
+        """
+        import asyncio
+
+        future, b_leader    = self.flight_join(self.d_aflight, str_key,
+                                               asyncio.get_running_loop().create_future)
+        if not b_leader:
+            return await asyncio.shield(future)
+        try:
+            f, result   = None, None
+            if len(self.str_flightDir):
+                f, result   = await asyncio.get_running_loop().run_in_executor(
+                                            None, self.lock_acquire, str_key)
+            try:
+                if result is None:
+                    self.stat_add('leaders')
+                    result  = await fn()
+                    self.result_save(str_key, f, result)
+            finally:
+                self.lock_release(str_key, f)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Waiters get the exception: do not also warn it was never retrieved
+            future.exception()
+            raise
+        finally:
+            self.flight_end(self.d_aflight, str_key)
+
+    def path_get(self, str_key, str_ext):
+        return os.path.join(self.str_flightDir, '%s.%s' % (str_key, str_ext))
+
+    def lock_acquire(self, str_key):
+        """
+        Take the lock file of <str_key> (if there is a <flightDir>), and 
+        return (the open lock file, None) to lead the call, or (None, the 
+        result) if another process led it while we waited on the lock.
+        """
+        if not len(self.str_flightDir):
+            return None, None
+
+        import fcntl
+
+        startTime   = time.time()
+        str_lock    = self.path_get(str_key, 'lock')
+        str_result  = self.path_get(str_key, 'result')
+        while True:
+            f       = open(str_lock, 'a')
+            try:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+
+                # The lock is only held if its file was not removed (by the
+                # previous leader) while we opened and waited on it
+                try:
+                    b_held  = os.stat(str_lock).st_ino == os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    b_held  = False
+
+                # A result saved since we started was led by another process
+                # (else, the leader failed: lead the call in its place)
+                try:
+                    if os.path.getmtime(str_result) >= startTime:
+                        with open(str_result, 'rb') as fr:
+                            result  = fr.read()
+                        if b_held:
+                            self.lock_release(str_key, f)
+                        f.close()
+                        self.stat_add('crossProcess')
+                        return None, result
+                except OSError:
+                    pass
+                if b_held:
+                    return f, None
+                f.close()
+            except BaseException:
+                f.close()
+                raise
+
+    def lock_release(self, str_key, f):
+        """
+        Remove and unlock the lock file <f> of <str_key> (if any).
+        """
+        if f is None:
+            return
+        try:
+            os.remove(self.path_get(str_key, 'lock'))
+        except OSError:
+            pass
+        f.close()
+
+    def result_save(self, str_key, f, result):
+        """
+        Save the result of a call led under the lock file <f> for the 
+        processes waiting on it, sweeping the stale results if due.
+        """
+        if f is None:
+            return
+        str_result  = self.path_get(str_key, 'result')
+        str_tmp     = '%s.%d.%d.tmp' % (str_result, os.getpid(), threading.get_ident())
+        with open(str_tmp, 'wb') as fw:
+            fw.write(result)
+        os.replace(str_tmp, str_result)
+        with self.lock:
+            b_sweep         = time.time() - self.sweepTime >= self.STALE
+            if b_sweep:
+                self.sweepTime  = time.time()
+        if b_sweep:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove the results saved over STALE seconds ago.
+        """
+        staleTime   = time.time() - self.STALE
+        for entry in os.scandir(self.str_flightDir):
+            try:
+                if entry.name.endswith('.result') and entry.stat().st_mtime < staleTime:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats_get(self):
+        with self.lock:
+            return dict(self.d_stats)
+
+
+class PfdcmHTTPError(IOError):
+    '''
+    An HTTP level error status returned by 'pfdcm'.
+    '''
+    def __init__(self, status, reason):
+        IOError.__init__(self, 'pfdcm returned HTTP %d %s' % (status, reason))
+        self.status     = status
+
+
+class PfdcmNotSentError(IOError):
+    '''
+    A failure to send a request to 'pfdcm' (so that it cannot have acted
+    on it, and it is safe to resend).
+    '''
+
+
+class PfdcmSession(object):
+    '''
+    A reusable, keep-alive HTTP client session to a 'pfdcm' service.
+
+    Messages are POSTed in the same 'payload' JSON wrapper used by pfurl.
+    Connections are held in a bounded pool and reused across calls (and
+    threads); the 'hits' and 'misses' counters record how often a pooled
+    connection could be reused.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.str_pfdcm      = ''
+        self.poolSize       = 1
+        self.jsonwrapper    = 'payload'
+        self.timeout        = None
+        for k, v in kwargs.items():
+            if k == 'pfdcm':        self.str_pfdcm      = v
+            if k == 'poolSize':     self.poolSize       = max(1, v)
+            if k == 'jsonwrapper':  self.jsonwrapper    = v
+            if k == 'timeout':      self.timeout        = v
+
+        str_url             = self.str_pfdcm
+        if '://' not in str_url:
+            str_url         = 'http://' + str_url
+        self.url            = urllib.parse.urlsplit(str_url)
+        self.str_path       = self.url.path or '/'
+        if len(self.url.query):
+            self.str_path   = '%s?%s' % (self.str_path, self.url.query)
+
+        self.pool           = queue.LifoQueue(maxsize = self.poolSize)
+        self.lock           = threading.Lock()
+        self.hits           = 0
+        self.misses         = 0
+        self.requests       = 0
+
+    def connection_new(self):
+        """
+        Return a new (unconnected) connection to the service.
+        """
+        import http.client
+
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(
+                            self.url.hostname, self.url.port, timeout = self.timeout)
+        return http.client.HTTPConnection(
+                            self.url.hostname, self.url.port, timeout = self.timeout)
+
+    def connection_get(self):
+        """
+        Return a (connection, b_reused) tuple, preferring a pooled connection.
+        """
+        try:
+            conn    = self.pool.get_nowait()
+            with self.lock: self.hits   += 1
+            return conn, True
+        except queue.Empty:
+            with self.lock: self.misses += 1
+            return self.connection_new(), False
+
+    def connection_release(self, conn):
+        """
+        Return a connection to the pool, closing it if the pool is full.
+        """
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def exchange(self, conn, str_body, d_header):
+        """
+        POST a request body on a connection, and return the response and
+        its body. A failure to send the request is raised as a 
+        PfdcmNotSentError.
+        """
+        import http.client
+
+        try:
+            conn.request('POST', self.str_path, str_body, d_header)
+        except (http.client.HTTPException, OSError) as e:
+            raise PfdcmNotSentError('could not send to pfdcm: %s' % e) from e
+        response    = conn.getresponse()
+        return response, response.read()
+
+    def post(self, d_msg):
+        """
+        POST a message to 'pfdcm' and return the response body as bytes.
+        """
+        str_body    = json.dumps({self.jsonwrapper: d_msg}).encode('utf-8')
+        import http.client
+
+        d_header    = {
+            'Content-Type':     'application/json',
+            'Connection':       'keep-alive'
+        }
+        with self.lock: self.requests += 1
+
+        conn, b_reused  = self.connection_get()
+        try:
+            response, body  = self.exchange(conn, str_body, d_header)
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            if not b_reused or not (message_isQuery(d_msg) or isinstance(e, PfdcmNotSentError)):
+                raise
+            # The server may have dropped an idle keep-alive connection;
+            # resend once on a fresh connection. Only a query may be resent
+            # once its request went out.
+            conn        = self.connection_new()
+            try:
+                response, body  = self.exchange(conn, str_body, d_header)
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.connection_release(conn)
+        if response.status >= 400:
+            raise PfdcmHTTPError(response.status, response.reason)
+        return body
+
+    def stats_get(self):
+        """
+        Return the pool reuse counters.
+        """
+        with self.lock:
+            return {
+                'poolSize': self.poolSize,
+                'requests': self.requests,
+                'hits':     self.hits,
+                'misses':   self.misses
+            }
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AsyncPfdcmSession(object):
+    '''
+    An asyncio, keep-alive HTTP client session to a 'pfdcm' service: the 
+    counterpart of PfdcmSession for coroutines, to be used from within a 
+    single event loop.
+
+    Messages are POSTed in the same 'payload' JSON wrapper used by pfurl,
+    over a minimal HTTP/1.1 client on asyncio streams.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.str_pfdcm      = ''
+        self.poolSize       = 1
+        self.jsonwrapper    = 'payload'
+        for k, v in kwargs.items():
+            if k == 'pfdcm':        self.str_pfdcm      = v
+            if k == 'poolSize':     self.poolSize       = max(1, v)
+            if k == 'jsonwrapper':  self.jsonwrapper    = v
+
+        str_url             = self.str_pfdcm
+        if '://' not in str_url:
+            str_url         = 'http://' + str_url
+        self.url            = urllib.parse.urlsplit(str_url)
+        self.str_path       = self.url.path or '/'
+        if len(self.url.query):
+            self.str_path   = '%s?%s' % (self.str_path, self.url.query)
+        self.b_ssl          = self.url.scheme == 'https'
+        self.port           = self.url.port or (443 if self.b_ssl else 80)
+
+        self.pool           = []
+        self.hits           = 0
+        self.misses         = 0
+        self.requests       = 0
+
+    async def connection_get(self):
+        """
+        Return a ((reader, writer), b_reused) tuple, preferring a pooled 
+        connection that is still open.
+        """
+        import asyncio
+
+        while len(self.pool):
+            reader, writer  = self.pool.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.hits  += 1
+                return (reader, writer), True
+            writer.close()
+        self.misses    += 1
+        return await asyncio.open_connection(
+                            self.url.hostname, self.port, ssl = self.b_ssl or None), False
+
+    def connection_release(self, conn):
+        """
+        Return a connection to the pool, closing it if the pool is full.
+        """
+        if len(self.pool) < self.poolSize:
+            self.pool.append(conn)
+        else:
+            conn[1].close()
+
+    async def request(self, conn, body):
+        """
+        POST <body> on a connection and return the response (status, 
+        reason, body, b_close).
+        """
+        reader, writer  = conn
+        try:
+            writer.write((
+                'POST %s HTTP/1.1\r\n'
+                'Host: %s:%d\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: keep-alive\r\n\r\n' %
+                (self.str_path, self.url.hostname, self.port, len(body))).encode('latin-1') + body)
+            await writer.drain()
+        except OSError as e:
+            raise PfdcmNotSentError('could not send to pfdcm: %s' % e) from e
+
+        str_line    = (await reader.readline()).decode('latin-1')
+        if not len(str_line):
+            raise ConnectionResetError('pfdcm closed the connection')
+        l_status    = str_line.split(None, 2)
+        status      = int(l_status[1])
+        str_reason  = l_status[2].strip() if len(l_status) > 2 else ''
+        d_header    = {}
+        while True:
+            str_line    = (await reader.readline()).decode('latin-1').strip()
+            if not len(str_line):
+                break
+            str_name, sep, str_value    = str_line.partition(':')
+            d_header[str_name.strip().lower()]  = str_value.strip()
+
+        b_close     = d_header.get('connection', '').lower() == 'close' or \
+                        (l_status[0] == 'HTTP/1.0' and
+                         d_header.get('connection', '').lower() != 'keep-alive')
+        if 'content-length' in d_header:
+            body    = await reader.readexactly(int(d_header['content-length']))
+        elif d_header.get('transfer-encoding', '').lower() == 'chunked':
+            l_chunk = []
+            while True:
+                size    = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while len((await reader.readline()).strip()):
+                        pass
+                    break
+                l_chunk.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body    = b''.join(l_chunk)
+        else:
+            body    = await reader.read()
+            b_close = True
+        return status, str_reason, body, b_close
+
+    async def post(self, d_msg):
+        """
+        POST a message to 'pfdcm' and return the response body as bytes.
+        """
+        import asyncio
+
+        body            = json.dumps({self.jsonwrapper: d_msg}).encode('utf-8')
+        self.requests  += 1
+        conn, b_reused  = await self.connection_get()
+        try:
+            try:
+                status, str_reason, body, b_close   = await self.request(conn, body)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                conn[1].close()
+                if not b_reused or not (message_isQuery(d_msg) or isinstance(e, PfdcmNotSentError)):
+                    raise ConnectionResetError(str(e)) if isinstance(e, EOFError) else e
+                # The server may have dropped an idle keep-alive connection;
+                # resend once on a fresh connection. Only a query may be
+                # resent once its request went out.
+                conn, b_reused  = await self.connection_get()
+                status, str_reason, body, b_close   = await self.request(conn, body)
+        except BaseException:
+            # Also on cancellation (a timeout): the connection state is unknown
+            conn[1].close()
+            raise
+
+        if b_close:
+            conn[1].close()
+        else:
+            self.connection_release(conn)
+        if status >= 400:
+            raise PfdcmHTTPError(status, str_reason)
+        return body
+
+    def stats_get(self):
+        """
+        Return the pool reuse counters.
+        """
+        return {
+            'poolSize': self.poolSize,
+            'requests': self.requests,
+            'hits':     self.hits,
+            'misses':   self.misses
+        }
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        while len(self.pool):
+            self.pool.pop()[1].close()
+
+
+class HitStore(object):
+    '''
+    A compact, column oriented store of query hits.
+
+    A 'pfdcm' hit is a dict of DICOM tag name to a dict of fields (such
+    as 'tag', 'value' and 'label'). Instead of a dict per hit and per tag,
+    the store keeps one list (column) per (tag, field) pair, with interned
+    tag and field names, and equal string values shared between hits.
+    Hits are only rebuilt as dicts when indexed or iterated, and single
+    columns can be read directly.
+    '''
+
+    __slots__   = ('l_tag', 'd_column', 'hits', 'l_layout')
+
+    # Marks a (tag, field) absent from a hit
+    MISSING     = object()
+
+    def __init__(self, l_data = None):
+        self.l_tag      = []
+        self.d_column   = {}
+        self.hits       = 0
+        # The (tag, field names, columns) of the last hit appended
+        self.l_layout   = None
+        if l_data is not None:
+            self.extend(l_data)
+
+    def column_make(self, str_tag, str_field):
+        """
+        Return the column of a (tag, field), creating it if need be. The
+        field None holds tag entries that are not a (non-empty) dict.
+        """
+        d_field     = self.d_column.get(str_tag)
+        if d_field is None:
+            str_tag     = sys.intern(str_tag)
+            d_field     = self.d_column[str_tag]    = {}
+            self.l_tag.append(str_tag)
+        l_column    = d_field.get(str_field)
+        if l_column is None:
+            if str_field is not None:
+                str_field   = sys.intern(str_field)
+            l_column    = d_field[str_field]        = [self.MISSING] * self.hits
+            self.l_layout   = None
+        return l_column
+
+    def append(self, d_hit, d_shared = None):
+        """
+        Append a hit (dict), sharing equal string values via <d_shared>.
+        """
+        if d_shared is None:
+            d_shared    = {}
+        if self.l_layout is not None and self.layout_append(d_hit, d_shared):
+            return
+        index       = self.hits
+        columns     = 0
+        l_layout    = []
+        for str_tag, d_field in d_hit.items():
+            d_fieldColumn   = self.d_column.get(str_tag, {})
+            if isinstance(d_field, dict) and len(d_field):
+                for str_field, value in d_field.items():
+                    if isinstance(value, str):
+                        value   = d_shared.setdefault(value, value)
+                    l_column    = d_fieldColumn.get(str_field)
+                    if l_column is None:
+                        l_column    = self.column_make(str_tag, str_field)
+                    l_column.append(value)
+                    columns    += 1
+                if l_layout is not None:
+                    l_layout.append((str_tag, tuple(d_field),
+                                     tuple(self.d_column[str_tag][str_field] for str_field in d_field)))
+            else:
+                self.column_make(str_tag, None).append(d_field)
+                columns    += 1
+                l_layout    = None
+        self.hits  += 1
+
+        # Pad the columns this hit does not have
+        if columns < sum(len(d_fieldColumn) for d_fieldColumn in self.d_column.values()):
+            for d_fieldColumn in self.d_column.values():
+                for l_column in d_fieldColumn.values():
+                    if len(l_column) == index:
+                        l_column.append(self.MISSING)
+            l_layout    = None
+        self.l_layout   = l_layout
+
+    def layout_append(self, d_hit, d_shared):
+        """
+        Append a hit of the same tags and fields (in the same order) as the
+        last one, straight to its columns. Return False (appending nothing)
+        if the hit is laid out differently.
+        """
+        l_layout    = self.l_layout
+        if len(d_hit) != len(l_layout):
+            return False
+        share       = d_shared.setdefault
+        for tag, (str_tag, d_field) in enumerate(d_hit.items()):
+            str_layoutTag, t_field, t_column    = l_layout[tag]
+            if str_tag != str_layoutTag or type(d_field) is not dict or tuple(d_field) != t_field:
+                # Take back the fields of this hit appended so far
+                for str_layoutTag, t_field, t_column in l_layout[:tag]:
+                    for l_column in t_column:
+                        l_column.pop()
+                return False
+            for value, l_column in zip(d_field.values(), t_column):
+                l_column.append(share(value, value) if type(value) is str else value)
+        self.hits  += 1
+        return True
+
+    def extend(self, l_data):
+        """
+        Append a list of hits, or all the hits of another HitStore.
+        """
+        if isinstance(l_data, HitStore):
+            for str_tag in l_data.l_tag:
+                for str_field in l_data.d_column[str_tag]:
+                    self.column_make(str_tag, str_field)
+            for str_tag in self.l_tag:
+                d_other     = l_data.d_column.get(str_tag, {})
+                for str_field, l_column in self.d_column[str_tag].items():
+                    l_other = d_other.get(str_field)
+                    if l_other is None:
+                        l_column.extend([self.MISSING] * l_data.hits)
+                    else:
+                        l_column.extend(l_other)
+            self.hits  += l_data.hits
+        else:
+            d_shared    = {}
+            for d_hit in l_data:
+                self.append(d_hit, d_shared)
+
+    def select(self, l_index):
+        """
+        Return a new HitStore of the hits at the given indices.
+        """
+        store           = HitStore()
+        store.l_tag     = list(self.l_tag)
+        store.d_column  = {
+            str_tag: {
+                str_field: [l_column[i] for i in l_index]
+                for str_field, l_column in d_field.items()
+            }
+            for str_tag, d_field in self.d_column.items()
+        }
+        store.hits      = len(l_index)
+        return store
+
+    def column_set(self, str_tag, l_value, str_field = 'value'):
+        """
+        Set the (tag, field) of every hit from the list <l_value>.
+        """
+        if len(l_value) != self.hits:
+            raise ValueError('HitStore column of %d values for %d hits' % (len(l_value), self.hits))
+        self.column_make(str_tag, str_field)[:] = l_value
+
+    def column_get(self, str_tag, str_field = 'value', default = ''):
+        """
+        Return the list of a (tag, field) over all hits, with <default>
+        where a hit does not have it.
+        """
+        l_column    = self.d_column.get(str_tag, {}).get(str_field)
+        if l_column is None:
+            return [default] * self.hits
+        return [default if value is self.MISSING else value for value in l_column]
+
+    def plan_get(self):
+        """
+        Return, for every tag, a tuple of the tag, its column of non-dict
+        entries (or None) and its (field, column) pairs: the layout that
+        hits are rebuilt from.
+        """
+        l_plan  = []
+        for str_tag in self.l_tag:
+            d_fieldColumn   = self.d_column[str_tag]
+            l_plan.append((
+                str_tag,
+                d_fieldColumn.get(None),
+                tuple((str_field, l_column) for str_field, l_column in d_fieldColumn.items()
+                        if str_field is not None)
+            ))
+        return l_plan
+
+    def hit_get(self, index, l_plan = None):
+        """
+        Rebuild the hit (dict) at <index>, following <l_plan> (see
+        plan_get) if given.
+        """
+        MISSING = self.MISSING
+        d_hit   = {}
+        for str_tag, l_raw, t_field in l_plan or self.plan_get():
+            if l_raw is not None and l_raw[index] is not MISSING:
+                d_hit[str_tag]  = l_raw[index]
+                continue
+            d_field = {
+                str_field: l_column[index]
+                for str_field, l_column in t_field if l_column[index] is not MISSING
+            }
+            if len(d_field):
+                d_hit[str_tag]  = d_field
+        return d_hit
+
+    def __len__(self):
+        return self.hits
+
+    def __getitem__(self, index):
+        if index < 0:
+            index  += self.hits
+        if not 0 <= index < self.hits:
+            raise IndexError('HitStore index out of range')
+        return self.hit_get(index)
+
+    def __iter__(self):
+        l_plan  = self.plan_get()
+        for index in range(self.hits):
+            yield self.hit_get(index, l_plan)
+
+
+def hits_decode(body, l_keys = None):
+    """
+    Decode a raw 'pfdcm' query response body, building the HitStore of
+    its hits one hit at a time as they are decoded, so that the full list
+    of hit dicts is never held at once. Hits are trimmed to the tags in
+    <l_keys> (if any).
+
+    This needs the object hook of the standard 'json', so query responses
+    are not decoded with 'orjson' (see json_loads). Building the store 
+    takes most of the time: decoding the whole list with 'orjson' first 
+    saves little of it, at about three times the peak memory (see 
+    'bench/hitstore.py').
+
+    Return a tuple of the decoded response and whether any hit had to be
+    trimmed. If the hits are not laid out as expected, the response is
+    decoded as is (with a plain list of hits).
+    """
+    store       = HitStore()
+    d_shared    = {}
+    l_keys      = l_keys or []
+    s_keys      = set(l_keys)
+    l_trimmed   = []
+
+    def hit_add(d):
+        # A hit is a dict of tags, each a dict with a 'value'
+        if 'value' in d or not len(d) or \
+                not all(type(v) is dict and 'value' in v for v in d.values()):
+            return d
+        if len(s_keys) and len(d.keys() - s_keys):
+            l_trimmed.append(True)
+            d   = {key: d[key] for key in l_keys if key in d}
+        store.append(d, d_shared)
+        return store.hits - 1
+
+    d_response  = json.loads(body, object_hook = hit_add)
+    try:
+        l_data  = d_response['query']['data']
+    except (KeyError, TypeError):
+        l_data  = None
+    if l_data != list(range(store.hits)):
+        return json_loads(body), False
+    d_response['query']['data'] = store
+    return d_response, len(l_trimmed) > 0
+
+
+def hits_column(l_data, str_tag, str_field = 'value', default = ''):
+    """
+    Return the list of a (tag, field) over a list of hits or a HitStore,
+    with <default> where a hit does not have it.
+    """
+    if isinstance(l_data, HitStore):
+        return l_data.column_get(str_tag, str_field, default)
+    l_column    = []
+    for d_hit in l_data:
+        d_field = d_hit.get(str_tag)
+        l_column.append(d_field.get(str_field, default) if isinstance(d_field, dict) else default)
+    return l_column
+
+
+def hits_select(l_data, l_index):
+    """
+    Return the hits at the given indices of a list of hits or a HitStore.
+    """
+    if isinstance(l_data, HitStore):
+        return l_data.select(l_index)
+    return [l_data[i] for i in l_index]
+
+
+class HitFilter(object):
+    '''
+    A predicate over query hits, compiled once from the query criteria: a
+    list of Modality values, a StudyDate range (YYYYMMDD-YYYYMMDD, either 
+    end of which may be left open) and a SeriesDescription regular 
+    expression. A hit is kept if it meets all the criteria given; a hit
+    without a tag that is filtered on is dropped.
+
+    The hits are filtered in one pass over the columns of the tags that 
+    are filtered on, and the criteria that 'pfdcm' can match itself are
+    returned by on_get to be pushed down into the query.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        import re
+
+        self.l_modality             = []
+        self.str_studyDate          = ''
+        self.str_seriesDescription  = ''
+        for k, v in kwargs.items():
+            if k == 'modality':             self.l_modality             = v
+            if k == 'studyDate':            self.str_studyDate          = v
+            if k == 'seriesDescription':    self.str_seriesDescription  = v
+
+        self.l_modality = [str_modality.strip().upper() for str_modality in self.l_modality
+                            if len(str_modality.strip())]
+        self.l_test     = []
+        if len(self.l_modality):
+            s_modality  = set(self.l_modality)
+            self.l_test.append(('Modality', lambda value: str(value).strip().upper() in s_modality))
+        self.str_start  = self.str_end  = ''
+        if len(self.str_studyDate.strip()):
+            start, end      = studyDateRange_parse(self.str_studyDate)
+            self.str_start  = start.strftime('%Y%m%d') if start else ''
+            self.str_end    = end.strftime('%Y%m%d') if end else ''
+            self.l_test.append(('StudyDate', self.studyDate_test))
+        if len(self.str_seriesDescription):
+            search          = re.compile(self.str_seriesDescription).search
+            self.l_test.append(('SeriesDescription', lambda value: search(str(value)) is not None))
+
+    def __bool__(self):
+        return len(self.l_test) > 0
+
+    def studyDate_test(self, value):
+        # Also accept the old 'YYYY.MM.DD' form of a DICOM date
+        str_date    = str(value).strip().replace('.', '')
+        return len(str_date) == 8 and str_date.isdigit() and \
+                (not self.str_start or str_date >= self.str_start) and \
+                (not self.str_end or str_date <= self.str_end)
+
+    def tags_get(self):
+        """
+        Return the tags filtered on.
+        """
+        return [str_tag for str_tag, test in self.l_test]
+
+    def on_get(self):
+        """
+        Return the criteria that can be pushed down into the 'on' of a 
+        'pfdcm' query: a single Modality, and the StudyDate range.
+        """
+        d_on    = {}
+        if len(self.l_modality) == 1:
+            d_on['Modality']    = self.l_modality[0]
+        if self.str_start or self.str_end:
+            d_on['StudyDate']   = '%s-%s' % (self.str_start, self.str_end)
+        return d_on
+
+    def select(self, l_data):
+        """
+        Return the indices of the hits (of a list or a HitStore) that meet 
+        all the criteria.
+        """
+        l_column    = [hits_column(l_data, str_tag, default = None) for str_tag, test in self.l_test]
+        l_fn        = [test for str_tag, test in self.l_test]
+        return [
+            index for index, t_value in enumerate(zip(*l_column))
+            if all(value is not None and test(value) for test, value in zip(l_fn, t_value))
+        ]
+
+
+class CompressWriter(io.RawIOBase):
+    '''
+    A (binary) file writer that compresses what is written to it, as it 
+    is written, with 'gzip' or 'zstd' (if the 'zstandard' package is 
+    installed). Only the compressor state is held in memory.
+
+    The uncompressed and compressed byte counts and the time spent 
+    compressing are kept in <bytesIn>, <bytesOut> and <seconds>.
+    '''
+
+    # The file name suffix and default level of each format
+    d_format    = {
+        'gzip':     ('.gz',     6),
+        'zstd':     ('.zst',    3)
+    }
+
+    def __init__(self, str_path, str_format = 'gzip', level = 0):
+        super().__init__()
+        level           = level or self.d_format[str_format][1]
+        if str_format == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level = level).compressobj()
+        else:
+            import zlib
+            # wbits 31: a gzip header and trailer around the deflate stream
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.f          = open(str_path, 'wb')
+        self.bytesIn    = 0
+        self.bytesOut   = 0
+        self.seconds    = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        startTime       = time.perf_counter()
+        compressed      = self.compressor.compress(bytes(data))
+        self.seconds   += time.perf_counter() - startTime
+        self.bytesIn   += len(data)
+        self.bytesOut  += len(compressed)
+        self.f.write(compressed)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            startTime       = time.perf_counter()
+            compressed      = self.compressor.flush()
+            self.seconds   += time.perf_counter() - startTime
+            self.bytesOut  += len(compressed)
+            self.f.write(compressed)
+            self.f.close()
+        super().close()
+
+
+class RawResultStream(object):
+    '''
+    A stand-in for a ResultStream that writes a raw 'pfdcm' response 
+    body (bytes) to a (binary) file as is, ignoring the decoded hits.
+    '''
+
+    def __init__(self, f, body):
+        self.f      = f
+        self.body   = body
+
+    def write(self, l_hits):
+        pass
+
+    def close(self, d_results = None):
+        self.f.write(self.body)
+        self.f.close()
+
+
+class ResultStream(object):
+    '''
+    Incrementally write query hits to an (open) result file.
+
+    In 'json' format the file is the document json.dump would write of 
+    the results, with the streamed hits as its {"query": {"data": [...]}}.
+    If the (non-hit) results are given on construction, the hits are 
+    written straight to the file between its head and tail; otherwise 
+    they are spooled (to disk, past a few MiB) until the results are
+    known on close. In 'ndjson' format each hit is written as one line.
+    '''
+
+    # Spooled hits are kept in memory up to this size
+    SPOOL       = 8 * 1024 * 1024
+
+    def __init__(self, f, *args, **kwargs):
+        self.f              = f
+        self.str_format     = 'json'
+        self.b_sortKeys     = False
+        self.indent         = None
+        d_results           = None
+        for k, v in kwargs.items():
+            if k == 'format':       self.str_format     = v
+            if k == 'sortKeys':     self.b_sortKeys     = v
+            if k == 'indent':       self.indent         = v
+            if k == 'results':      d_results           = v
+
+        if self.str_format == 'ndjson':
+            self.indent     = None
+        self.encoder        = json.JSONEncoder(sort_keys = self.b_sortKeys, indent = self.indent)
+        self.str_nl         = '' if self.indent is None else '\n'
+        self.str_sep        = ', ' if self.indent is None else ','
+        self.hits           = 0
+        self.f_hits         = self.f
+        self.str_tail       = None
+
+        if self.str_format == 'json':
+            if d_results is not None:
+                str_head, self.str_tail = self.layout_get(d_results, False)
+                self.f.write(str_head)
+            else:
+                import tempfile
+
+                self.f_hits = tempfile.SpooledTemporaryFile(max_size = self.SPOOL, mode = 'w+')
+
+    def indent_get(self, depth):
+        return ' ' * (self.indent or 0) * depth
+
+    def value_encode(self, value, depth):
+        """
+        Encode a value nested at <depth> in the document.
+        """
+        str_json    = self.encoder.encode(value)
+        if self.indent is None:
+            return str_json
+        return str_json.replace('\n', '\n' + self.indent_get(depth))
+
+    def layout_get(self, d_results, b_spooled):
+        """
+        Return the (head, tail) of the document of <d_results> around its
+        hits array, or (the whole document, '') if it has none. Spooled 
+        hits are the 'data' of the 'query' (made for them if need be).
+        """
+        import uuid
+
+        d_results   = dict(d_results)
+        d_query     = d_results.get('query', {} if self.hits else None)
+        if not isinstance(d_query, dict) or not (b_spooled or 'data' in d_query):
+            return self.encoder.encode(d_results), ''
+        # Encode a unique placeholder string in place of the hits array
+        str_mark            = 'hits-%s' % uuid.uuid4().hex
+        d_results['query']  = dict(d_query, data = str_mark)
+        str_head, str_tail  = self.encoder.encode(d_results).split(self.encoder.encode(str_mark))
+        return str_head + '[', str_tail
+
+    def write(self, l_hits):
+        """
+        Write a list of hits.
+        """
+        if self.str_tail == '':
+            # Results given with no 'query' to hold the hits
+            return
+        for d_hit in l_hits:
+            if self.str_format == 'ndjson':
+                self.f_hits.write(self.encoder.encode(d_hit))
+                self.f_hits.write('\n')
+            else:
+                self.f_hits.write('%s%s%s' % (
+                                    self.str_sep if self.hits else '',
+                                    self.str_nl + self.indent_get(3),
+                                    self.value_encode(d_hit, 3)))
+            self.hits  += 1
+
+    def close(self, d_results = None):
+        """
+        Write out the document of <d_results> around the hits (for 'json',
+        unless the results were given on construction), and close.
+        """
+        if self.str_format == 'json':
+            if self.str_tail is None:
+                import shutil
+
+                str_head, self.str_tail = self.layout_get(d_results or {}, True)
+                self.f.write(str_head)
+                if len(self.str_tail):
+                    self.f_hits.seek(0)
+                    shutil.copyfileobj(self.f_hits, self.f)
+                self.f_hits.close()
+            if len(self.str_tail):
+                if self.hits:
+                    self.f.write(self.str_nl + self.indent_get(2))
+                self.f.write(']' + self.str_tail)
+        self.f.close()
+
+
+class SummaryStream(object):
+    '''
+    Incrementally write the summary table of query hits to an (open) file.
+
+    Each batch of hits is read one column (summary key) at a time; keys
+    missing from a hit give an empty cell. 'csv' and 'tsv' rows are 
+    written as the hits arrive. The 'fixed' format pads each column to 
+    its widest entry, so only the summary cells are kept until close.
+    '''
+
+    def __init__(self, f, *args, **kwargs):
+        self.f              = f
+        self.l_keys         = []
+        self.str_format     = 'fixed'
+        for k, v in kwargs.items():
+            if k == 'keys':         self.l_keys         = v
+            if k == 'format':       self.str_format     = v
+
+        self.hits           = 0
+        self.writer         = None
+        self.l_column       = [[] for key in self.l_keys]
+        if self.str_format in ['csv', 'tsv']:
+            import csv
+
+            self.writer     = csv.writer(
+                                f,
+                                dialect         = 'excel' if self.str_format == 'csv' else 'excel-tab',
+                                lineterminator  = '\n')
+
+    def write(self, l_hits):
+        """
+        Write (or for 'fixed', collect) the summary rows of a list of hits.
+        """
+        if not len(l_hits):
+            return
+        l_column    = [
+            [str(value) for value in hits_column(l_hits, key)]
+            for key in self.l_keys
+        ]
+        if self.writer:
+            if not self.hits:
+                self.writer.writerow(self.l_keys)
+            self.writer.writerows(zip(*l_column))
+        else:
+            for l_all, l_cell in zip(self.l_column, l_column):
+                l_all.extend(l_cell)
+        self.hits  += len(l_hits)
+
+    def close(self):
+        """
+        Write out any 'fixed' width table, and close.
+        """
+        if not self.writer and self.hits:
+            l_width = [
+                max([len(key)] + [len(str_cell) for str_cell in l_cell])
+                for key, l_cell in zip(self.l_keys, self.l_column)
+            ]
+            str_format  = '\t'.join('%%-%ds' % width for width in l_width) + '\n'
+            self.f.write(str_format % tuple(self.l_keys))
+            for row in zip(*self.l_column):
+                self.f.write(str_format % row)
+        self.f.close()
+
+
+class StudyIndex(object):
+    '''
+    A study level index of query hits, grouped by StudyInstanceUID, with 
+    the rollups of each study: its (distinct) series, the total of their
+    NumberOfSeriesRelatedInstances and the set of their modalities.
+
+    Like an output stream, the hits are indexed in one pass as they are
+    written, so that only an entry per study (and not the hits) is kept.
+    Hits without a StudyInstanceUID are counted, but not indexed.
+    '''
+
+    # The tags read from each hit
+    l_hitTags   = [
+        'StudyInstanceUID', 'SeriesInstanceUID', 'Modality', 'NumberOfSeriesRelatedInstances',
+        'PatientID', 'StudyDate', 'StudyDescription'
+    ]
+
+    # The (DICOM study level) keys of each study row
+    l_studyKeys = [
+        'PatientID', 'StudyDate', 'StudyInstanceUID', 'StudyDescription', 'ModalitiesInStudy',
+        'NumberOfStudyRelatedSeries', 'NumberOfStudyRelatedInstances'
+    ]
+
+    def __init__(self):
+        self.d_study    = {}
+        self.hits       = 0
+
+    def write(self, l_hits):
+        """
+        Index a list of hits (or a HitStore).
+        """
+        self.hits  += len(l_hits)
+        for str_studyUID, str_seriesUID, str_modality, instances,               \
+                str_patientID, str_studyDate, str_studyDescription in zip(
+                    *[hits_column(l_hits, str_tag) for str_tag in self.l_hitTags]):
+            if not str_studyUID:
+                continue
+            d_study = self.d_study.get(str_studyUID)
+            if d_study is None:
+                d_study = self.d_study[str_studyUID]   = {
+                    'PatientID':        str_patientID,
+                    'StudyDate':        str_studyDate,
+                    'StudyDescription': str_studyDescription,
+                    'series':           set(),
+                    'instances':        0,
+                    'modalities':       set()
+                }
+            if str_seriesUID and str_seriesUID not in d_study['series']:
+                d_study['series'].add(str_seriesUID)
+                str_instances           = str(instances).strip()
+                if str_instances.isdigit():
+                    d_study['instances']   += int(str_instances)
+            if str_modality:
+                d_study['modalities'].add(str(str_modality))
+
+    def close(self):
+        pass
+
+    def stats_get(self):
+        """
+        Return the hit, study, series and instance counts.
+        """
+        return {
+            'hits':         self.hits,
+            'studies':      len(self.d_study),
+            'series':       sum(len(d_study['series']) for d_study in self.d_study.values()),
+            'instances':    sum(d_study['instances'] for d_study in self.d_study.values())
+        }
+
+    def rows_get(self):
+        """
+        Return the study rollups as a list of hits of the l_studyKeys (so
+        that they can be written by a SummaryStream), ordered by PatientID
+        and StudyDate.
+        """
+        l_row   = []
+        for str_studyUID, d_study in self.d_study.items():
+            d_row   = {
+                'PatientID':                        d_study['PatientID'],
+                'StudyDate':                        d_study['StudyDate'],
+                'StudyInstanceUID':                 str_studyUID,
+                'StudyDescription':                 d_study['StudyDescription'],
+                'ModalitiesInStudy':                ','.join(sorted(d_study['modalities'])),
+                'NumberOfStudyRelatedSeries':       len(d_study['series']),
+                'NumberOfStudyRelatedInstances':    d_study['instances']
+            }
+            l_row.append({key: {'value': value} for key, value in d_row.items()})
+        l_row.sort(key = lambda d_row: tuple(str(d_row[key]['value']) for key in self.l_studyKeys[:3]))
+        return l_row
+
+
+class PacsQueryApp(ChrisApp):
+    '''
+    '''
+    AUTHORS = 'FNNDSC (dev@babyMRI.org)'
+    SELFPATH = os.path.dirname(os.path.abspath(__file__))
+    SELFEXEC = os.path.basename(__file__)
+    EXECSHELL = 'python3'
+    TITLE = 'Pacs Query'
+    CATEGORY = ''
+    TYPE = 'fs'
+    DESCRIPTION = 'An app to query a PACS using an intermediary REST service.'
+    DOCUMENTATION = 'http://wiki'
+    LICENSE = 'Opensource (MIT)'
+    VERSION = '0.99'
+    MAX_NUMBER_OF_WORKERS = 1  # Override with integer value
+    MIN_NUMBER_OF_WORKERS = 1  # Override with integer value
+    MAX_CPU_LIMIT = ''  # Override with millicore value as string, e.g. '2000m'
+    MIN_CPU_LIMIT = ''  # Override with millicore value as string, e.g. '2000m'
+    MAX_MEMORY_LIMIT = ''  # Override with string, e.g. '1Gi', '2000Mi'
+    MIN_MEMORY_LIMIT = ''  # Override with string, e.g. '1Gi', '2000Mi'
+    MIN_GPU_LIMIT = 0  # Override with the minimum number of GPUs, as an integer, for your plugin
+    MAX_GPU_LIMIT = 0  # Override with the maximum number of GPUs, as an integer, for your plugin
+
+    # Fill out this with key-value output descriptive info (such as an output file path
+    # relative to the output dir) that you want to save to the output meta file when
+    # called with the --saveoutputmeta flag
+    OUTPUT_META_DICT = {}
+
+    def __init__(self, *args, **kwargs):
+        import pfmisc
+
+        ChrisApp.__init__(self, *args, **kwargs)
+
+        self.__name__           = 'PacsQueryApp'
+
+        # Debugging control
+        self.b_useDebug         = False
+        self.str_debugFile      = '/dev/null'
+        self.b_quiet            = True
+        self.dp                 = pfmisc.debug(    
+                                            verbosity   = 0,
+                                            level       = -1,
+                                            within      = self.__name__
+                                            )
+        self.pp                 = pprint.PrettyPrinter(indent=4)
+
+        # Output dir
+        self.str_outputDir      = ''
+
+        # Service and payload vars
+        self.str_pfdcm          = ''
+        self.str_msg            = ''
+        self.d_msg              = {}
+        self.l_msg              = []
+
+        # Alternate, simplified CLI flags
+        self.str_patientID      = ''
+        self.l_patientID        = []
+        self.str_PACSservice    = ''
+
+        # Fan-out across several PACS services
+        self.l_PACSservice      = []
+        self.b_PACSfirstComplete= False
+
+        # Batch (multi-patient) query control
+        self.jobs               = 1
+
+        # Serving query jobs from a warm process (see serve)
+        self.b_serve            = False
+
+        # Persistent HTTP session to 'pfdcm', and the asyncio session of
+        # an --async query
+        self.poolSize           = 0
+        self.session            = None
+        self.b_async            = False
+        self.asyncSession       = None
+
+        # On-disk query cache
+        self.cache              = None
+
+        # Timeouts, retries and hedging of 'pfdcm' calls
+        self.retry              = RetryEngine()
+
+        # Rate limit, in-flight cap and priority of 'pfdcm' calls
+        self.scheduler          = None
+        self.str_priority       = 'bulk'
+
+        # Coalescing of concurrent identical 'pfdcm' queries
+        self.flight             = None
+
+        # Client side filter of the hits on the query criteria
+        self.filter             = None
+
+        # Study level index (and rollups) of the hits of a run
+        self.studyIndex         = None
+
+        # Incremental (delta) query state
+        self.state              = None
+
+        # Persistent SQLite index of hits
+        self.index              = None
+
+        # Chunked (split) queries
+        self.chunkDays          = 0
+        self.maxChunkHits       = 0
+        self.chunkRange         = (None, None)
+        self.l_chunkModality    = []
+
+        # Per-phase timing (seconds) and count metrics
+        self.d_metrics          = {'time': {}, 'count': {}}
+        self.metricsLock        = threading.Lock()
+        self.str_metricsFile    = ''
+
+        # Control
+        self.b_canRun           = False
+
+        # Summary report
+        self.b_summaryReport    = False
+        self.str_summaryKeys    = ''
+        self.l_summaryKeys      = []
+        self.str_summaryFile    = ''
+        self.str_summaryFormat  = 'fixed'
+
+        # Tags returned for each hit (projection); empty for all
+        self.l_returnKeys       = []
+
+        # Result report
+        self.str_resultFile     = ''
+        self.str_resultFormat   = 'json'
+        self.b_resultSortKeys   = False
+        self.resultIndent       = None
+
+        # Raw (passthrough) result: the last response body received
+        self.b_resultRaw        = False
+        self.resultBody         = None
+
+        # Output file compression, and the compressed name and writer of
+        # each output file
+        self.str_compress       = ''
+        self.compressLevel      = 0
+        self.d_outputFile       = {}
+       
+    def define_parameters(self):
+        """
+        Define the CLI arguments accepted by this plugin app.
+        """
+
+        # The space of input parameters is very straightforward
+        #   1. The IP:port of the pfdcm service
+        #   2. A 'msg' type string / dictionary to send to the service.
+
+        # PACS settings
+        self.add_argument(
+            '--pfdcm',
+            dest        = 'str_pfdcm',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'The PACS Q/R intermediary service IP:port.')
+        self.add_argument(
+            '--msg',
+            dest        = 'str_msg',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'The actual complete JSON message to send to the Q/R intermediary service.')
+        self.add_argument(
+            '--PatientID',
+            dest        = 'str_patientID',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'The PatientID to query. A comma separated list queries each patient.')
+        self.add_argument(
+            '--PatientIDFile',
+            dest        = 'str_patientIDFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'A file of PatientIDs (one per line) to query.')
+        self.add_argument(
+            '--Modality',
+            dest        = 'str_modality',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, only return the hits of these (comma separated) modalities.')
+        self.add_argument(
+            '--StudyDate',
+            dest        = 'str_studyDate',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, only return the hits in this StudyDate range (YYYYMMDD-YYYYMMDD).')
+        self.add_argument(
+            '--SeriesDescription',
+            dest        = 'str_seriesDescription',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, only return the hits whose SeriesDescription matches this regex.')
+        self.add_argument(
+            '--jobs',
+            dest        = 'jobs',
+            type        = int,
+            default     = 1,
+            optional    = True,
+            help        = 'The number of concurrent queries to dispatch in a multi-patient query.')
+        self.add_argument(
+            '--async',
+            dest        = 'b_async',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, dispatch a multi-patient query with an asyncio client.')
+        self.add_argument(
+            '--poolSize',
+            dest        = 'poolSize',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, reuse up to this many keep-alive connections to pfdcm.')
+        self.add_argument(
+            '--timeout',
+            dest        = 'timeout',
+            type        = float,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, the time limit (in seconds) of each attempt at a pfdcm call.')
+        self.add_argument(
+            '--deadline',
+            dest        = 'deadline',
+            type        = float,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, the total time limit (in seconds) of a pfdcm call, over all attempts.')
+        self.add_argument(
+            '--retries',
+            dest        = 'retries',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'The number of times to retry a pfdcm call that failed transiently.')
+        self.add_argument(
+            '--backoff',
+            dest        = 'backoff',
+            type        = float,
+            default     = 0.5,
+            optional    = True,
+            help        = 'The base (in seconds) of the jittered exponential backoff between retries.')
+        self.add_argument(
+            '--hedgePercentile',
+            dest        = 'hedgePercentile',
+            type        = float,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, hedge a query taking longer than this latency percentile.')
+        self.add_argument(
+            '--rateLimit',
+            dest        = 'rateLimit',
+            type        = float,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, the maximum rate of calls (per second) to each PACS service.')
+        self.add_argument(
+            '--rateBurst',
+            dest        = 'rateBurst',
+            type        = int,
+            default     = 1,
+            optional    = True,
+            help        = 'The number of calls that may be made at once under the --rateLimit.')
+        self.add_argument(
+            '--maxInFlight',
+            dest        = 'maxInFlight',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, the maximum number of calls outstanding on each PACS service.')
+        self.add_argument(
+            '--priority',
+            dest        = 'str_priority',
+            type        = str,
+            default     = '',
+            choices     = ['', 'interactive', 'bulk'],
+            optional    = True,
+            help        = 'The priority class of the calls (by default, interactive for a single patient).')
+        self.add_argument(
+            '--schedulerDir',
+            dest        = 'str_schedulerDir',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, share the call scheduling with all runs using this directory.')
+        self.add_argument(
+            '--coalesceDir',
+            dest        = 'str_coalesceDir',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, coalesce identical queries with all runs using this directory.')
+        self.add_argument(
+            '--cacheDir',
+            dest        = 'str_cacheDir',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, cache query responses in this directory.')
+        self.add_argument(
+            '--cacheTTL',
+            dest        = 'cacheTTL',
+            type        = float,
+            default     = 3600,
+            optional    = True,
+            help        = 'The lifetime (in seconds) of a cached query response.')
+        self.add_argument(
+            '--cacheMaxBytes',
+            dest        = 'cacheMaxBytes',
+            type        = int,
+            default     = 256 * 1024 * 1024,
+            optional    = True,
+            help        = 'The maximum size of the query cache; least recently used entries are evicted.')
+        self.add_argument(
+            '--PACSservice',
+            dest        = 'str_PACSservice',
+            type        = str,
+            default     = 'orthanc',
+            optional    = True,
+            help        = 'The PACS service(s) to use. Note this a key to a lookup in "pfdcm".')
+        self.add_argument(
+            '--PACSfirstComplete',
+            dest        = 'b_PACSfirstComplete',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, use the hits of the first of several PACS services to answer.')
+        self.add_argument(
+            '--summaryKeys',
+            dest        = 'str_summaryKeys',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, generate a summary report based on a comma separated key list.')
+        self.add_argument(
+            '--summaryFile',
+            dest        = 'str_summaryFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) a summary report to passed file (in outputdir).')
+        self.add_argument(
+            '--summaryFormat',
+            dest        = 'str_summaryFormat',
+            type        = str,
+            default     = 'fixed',
+            choices     = ['fixed', 'csv', 'tsv'],
+            optional    = True,
+            help        = 'The format of the summary report.')
+        self.add_argument(
+            '--studySummaryFile',
+            dest        = 'str_studySummaryFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) a per study summary report to passed file (in outputdir).')
+        self.add_argument(
+            '--returnKeys',
+            dest        = 'str_returnKeys',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'A comma separated list of the only tags to return for each hit ("*" for all).')
+        self.add_argument(
+            '--numberOfHitsFile',
+            dest        = 'str_numberOfHitsFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) the number of hits (in outputdir).')
+        self.add_argument(
+            '--countsFile',
+            dest        = 'str_countsFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save the number of hits, studies and series (in outputdir).')
+        self.add_argument(
+            '--chunkDays',
+            dest        = 'chunkDays',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, split each query into StudyDate windows of this many days.')
+        self.add_argument(
+            '--chunkStudyDate',
+            dest        = 'str_chunkStudyDate',
+            type        = str,
+            default     = '-',
+            optional    = True,
+            help        = 'The StudyDate range (YYYYMMDD-YYYYMMDD, default open) covered by a --chunkDays query. Studies without a StudyDate are not found.')
+        self.add_argument(
+            '--chunkModalities',
+            dest        = 'str_chunkModalities',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, also split each --chunkDays query by this comma separated Modality list.')
+        self.add_argument(
+            '--maxChunkHits',
+            dest        = 'maxChunkHits',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'If specified, re-split any chunk returning more than this many hits.')
+        self.add_argument(
+            '--incremental',
+            dest        = 'b_incremental',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, only query for and report hits new since the last run.')
+        self.add_argument(
+            '--stateDir',
+            dest        = 'str_stateDir',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'The directory holding the --incremental query state.')
+        self.add_argument(
+            '--mergedResultFile',
+            dest        = 'str_mergedResultFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified with --incremental, save (overwrite) all hits seen so far (in outputdir).')
+        self.add_argument(
+            '--indexDB',
+            dest        = 'str_indexDB',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, upsert all hits into this SQLite index.')
+        self.add_argument(
+            '--indexLookup',
+            dest        = 'b_indexLookup',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, look the PatientID(s) up in the --indexDB instead of querying pfdcm.')
+        self.add_argument(
+            '--lookupSeriesDescription',
+            dest        = 'str_lookupSeriesDescription',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified with --indexLookup, a SQL LIKE pattern on the SeriesDescription.')
+        self.add_argument(
+            '--metricsFile',
+            dest        = 'str_metricsFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) timing and size metrics as JSON (in outputdir).')
+        self.add_argument(
+            '--serve',
+            dest        = 'str_serve',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, serve query jobs on this Unix socket ("-" for stdin).')
+        self.add_argument(
+            '--submit',
+            dest        = 'str_submit',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, submit this command line as a job to the server on this Unix socket.')
+        self.add_argument(
+            '--resultFile',
+            dest        = 'str_resultFile',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, save (overwrite) all the hits to the passed file (in outputdir).')
+        self.add_argument(
+            '--resultFormat',
+            dest        = 'str_resultFormat',
+            type        = str,
+            default     = 'json',
+            choices     = ['json', 'ndjson'],
+            optional    = True,
+            help        = 'The format of the resultFile: a JSON document, or one JSON hit per line.')
+        self.add_argument(
+            '--resultSortKeys',
+            dest        = 'b_resultSortKeys',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, sort the keys in the resultFile.')
+        self.add_argument(
+            '--resultIndent',
+            dest        = 'resultIndent',
+            type        = int,
+            default     = None,
+            optional    = True,
+            help        = 'If specified, indent the (json) resultFile by this many spaces.')
+        self.add_argument(
+            '--resultRaw',
+            dest        = 'b_resultRaw',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'If specified, write the raw pfdcm response bytes to the resultFile.')
+        self.add_argument(
+            '--compress',
+            dest        = 'str_compress',
+            type        = str,
+            default     = '',
+            choices     = ['', 'gzip', 'zstd'],
+            optional    = True,
+            help        = 'If specified, compress the result and summary files (gzip or zstd).')
+        self.add_argument(
+            '--compressLevel',
+            dest        = 'compressLevel',
+            type        = int,
+            default     = 0,
+            optional    = True,
+            help        = 'The compression level (default 6 for gzip, 3 for zstd).')
+        self.add_argument(
+            '--man',
+            dest        = 'str_man',
+            type        = str,
+            default     = '',
+            optional    = True,
+            help        = 'If specified, print help on the passed key entry. Use "entries" for all key list')
+        self.add_argument(
+            '--pfurlQuiet',
+            dest        = 'b_pfurlQuiet',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'Silence pfurl noise.'),
+        self.add_argument(
+            '--version',
+            dest        = 'b_version',
+            type        = bool,
+            default     = False,
+            action      = 'store_true',
+            optional    = True,
+            help        = 'Show .')
+
+    def df_print(self, adict):
+        """
+        Return a nicely formatted string representation of a dictionary
+        """
+        return self.pp.pformat(adict).strip()
+
+    def metric_add(self, str_group, str_name, value):
+        """
+        Accumulate <value> into the named metric (thread safe).
+        """
+        with self.metricsLock:
+            d_group             = self.d_metrics.setdefault(str_group, {})
+            d_group[str_name]   = d_group.get(str_name, 0) + value
+
+    @contextlib.contextmanager
+    def metric_time(self, str_phase):
+        """
+        Context manager accumulating the wall time of a phase.
+        """
+        startTime   = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.metric_add('time', str_phase, time.perf_counter() - startTime)
+
+    def service_call(self, *args, **kwargs):
+
+        d_msg   = {}
+        for k, v in kwargs.items():
+            if k == 'msg':  d_msg   = v
+
+        d_response  = self.cache_lookup(d_msg)
+        if d_response is not None:
+            return d_response
+
+        self.dp.qprint('Sending d_msg =\n %s' % self.df_print(d_msg))
+        if not self.flight or not message_isQuery(d_msg):
+            body, d_response    = self.retry.call(
+                                        lambda: self.service_attempt(d_msg),
+                                        b_idempotent = message_isQuery(d_msg))
+            return self.response_accept(d_msg, body, d_response)
+
+        l_lead  = []
+        def lead():
+            body, d_response    = self.retry.call(
+                                        lambda: self.service_attempt(d_msg),
+                                        b_idempotent = True)
+            l_lead.append(d_response)
+            return body
+        body    = self.flight.call(message_key(d_msg), lead)
+        return self.response_accept(d_msg, body, self.flight_response(d_msg, body, l_lead))
+
+    def flight_response(self, d_msg, body, l_lead):
+        """
+        Return the decoded response of a coalesced call: the leader's own,
+        or (each waiter decoding its own copy of) the shared body.
+        """
+        if len(l_lead):
+            return l_lead[0]
+        self.metric_add('count', 'coalesced', 1)
+        return self.response_decode(body, d_msg)
+
+    def flight_checkAndConstruct(self, options):
+        """
+        Construct the coalescing of identical queries, across the runs 
+        using the --coalesceDir if specified (keeping a warm one of the 
+        same directory).
+
+        Return True/False accordingly
+        """
+
+        if not self.flight or self.flight.str_flightDir != options.str_coalesceDir:
+            self.flight = SingleFlight(flightDir = options.str_coalesceDir)
+        return len(options.str_coalesceDir) > 0
+
+    def cache_lookup(self, d_msg):
+        """
+        Return the (decoded) cached response to a message, or None.
+        """
+        if self.cache is None or not self.cache.isCacheable(d_msg):
+            return None
+        with self.metric_time('cache'):
+            body    = self.cache.get(d_msg)
+        if body is None:
+            return None
+        self.dp.qprint('Returning cached response for d_msg =\n %s' % self.df_print(d_msg))
+        if self.b_resultRaw:
+            self.resultBody = body
+        return self.response_compact(self.response_decode(body, d_msg), d_msg)
+
+    def response_accept(self, d_msg, body, d_response):
+        """
+        Cache and compact the (raw and decoded) response to a message.
+        """
+        if self.cache is not None and self.cache.isCacheable(d_msg) and \
+                d_response.get('status', True):
+            self.cache.put(d_msg, body)
+        if self.b_resultRaw:
+            self.resultBody = body
+        return self.response_compact(d_response, d_msg)
+
+    def response_compact(self, d_response, d_msg = None):
+        """
+        Replace the list of query hits in a decoded response by a compact
+        HitStore (leaving any other response, or one already decoded into
+        a HitStore, as is).
+
+        If the query message asked for 'returnKeys' and 'pfdcm' ignored 
+        them, the hits are trimmed to these tags here.
+        """
+        try:
+            l_data  = d_response['query']['data']
+        except (KeyError, TypeError):
+            return d_response
+        if isinstance(l_data, list) and all(isinstance(d_hit, dict) for d_hit in l_data):
+            l_keys  = (d_msg or {}).get('meta', {}).get('returnKeys', [])
+            with self.metric_time('compact'):
+                if len(l_keys) and any(len(d_hit.keys() - l_keys) for d_hit in l_data):
+                    self.metric_add('count', 'projectionFallback', 1)
+                    l_data  = [
+                        {key: d_hit[key] for key in l_keys if key in d_hit}
+                        for d_hit in l_data
+                    ]
+                d_response['query']['data'] = HitStore(l_data)
+        return d_response
+
+    def service_attempt(self, d_msg):
+        """
+        A single attempt at sending a message to 'pfdcm': return a tuple of
+        the raw response body and its decoded form.
+        """
+        with self.call_slot(d_msg):
+            with self.metric_time('network'):
+                body    = self.service_post(d_msg)
+        self.metric_add('count', 'requests', 1)
+        return body, self.response_decode(body, d_msg)
+
+    def call_slot(self, d_msg):
+        """
+        Return a context manager holding a scheduler slot for a call with
+        <d_msg> to its PACS service (a no-op if calls are not scheduled).
+        """
+        if not self.scheduler:
+            return contextlib.nullcontext()
+        return self.scheduler.slot(message_PACSservice(d_msg), self.str_priority)
+
+    def scheduler_checkAndConstruct(self, options, b_chunked):
+        """
+        Checks if user specified a --rateLimit or --maxInFlight, and if so,
+        construct the call scheduler (keeping a warm one of the same 
+        settings), and set the priority class of this run.
+
+        Return True/False accordingly
+        """
+
+        self.str_priority   = options.str_priority
+        if not len(self.str_priority):
+            b_single            = len(self.l_msg) <= 1 and len(self.l_PACSservice) <= 1
+            self.str_priority   = 'interactive' if b_single and not b_chunked else 'bulk'
+        if options.rateLimit <= 0 and options.maxInFlight <= 0:
+            self.scheduler  = None
+            return False
+        if not self.scheduler or                                        \
+                (self.scheduler.rate, self.scheduler.burst, self.scheduler.maxInFlight,
+                 self.scheduler.str_schedulerDir) !=                    \
+                (options.rateLimit, max(1, options.rateBurst), options.maxInFlight,
+                 options.str_schedulerDir):
+            self.scheduler  = QueryScheduler(
+                                    rate            = options.rateLimit,
+                                    burst           = options.rateBurst,
+                                    maxInFlight     = options.maxInFlight,
+                                    schedulerDir    = options.str_schedulerDir
+                                    )
+        return True
+
+    def response_decode(self, body, d_msg = None):
+        """
+        Decode a raw 'pfdcm' response body, recording its size. The hits
+        of a query response are decoded straight into a HitStore.
+        """
+        self.metric_add('count', 'responseBytes', len(body))
+        if not message_isQuery(d_msg):
+            with self.metric_time('decode'):
+                return json_loads(body)
+        with self.metric_time('decode'):
+            d_response, b_trimmed   = hits_decode(body, d_msg.get('meta', {}).get('returnKeys'))
+        if b_trimmed:
+            self.metric_add('count', 'projectionFallback', 1)
+        return d_response
+
+    def service_post(self, d_msg):
+        """
+        POST a message to 'pfdcm' and return the raw response body (bytes),
+        using the persistent session if there is one.
+        """
+
+        if self.session:
+            return self.session.post(d_msg)
+        else:
+            import pfurl
+
+            serviceCall = pfurl.Pfurl(
+                msg                     = json.dumps(d_msg),
+                http                    = self.str_pfdcm,
+                verb                    = 'POST',
+                b_raw                   = True,
+                b_quiet                 = self.b_pfurlQuiet,
+                b_httpResponseBodyParse = True,
+                jsonwrapper             = 'payload',
+                debugFile               = self.str_debugFile,
+                useDebug                = self.b_useDebug
+            )
+            return serviceCall().encode('utf-8')
+
+    def cache_checkAndConstruct(self, options):
+        """
+        Checks if user specified a query cache, and if so, construct it.
+
+        Return True/False accordingly
+        """
+
+        if len(options.str_cacheDir) and not self.cache:
+            self.cache  = QueryCache(
+                                cacheDir    = options.str_cacheDir,
+                                TTL         = options.cacheTTL,
+                                maxBytes    = options.cacheMaxBytes
+                                )
+        return self.cache is not None
+
+    def session_checkAndConstruct(self):
+        """
+        Checks if a persistent 'pfdcm' session is needed (an explicit
+        --poolSize, a multi-patient query, or a served job), and if so,
+        construct it.
+
+        Return True/False accordingly
+        """
+
+        if self.b_async and len(self.l_msg) > 1:
+            # Served by the AsyncPfdcmSession of async_call
+            return self.session is not None
+        poolSize    = self.poolSize
+        if self.b_resultRaw or self.b_serve:
+            # The raw body is only available from a session, not from pfurl,
+            # and a served job keeps the session warm for the next one
+            poolSize    = max(poolSize, 1)
+        if len(self.l_msg) > 1 or self.chunkDays > 0 or len(self.l_PACSservice) > 1:
+            poolSize    = max(poolSize, self.jobs * max(1, len(self.l_PACSservice)))
+        if poolSize > 0 and not self.session:
+            self.session    = PfdcmSession(
+                                    pfdcm       = self.str_pfdcm,
+                                    poolSize    = poolSize,
+                                    timeout     = self.retry.timeout or None
+                                    )
+        return self.session is not None
+
+    def retry_construct(self, options):
+        """
+        Construct the retry engine from the CLI timeout/retry settings.
+        """
+
+        self.retry  = RetryEngine(
+                            timeout         = options.timeout,
+                            deadline        = options.deadline,
+                            retries         = options.retries,
+                            backoff         = options.backoff,
+                            hedgePercentile = options.hedgePercentile
+                            )
+        return self.retry
+
+    def stats_report(self):
+        """
+        Log and record the session pool and cache counters in the output meta.
+        """
+
+        session = self.asyncSession if self.b_async and self.asyncSession else self.session
+        if session:
+            d_pool  = session.stats_get()
+            self.dp.qprint('pfdcm session: %d requests, %d pool hits, %d pool misses' %
+                            (d_pool['requests'], d_pool['hits'], d_pool['misses']))
+            self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, pool = d_pool)
+        if self.cache:
+            d_cache = self.cache.stats_get()
+            self.dp.qprint('query cache: %d hits, %d misses, %d evictions' %
+                            (d_cache['hits'], d_cache['misses'], d_cache['evictions']))
+            self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, cache = d_cache)
+        d_retry = self.retry.stats_get()
+        if d_retry['attempts']:
+            self.dp.qprint('pfdcm calls: %d attempts, %d retries, %d timeouts, %d hedges (%d won)' %
+                            (d_retry['attempts'], d_retry['retries'], d_retry['timeouts'],
+                             d_retry['hedges'], d_retry['hedgeWins']))
+            self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, retry = d_retry)
+        if self.scheduler:
+            d_scheduler = self.scheduler.stats_get()
+            for str_class, d_stats in d_scheduler.items():
+                self.dp.qprint('scheduler (%s): %d calls, %.3f s queue wait (max %.3f s), %.3f s service' %
+                                (str_class, d_stats['calls'], d_stats['queueWait'],
+                                 d_stats['queueWaitMax'], d_stats['serviceTime']))
+            self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, scheduler = d_scheduler)
+        if self.flight:
+            d_flight    = self.flight.stats_get()
+            if d_flight['coalesced'] or d_flight['crossProcess']:
+                self.dp.qprint('coalesced calls: %d in this run, %d across runs' %
+                                (d_flight['coalesced'], d_flight['crossProcess']))
+            self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, coalesce = d_flight)
+        self.OUTPUT_META_DICT   = dict(self.OUTPUT_META_DICT, metrics = self.d_metrics)
+
+    def metrics_save(self, options):
+        """
+        Save the output meta (metrics and counters) to the --metricsFile.
+        """
+
+        if len(options.str_metricsFile):
+            str_FQmetricsFile   = os.path.join(self.str_outputDir, options.str_metricsFile)
+            self.dp.qprint('Saving metrics to %s' % str_FQmetricsFile )
+            with open(str_FQmetricsFile, 'w') as f:
+                json.dump(self.OUTPUT_META_DICT, f, sort_keys = True, indent = 4)
+
+    def outputFile_measure(self, str_phase, str_file):
+        """
+        Record the size of a generated output file, and if compressed, its
+        uncompressed size and compression time.
+        """
+        if str_file in self.d_outputFile:
+            str_file, writer    = self.d_outputFile[str_file]
+            self.metric_add('count', '%sUncompressedBytes' % str_phase, writer.bytesIn)
+            self.metric_add('time', '%s.compress' % str_phase, writer.seconds)
+            self.dp.qprint('Compressed %s: %d to %d bytes in %.3f s' %
+                            (str_file, writer.bytesIn, writer.bytesOut, writer.seconds))
+        try:
+            self.metric_add('count', '%sBytes' % str_phase,
+                            os.path.getsize(os.path.join(self.str_outputDir, str_file)))
+        except OSError:
+            pass
+
+    def query_call(self, str_patientID, d_msg):
+        """
+        Perform the query for a single PatientID, returning only the hits
+        not seen in earlier runs if the query is incremental.
+        """
+
+        d_response  = self.hits_filter(self.PACS_call(d_msg))
+        if self.state:
+            d_response  = self.incremental_filter(str_patientID, d_response)
+        return d_response
+
+    def PACS_call(self, d_msg):
+        """
+        Send a query message to each of the PACS services concurrently, 
+        and merge their responses (see PACSresponses_merge). With a single
+        PACS service, this is simply a service_call.
+
+        With --PACSfirstComplete, the first successful response is used 
+        and the other PACS services are not waited for.
+        """
+
+        import concurrent.futures
+
+        if len(self.l_PACSservice) < 2:
+            return self.service_call(msg = d_msg)
+
+        d_future    = {}
+        for str_PACSservice in self.l_PACSservice:
+            d_PACSmsg                   = dict(d_msg, meta = dict(d_msg['meta']))
+            d_PACSmsg['meta']['PACS']   = str_PACSservice
+            d_future[thread_submit(lambda m = d_PACSmsg: self.service_call(msg = m))] = str_PACSservice
+
+        d_response  = {}
+        d_status    = {}
+        s_pending   = set(d_future)
+        while len(s_pending):
+            s_done, s_pending   = concurrent.futures.wait(
+                                        s_pending,
+                                        return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in s_done:
+                self.PACSresult_collect(d_future[future], future, d_response, d_status)
+            if self.b_PACSfirstComplete and \
+                    any(d['status'] for d in d_status.values()):
+                break
+        for future in s_pending:
+            d_status[d_future[future]]  = {'status': None, 'abandoned': True}
+        return self.PACSresponses_merge(d_response, d_status)
+
+    def PACSresult_collect(self, str_PACSservice, future, d_response, d_status):
+        """
+        Record the response (or failure) of a done <future> (or asyncio 
+        task) querying a PACS service in <d_response> and <d_status>.
+        """
+        try:
+            d_response[str_PACSservice] = future.result()
+            d_status[str_PACSservice]   = {
+                'status':   d_response[str_PACSservice].get('status', True)
+            }
+        except Exception as e:
+            d_status[str_PACSservice]   = {
+                'status':   False,
+                'error':    '%s: %s' % (type(e).__name__, e)
+            }
+            self.dp.qprint('Query of PACS %s failed: %s' %
+                            (str_PACSservice, d_status[str_PACSservice]['error']),
+                            comms = 'error')
+
+    def PACSresponses_merge(self, d_response, d_status):
+        """
+        Merge the responses of several PACS services to the same query, 
+        taken in --PACSservice order, into a single response (or raise if
+        none of them answered).
+
+        A hash index on (StudyInstanceUID, SeriesInstanceUID) drops the hits
+        already returned by another PACS; the (comma separated) PACS holding
+        each hit are recorded as its 'PACSservice' value.
+        """
+
+        if not len(d_response):
+            raise IOError('Query failed on all PACS services: %s' % 
+                            ', '.join('%s (%s)' % (k, d.get('error', '')) for k, d in d_status.items()))
+
+        d_index     = {}
+        l_source    = []
+        l_data      = HitStore()
+        for str_PACSservice in self.l_PACSservice:
+            if str_PACSservice not in d_response:
+                continue
+            try:
+                l_hits  = d_response[str_PACSservice]['query']['data']
+            except (KeyError, TypeError):
+                continue
+            if not isinstance(l_hits, (list, HitStore)):
+                continue
+            l_index     = []
+            for index, key in enumerate(zip(hits_column(l_hits, 'StudyInstanceUID'),
+                                            hits_column(l_hits, 'SeriesInstanceUID'))):
+                merged  = d_index.get(key) if any(key) else None
+                if merged is None:
+                    if any(key):
+                        d_index[key]    = len(l_source)
+                    l_source.append([str_PACSservice])
+                    l_index.append(index)
+                elif str_PACSservice not in l_source[merged]:
+                    l_source[merged].append(str_PACSservice)
+            d_status[str_PACSservice]['hits']   = len(l_index)
+            l_data.extend(hits_select(l_hits, l_index))
+        l_data.column_set('PACSservice', [','.join(l) for l in l_source])
+
+        b_status    = all(d['status'] is not False for d in d_status.values())
+        if self.b_PACSfirstComplete:
+            b_status    = any(d['status'] for d in d_status.values())
+        self.dp.qprint('Merged %d unique hits from PACS %s' % (len(l_data), ', '.join(d_response)))
+        return {
+            'status':   b_status,
+            'query': {
+                'status':   b_status,
+                'data':     l_data
+            },
+            'PACS':     d_status
+        }
+
+    def response_incomplete(self, d_response):
+        """
+        Return why <d_response> is not complete, or '' if it is: it must
+        have succeeded and, for a query of several PACS services, every one
+        of them must have answered (which --PACSfirstComplete does not wait
+        for).
+        """
+        d_PACS      = d_response.get('PACS', {})
+        l_failed    = [str_PACS for str_PACS, d in d_PACS.items() if not d['status']]
+        if len(l_failed) == 1:
+            return 'PACS %s failed' % l_failed[0]
+        if len(l_failed):
+            return '%d of %d PACS failed (%s)' % (len(l_failed), len(d_PACS), ', '.join(l_failed))
+        if not d_response.get('status', True):
+            return 'the query failed'
+        return ''
+
+    def incremental_filter(self, str_patientID, d_response, d_state = None):
+        """
+        Drop the hits in <d_response> already seen for <str_patientID>, and
+        update the persisted state with the new hits and latest StudyDate.
+        The state is only saved if the response is complete.
+
+        If a (pending) <d_state> is passed, it is updated but not saved: the
+        caller saves it once all the queries of the patient have succeeded.
+        """
+
+        b_save              = d_state is None
+        if b_save:
+            d_state         = self.state.get(str_patientID, self.str_PACSservice)
+        str_since           = d_state['lastStudyDate']
+        d_seen              = d_state['hits']
+        l_data              = d_response['query']['data']
+        l_index             = []
+        for index, (str_seriesUID, studyDate) in enumerate(zip(
+                                hits_column(l_data, 'SeriesInstanceUID'),
+                                hits_column(l_data, 'StudyDate'))):
+            if len(str_seriesUID):
+                if str_seriesUID in d_seen:
+                    continue
+                d_seen[str_seriesUID]   = l_data[index]
+            l_index.append(index)
+            str_date        = str(studyDate)
+            if len(str_date) == 8 and str_date.isdigit() and str_date > d_state['lastStudyDate']:
+                d_state['lastStudyDate']    = str_date
+
+        str_incomplete      = self.response_incomplete(d_response) if b_save else ''
+        if b_save and not len(str_incomplete):
+            self.state.put(d_state)
+        elif b_save:
+            self.dp.qprint('Not saving the incremental state of PatientID %s: %s' %
+                            (str_patientID, str_incomplete), comms = 'error')
+        l_new               = hits_select(l_data, l_index)
+        self.dp.qprint('Incremental query for PatientID %s since "%s": %d new of %d hits' %
+                        (str_patientID, str_since, len(l_new), len(l_data)))
+        d_response['query']['data'] = l_new
+        d_response['incremental']   = {
+            'since':        str_since,
+            'newHits':      len(l_new),
+            'knownHits':    len(d_seen)
+        }
+        return d_response
+
+    def index_checkAndConstruct(self, options):
+        """
+        Checks if user specified an --indexDB, and if so, open it.
+
+        Return True/False accordingly
+        """
+
+        if len(options.str_indexDB) and not self.index:
+            self.index  = HitIndex(indexDB = options.str_indexDB)
+        return self.index is not None
+
+    def index_lookup(self, options):
+        """
+        Look the hits of each PatientID up in the --indexDB, without any 
+        'pfdcm' query, and return them as a batch query would.
+        """
+
+        if not self.index_checkAndConstruct(options):
+            self.dp.qprint('--indexLookup requires an --indexDB', comms = 'error')
+            return {'status': False}
+
+        if self.filter_checkAndConstruct(options) is None:
+            return {'status': False}
+
+        self.l_patientID    = self.patientIDs_get(options)
+        d_batch             = {}
+        l_data              = HitStore()
+        with self.metric_time('lookup'):
+            for str_patientID in self.l_patientID:
+                l_hits  = self.index.get(str_patientID, options.str_lookupSeriesDescription)
+                if self.filter:
+                    l_hits  = hits_select(l_hits, self.filter.select(l_hits))
+                d_batch[str_patientID]  = {'status': True, 'hits': len(l_hits)}
+                l_data.extend(l_hits)
+        self.index.close()
+        self.dp.qprint('Index lookup of %d PatientID(s) returned %d hits' %
+                        (len(self.l_patientID), len(l_data)))
+        return {
+            'status':   True,
+            'query': {
+                'status':   True,
+                'data':     l_data
+            },
+            'batch':    d_batch
+        }
+
+    def state_checkAndConstruct(self, options):
+        """
+        Checks if user specified an --incremental query, and if so,
+        construct the query state store.
+
+        Return True/False accordingly
+        """
+
+        if options.b_incremental and not self.state:
+            if not len(options.str_stateDir):
+                self.dp.qprint('--incremental requires a --stateDir', comms = 'error')
+                return False
+            self.state  = QueryState(stateDir = options.str_stateDir)
+        return self.state is not None
+
+    def chunks_make(self, str_patientID, d_msg):
+        """
+        Return the list of chunks of a query message: one per --chunkDays
+        StudyDate window (clipped to any StudyDate range already in the
+        message) and --chunkModalities entry. An open start (None) gives
+        one more window, of all the studies before chunkStart.
+        """
+
+        start, end  = self.chunkRange
+        str_range   = d_msg['meta']['on'].get('StudyDate', '')
+        if len(str_range):
+            msgStart, msgEnd    = studyDateRange_parse(str_range, (start, end))
+            if msgStart is not None:
+                start   = msgStart if start is None else max(start, msgStart)
+            end     = min(end, msgEnd)
+
+        l_window    = []
+        windowStart = start
+        if start is None:
+            l_window.append((None, min(end, chunkStart - datetime.timedelta(days = 1))))
+            windowStart = chunkStart
+        while windowStart <= end:
+            windowEnd   = min(end, windowStart + datetime.timedelta(days = self.chunkDays - 1))
+            l_window.append((windowStart, windowEnd))
+            windowStart = windowEnd + datetime.timedelta(days = 1)
+
+        l_chunk     = []
+        for windowStart, windowEnd in l_window:
+            for str_modality in self.l_chunkModality or ['']:
+                l_chunk.append({
+                    'PatientID':    str_patientID,
+                    'msg':          d_msg,
+                    'start':        windowStart,
+                    'end':          windowEnd,
+                    'Modality':     str_modality
+                })
+        return l_chunk
+
+    def chunk_split(self, d_chunk):
+        """
+        Return the two halves of a chunk's StudyDate window.
+        """
+
+        start   = d_chunk['start'] or chunkFirst
+        mid     = start + (d_chunk['end'] - start) // 2
+        return [
+            dict(d_chunk, end   = mid),
+            dict(d_chunk, start = mid + datetime.timedelta(days = 1))
+        ]
+
+    def chunkStudyDate_get(self, d_chunk):
+        """
+        Return the StudyDate range of a chunk.
+        """
+
+        return '%s-%s' % (d_chunk['start'].strftime('%Y%m%d') if d_chunk['start'] else '',
+                          d_chunk['end'].strftime('%Y%m%d'))
+
+    def chunkMessage_construct(self, d_chunk):
+        """
+        Return the query message of a chunk.
+        """
+
+        d_msg           = json.loads(json.dumps(d_chunk['msg']))
+        d_on            = d_msg['meta']['on']
+        d_on['StudyDate']   = self.chunkStudyDate_get(d_chunk)
+        if len(d_chunk['Modality']):
+            d_on['Modality']    = d_chunk['Modality']
+        return d_msg
+
+    def chunk_checkAndConstruct(self, options):
+        """
+        Checks if user specified a chunked query, and if so, set up the
+        chunking parameters.
+
+        Return True/False accordingly, or None if the --chunkStudyDate is
+        not valid.
+        """
+
+        if options.chunkDays <= 0 or not len(self.l_msg):
+            return False
+        try:
+            self.chunkRange     = studyDateRange_parse(
+                                    options.str_chunkStudyDate,
+                                    (None, datetime.date.today()))
+        except ValueError as e:
+            self.dp.qprint('Invalid --chunkStudyDate: %s' % e, comms = 'error')
+            return None
+        self.chunkDays          = options.chunkDays
+        self.maxChunkHits       = options.maxChunkHits
+        self.l_chunkModality    = [str_modality.strip()
+                                    for str_modality in options.str_chunkModalities.split(',')
+                                    if len(str_modality.strip())]
+        if not len(self.l_chunkModality) and self.filter and len(self.filter.l_modality) > 1:
+            # Push the --Modality list down as one chunk per modality
+            self.l_chunkModality    = list(self.filter.l_modality)
+        return True
+
+    def chunked_call(self, *args, **kwargs):
+        """
+        Split each (patientID, d_msg) query job into chunks, dispatch the
+        chunks over a bounded worker pool, and stream the hits of each 
+        chunk to the output streams as it completes. A chunk returning 
+        more than --maxChunkHits hits is re-split (by halving its StudyDate
+        window) and re-queried.
+
+        Only the chunks in flight are held in memory: the returned structure
+        records the status of every chunk, and the total hit count, but not
+        the hits themselves.
+
+        An incremental state is only saved once every chunk of the patient
+        has succeeded: if one fails, its StudyDate window must not be 
+        skipped by the next run, so the state is left as it was.
+        """
+
+        import concurrent.futures
+
+        l_job       = []
+        jobs        = 1
+        d_stream    = {}
+        for k, v in kwargs.items():
+            if k == 'jobList':  l_job       = v
+            if k == 'jobs':     jobs        = v
+            if k == 'streams':  d_stream    = v
+
+        l_chunk     = []
+        for str_patientID, d_msg in l_job:
+            l_chunk.extend(self.chunks_make(str_patientID, d_msg))
+        self.dp.qprint('Dispatching %d query chunks over %d worker(s)' % (len(l_chunk), jobs))
+
+        hits        = 0
+        l_status    = []
+        d_batch     = {str_patientID: {'status': True, 'hits': 0} for str_patientID, d_msg in l_job}
+        # The pending incremental state, and the chunks left, of each patient
+        d_state     = {}
+        d_chunks    = {str_patientID: 0 for str_patientID, d_msg in l_job}
+        # Why the state of a patient is not to be saved
+        d_incomplete= {}
+        for d_chunk in l_chunk:
+            d_chunks[d_chunk['PatientID']]     += 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, jobs)) as pool:
+            d_pending   = {
+                pool.submit(self.PACS_call, self.chunkMessage_construct(d_chunk)): d_chunk
+                for d_chunk in l_chunk
+            }
+            while len(d_pending):
+                s_done, s_running   = concurrent.futures.wait(
+                                        d_pending,
+                                        return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in s_done:
+                    d_chunk         = d_pending.pop(future)
+                    str_patientID   = d_chunk['PatientID']
+                    d_chunks[str_patientID]    -= 1
+                    d_status        = {
+                        'PatientID':    str_patientID,
+                        'StudyDate':    self.chunkStudyDate_get(d_chunk),
+                        'Modality':     d_chunk['Modality'],
+                        'status':       True
+                    }
+                    l_status.append(d_status)
+                    try:
+                        d_response  = future.result()
+                        l_data      = d_response['query']['data']
+                    except Exception as e:
+                        d_status['status']              = False
+                        d_status['error']               = '%s: %s' % (type(e).__name__, e)
+                        d_batch[str_patientID]['status']= False
+                        self.dp.qprint('Query chunk %s failed: %s' % (d_status, d_status['error']),
+                                        comms = 'error')
+                        d_incomplete.setdefault(str_patientID, set()).add(
+                                            'query chunk %s failed' % d_status['StudyDate'])
+                        self.chunkState_save(str_patientID, d_state, d_chunks, d_incomplete)
+                        continue
+
+                    if self.maxChunkHits > 0 and len(l_data) > self.maxChunkHits and \
+                            d_chunk['end'] > (d_chunk['start'] or chunkFirst):
+                        d_status['split']   = True
+                        for d_half in self.chunk_split(d_chunk):
+                            d_chunks[str_patientID]    += 1
+                            d_pending[pool.submit(
+                                        self.PACS_call,
+                                        self.chunkMessage_construct(d_half))] = d_half
+                        continue
+
+                    l_data      = self.hits_filter(d_response)['query']['data']
+                    if self.state:
+                        str_incomplete  = self.response_incomplete(d_response)
+                        if len(str_incomplete):
+                            d_incomplete.setdefault(str_patientID, set()).add(
+                                            'query chunk %s: %s' % (d_status['StudyDate'], str_incomplete))
+                        if str_patientID not in d_state:
+                            d_state[str_patientID]  = self.state.get(str_patientID, self.str_PACSservice)
+                        l_data      = self.incremental_filter(
+                                            str_patientID, d_response, d_state[str_patientID]
+                                            )['query']['data']
+                    d_status['hits']                = len(l_data)
+                    d_batch[str_patientID]['hits'] += len(l_data)
+                    hits                           += len(l_data)
+                    self.outputStreams_write(d_stream, l_data)
+                    self.chunkState_save(str_patientID, d_state, d_chunks, d_incomplete)
+                    del d_response, l_data
+
+        b_status    = all(d['status'] for d in d_batch.values())
+        d_ret       = {
+            'status':   b_status,
+            'query': {
+                'status':   b_status,
+                'hits':     hits
+            },
+            'chunks':   l_status
+        }
+        if len(l_job) > 1:
+            d_ret['batch']  = d_batch
+        return d_ret
+
+    def chunkState_save(self, str_patientID, d_state, d_chunks, d_incomplete):
+        """
+        Save the pending incremental state of a patient once all its chunks
+        are done, unless any of them failed (or was incomplete).
+        """
+        if d_chunks[str_patientID] or str_patientID not in d_state:
+            return
+        d_patientState  = d_state.pop(str_patientID)
+        if str_patientID in d_incomplete:
+            self.dp.qprint('Not saving the incremental state of PatientID %s: %s' %
+                            (str_patientID, '; '.join(sorted(d_incomplete[str_patientID]))),
+                            comms = 'error')
+        else:
+            self.state.put(d_patientState)
+
+    def batch_call(self, *args, **kwargs):
+        """
+        Dispatch a list of (patientID, d_msg) query jobs over a bounded
+        worker pool, and merge all the returned hits into a single
+        structure that mirrors a single query response.
+
+        Per-patient status is recorded in the 'batch' field of the return.
+        """
+
+        l_job   = []
+        jobs    = 1
+        for k, v in kwargs.items():
+            if k == 'jobList':  l_job   = v
+            if k == 'jobs':     jobs    = v
+
+        def job_run(job):
+            str_patientID, d_msg = job
+            try:
+                return self.job_result(self.query_call(str_patientID, d_msg))
+            except Exception as e:
+                return self.job_result(None, e)
+
+        self.dp.qprint('Dispatching %d queries over %d worker(s)' % (len(l_job), jobs))
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, jobs)) as pool:
+            l_result    = list(pool.map(job_run, l_job))
+        return self.batch_merge(l_job, l_result)
+
+    def async_call(self, *args, **kwargs):
+        """
+        The asyncio form of batch_call: dispatch a list of (patientID, d_msg)
+        query jobs from a single event loop, with up to <jobs> of them 
+        outstanding at once, and merge all the returned hits.
+        """
+        import asyncio
+
+        l_job   = []
+        jobs    = 1
+        for k, v in kwargs.items():
+            if k == 'jobList':  l_job   = v
+            if k == 'jobs':     jobs    = v
+
+        async def batch_run():
+            semaphore           = asyncio.Semaphore(max(1, jobs))
+            self.asyncSession   = AsyncPfdcmSession(
+                                        pfdcm       = self.str_pfdcm,
+                                        poolSize    = max(1, jobs) * max(1, len(self.l_PACSservice))
+                                        )
+
+            async def job_run(job):
+                str_patientID, d_msg = job
+                async with semaphore:
+                    try:
+                        return self.job_result(await self.query_acall(str_patientID, d_msg))
+                    except Exception as e:
+                        return self.job_result(None, e)
+
+            try:
+                return await asyncio.gather(*[job_run(job) for job in l_job])
+            finally:
+                self.asyncSession.close()
+
+        self.dp.qprint('Dispatching %d queries with up to %d outstanding (asyncio)' %
+                        (len(l_job), jobs))
+        return self.batch_merge(l_job, asyncio.run(batch_run()))
+
+    async def query_acall(self, str_patientID, d_msg):
+        """
+        The asyncio form of query_call.
+        """
+
+        d_response  = self.hits_filter(await self.PACS_acall(d_msg))
+        if self.state:
+            d_response  = self.incremental_filter(str_patientID, d_response)
+        return d_response
+
+    async def PACS_acall(self, d_msg):
+        """
+        The asyncio form of PACS_call.
+        """
+        import asyncio
+
+        if len(self.l_PACSservice) < 2:
+            return await self.service_acall(d_msg)
+
+        d_task      = {}
+        for str_PACSservice in self.l_PACSservice:
+            d_PACSmsg                   = dict(d_msg, meta = dict(d_msg['meta']))
+            d_PACSmsg['meta']['PACS']   = str_PACSservice
+            d_task[asyncio.ensure_future(self.service_acall(d_PACSmsg))] = str_PACSservice
+
+        d_response  = {}
+        d_status    = {}
+        s_pending   = set(d_task)
+        while len(s_pending):
+            s_done, s_pending   = await asyncio.wait(
+                                        s_pending,
+                                        return_when = asyncio.FIRST_COMPLETED)
+            for task in s_done:
+                self.PACSresult_collect(d_task[task], task, d_response, d_status)
+            if self.b_PACSfirstComplete and \
+                    any(d['status'] for d in d_status.values()):
+                break
+        for task in s_pending:
+            task.cancel()
+            d_status[d_task[task]]  = {'status': None, 'abandoned': True}
+        return self.PACSresponses_merge(d_response, d_status)
 
-    # Fill out this with key-value output descriptive info (such as an output file path
-    # relative to the output dir) that you want to save to the output meta file when
-    # called with the --saveoutputmeta flag
-    OUTPUT_META_DICT = {}
+    async def service_acall(self, d_msg):
+        """
+        The asyncio form of service_call, over the AsyncPfdcmSession.
+        """
 
-    def __init__(self, *args, **kwargs):
-        ChrisApp.__init__(self, *args, **kwargs)
+        d_response  = self.cache_lookup(d_msg)
+        if d_response is not None:
+            return d_response
 
-        self.__name__           = 'PacsQueryApp'
+        self.dp.qprint('Sending d_msg =\n %s' % self.df_print(d_msg))
+        if not self.flight or not message_isQuery(d_msg):
+            body, d_response    = await self.retry.acall(
+                                        lambda: self.service_aattempt(d_msg),
+                                        b_idempotent = message_isQuery(d_msg))
+            return self.response_accept(d_msg, body, d_response)
 
-        # Debugging control
-        self.b_useDebug         = False
-        self.str_debugFile      = '/dev/null'
-        self.b_quiet            = True
-        self.dp                 = pfmisc.debug(    
-                                            verbosity   = 0,
-                                            level       = -1,
-                                            within      = self.__name__
-                                            )
-        self.pp                 = pprint.PrettyPrinter(indent=4)
+        l_lead  = []
+        async def lead():
+            body, d_response    = await self.retry.acall(
+                                        lambda: self.service_aattempt(d_msg),
+                                        b_idempotent = True)
+            l_lead.append(d_response)
+            return body
+        body    = await self.flight.acall(message_key(d_msg), lead)
+        return self.response_accept(d_msg, body, self.flight_response(d_msg, body, l_lead))
 
-        # Output dir
-        self.str_outputDir      = ''
+    async def service_aattempt(self, d_msg):
+        """
+        The asyncio form of service_attempt.
+        """
+        if self.scheduler:
+            async with self.scheduler.aslot(message_PACSservice(d_msg), self.str_priority):
+                with self.metric_time('network'):
+                    body    = await self.asyncSession.post(d_msg)
+        else:
+            with self.metric_time('network'):
+                body    = await self.asyncSession.post(d_msg)
+        self.metric_add('count', 'requests', 1)
+        return body, self.response_decode(body, d_msg)
 
-        # Service and payload vars
-        self.str_pfdcm          = ''
-        self.str_msg            = ''
-        self.d_msg              = {}
+    def job_result(self, d_response, e = None):
+        """
+        Return the result of one batch query job: its status and hits (and
+        per-PACS status) from its <d_response>, or the error <e> it raised.
+        """
+        if e is not None:
+            return {
+                'status':   False,
+                'hits':     0,
+                'data':     [],
+                'error':    '%s: %s' % (type(e).__name__, e)
+            }
+        l_data      = d_response['query']['data']
+        d_result    = {
+            'status':   d_response.get('status', True),
+            'hits':     len(l_data),
+            'data':     l_data
+        }
+        if 'PACS' in d_response:
+            d_result['PACS']    = d_response['PACS']
+        return d_result
 
-        # Alternate, simplified CLI flags
-        self.str_patientID      = ''
-        self.str_PACSservice    = ''
+    def batch_merge(self, l_job, l_result):
+        """
+        Merge the results of a list of batch query jobs into a single 
+        structure that mirrors a single query response.
+        """
 
-        # Control
-        self.b_canRun           = False
+        d_batch         = {}
+        l_data          = HitStore()
+        for (str_patientID, d_msg), d_result in zip(l_job, l_result):
+            l_data.extend(d_result.pop('data'))
+            d_batch[str_patientID]  = d_result
+            if not d_result['status']:
+                self.dp.qprint('Query for PatientID %s failed: %s' % 
+                                (str_patientID, d_result.get('error', d_result.get('PACS'))),
+                                comms = 'error')
 
-        # Summary report
-        self.b_summaryReport    = False
-        self.str_summaryKeys    = ''
-        self.l_summaryKeys      = []
-        self.str_summaryFile    = ''
+        b_status        = all(d['status'] for d in d_batch.values())
+        return {
+            'status':   b_status,
+            'query': {
+                'status':   b_status,
+                'data':     l_data
+            },
+            'batch':    d_batch
+        }
 
-        # Result report
-        self.str_resultFile     = ''
-       
-    def define_parameters(self):
+    def serve(self, options):
         """
-        Define the CLI arguments accepted by this plugin app.
+        Serve query jobs, one JSON job per line, from the Unix socket (one
+        job per connection) or stdin ('-') named by --serve, until a 
+        {"shutdown": true} job or the end of stdin.
+
+        This process (and its parsers, 'pfdcm' session and cache) stays 
+        warm across jobs; see job_run.
         """
 
-        # The space of input parameters is very straightforward
-        #   1. The IP:port of the pfdcm service
-        #   2. A 'msg' type string / dictionary to send to the service.
+        str_serve   = options.str_serve
+        f_reply     = sys.stdout
+        self.b_serve    = True
+        self.dp.qprint('Serving query jobs on %s' % ('stdin' if str_serve == '-' else str_serve))
+        if str_serve == '-':
+            for str_line in sys.stdin:
+                if not len(str_line.strip()):
+                    continue
+                reply   = self.job_run(str_line)
+                if reply is None:
+                    break
+                f_reply.write(reply.decode('utf-8'))
+                f_reply.flush()
+            return {'status': True}
 
-        # PACS settings
-        self.add_argument(
-            '--pfdcm',
-            dest        = 'str_pfdcm',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'The PACS Q/R intermediary service IP:port.')
-        self.add_argument(
-            '--msg',
-            dest        = 'str_msg',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'The actual complete JSON message to send to the Q/R intermediary service.')
-        self.add_argument(
-            '--PatientID',
-            dest        = 'str_patientID',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'The PatientID to query.')
-        self.add_argument(
-            '--PACSservice',
-            dest        = 'str_PACSservice',
-            type        = str,
-            default     = 'orthanc',
-            optional    = True,
-            help        = 'The PACS service to use. Note this a key to a lookup in "pfdcm".')
-        self.add_argument(
-            '--summaryKeys',
-            dest        = 'str_summaryKeys',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'If specified, generate a summary report based on a comma separated key list.')
-        self.add_argument(
-            '--summaryFile',
-            dest        = 'str_summaryFile',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'If specified, save (overwrite) a summary report to passed file (in outputdir).')
-        self.add_argument(
-            '--numberOfHitsFile',
-            dest        = 'str_numberOfHitsFile',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'If specified, save (overwrite) the number of hits (in outputdir).')
-        self.add_argument(
-            '--resultFile',
-            dest        = 'str_resultFile',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'If specified, save (overwrite) all the hits to the passed file (in outputdir).')
-        self.add_argument(
-            '--man',
-            dest        = 'str_man',
-            type        = str,
-            default     = '',
-            optional    = True,
-            help        = 'If specified, print help on the passed key entry. Use "entries" for all key list')
-        self.add_argument(
-            '--pfurlQuiet',
-            dest        = 'b_pfurlQuiet',
-            type        = bool,
-            default     = False,
-            action      = 'store_true',
-            optional    = True,
-            help        = 'Silence pfurl noise.'),
-        self.add_argument(
-            '--version',
-            dest        = 'b_version',
-            type        = bool,
-            default     = False,
-            action      = 'store_true',
-            optional    = True,
-            help        = 'Show .')
+        import stat
+        import socket
 
-    def df_print(self, adict):
+        # Only replace a stale socket, never any other file
+        if os.path.lexists(str_serve):
+            if not stat.S_ISSOCK(os.lstat(str_serve).st_mode):
+                self.dp.qprint('--serve %s exists and is not a socket' % str_serve, comms = 'error')
+                return {'status': False}
+            os.unlink(str_serve)
+        sock    = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Created owner-only, and made so again should the umask be ignored
+        umask   = os.umask(0o177)
+        try:
+            sock.bind(str_serve)
+        finally:
+            os.umask(umask)
+        os.chmod(str_serve, 0o600)
+        sock.listen(16)
+        try:
+            while True:
+                conn, address   = sock.accept()
+                with conn:
+                    f       = conn.makefile('rwb')
+                    reply   = self.job_run(f.readline())
+                    if reply is None:
+                        break
+                    try:
+                        f.write(reply)
+                        f.flush()
+                    except OSError:
+                        pass
+        finally:
+            sock.close()
+            os.unlink(str_serve)
+        return {'status': True}
+
+    def job_argv(self, d_job):
         """
-        Return a nicely formatted string representation of a dictionary
+        Return the command line of a job: either its "args" list, or its
+        flags (as a JSON object) and "outputdir".
         """
-        return self.pp.pformat(adict).strip()
 
-    def service_call(self, *args, **kwargs):
+        if 'args' in d_job:
+            l_argv  = [str(arg) for arg in d_job['args']]
+        else:
+            l_argv  = []
+            for k, v in d_job.items():
+                if k in ('cwd', 'outputdir') or v is None or v is False:
+                    continue
+                l_argv.append('--%s' % k)
+                if v is not True:
+                    l_argv.append(','.join(str(x) for x in v) if isinstance(v, list) else str(v))
+            l_argv.append(str(d_job.get('outputdir', '')))
+        for str_arg in l_argv:
+            if str_arg.split('=')[0] in ('--serve', '--submit'):
+                raise ValueError('a job cannot %s' % str_arg.split('=')[0])
+        return l_argv
 
-        d_msg   = {}
-        for k, v in kwargs.items():
-            if k == 'msg':  d_msg   = v
+    def job_reset(self, options):
+        """
+        Reset the per-run state before running a served job, keeping the 
+        warm 'pfdcm' session, cache and incremental state only if the job
+        uses the same ones. A kept cache takes the TTL and size limit of 
+        the job.
+        """
 
-        serviceCall = pfurl.Pfurl(
-            msg                     = json.dumps(d_msg),
-            http                    = self.str_pfdcm,
-            verb                    = 'POST',
-            b_raw                   = True,
-            b_quiet                 = self.b_pfurlQuiet,
-            b_httpResponseBodyParse = True,
-            jsonwrapper             = 'payload',
-            debugFile               = self.str_debugFile,
-            useDebug                = self.b_useDebug
-        )
-        
-        self.dp.qprint('Sending d_msg =\n %s' % self.df_print(d_msg))
-        d_response      = json.loads(serviceCall())
-        return d_response
+        self.b_canRun       = False
+        self.OUTPUT_META_DICT   = {}
+        self.str_msg        = ''
+        self.d_msg          = {}
+        self.l_msg          = []
+        self.l_patientID    = []
+        self.l_PACSservice  = []
+        self.l_returnKeys   = []
+        self.chunkDays      = 0
+        self.resultBody     = None
+        self.d_outputFile   = {}
+        self.index          = None
+        self.filter         = None
+        self.studyIndex     = None
+        self.asyncSession   = None
+        if self.session and (self.session.str_pfdcm != options.str_pfdcm or
+                             self.session.timeout != (options.timeout or None)):
+            self.session    = None
+        if self.cache and self.cache.str_cacheDir != options.str_cacheDir:
+            self.cache      = None
+        elif self.cache:
+            self.cache.TTL          = options.cacheTTL
+            self.cache.maxBytes     = options.cacheMaxBytes
+            self.cache.evict()
+        if self.state and (not options.b_incremental or 
+                           self.state.str_stateDir != options.str_stateDir):
+            self.state      = None
+
+    def job_run(self, str_line):
+        """
+        Run one served (JSON) job line, returning the (JSON) reply line, or
+        None on a shutdown job. The log goes to stderr.
+        """
+
+        startTime   = time.perf_counter()
+        str_cwd     = os.getcwd()
+        d_reply     = {'status': False}
+        try:
+            d_job   = json.loads(str_line)
+            if d_job.get('shutdown'):
+                return None
+            os.chdir(d_job.get('cwd', str_cwd))
+            with contextlib.redirect_stdout(sys.stderr):
+                options = self.parse_args(self.job_argv(d_job))
+                self.job_reset(options)
+                d_ret   = self.run(options)
+                if options.saveoutputmeta:
+                    self.save_output_meta()
+            str_outputDir   = os.path.abspath(options.outputdir)
+            d_reply = {
+                'status':       bool(d_ret.get('status')),
+                'hits':         self.d_metrics['count'].get('hits', 0),
+                'outputdir':    str_outputDir,
+                'files':        sorted(os.listdir(str_outputDir))
+            }
+        except SystemExit:
+            d_reply['error']    = 'invalid job arguments'
+        except Exception as e:
+            d_reply['error']    = '%s: %s' % (type(e).__name__, e)
+        finally:
+            os.chdir(str_cwd)
+        d_reply['seconds']  = time.perf_counter() - startTime
+        return (json.dumps(d_reply) + '\n').encode('utf-8')
 
     def man_get(self):
         """
         return a simple man/usage paragraph.
         """
 
-        d_ret = {
-            "man":  str_name + str_synposis + str_description + str_results + str_args,
-            "synopsis":     str_synposis,
-            "description":  str_description,
-            "results":      str_results,
-            "args":         str_args,
-            "overview": """
-            """,
-            "callingSyntax1": """
-                python3 pacsquery.py --pfdcm ${HOST_IP}:5015 --msg \
-                '{  
-                    "action": "PACSinteract",
-                    "meta": 
-                        {
-                            "do":  "query",
-                            "on" : 
-                            {
-                                "PatientID": "LILLA-9731"
-                            },
-                            "PACS" : "orthanc"
-                        }
-                }' /tmp
-            """,
-            "callingSyntax2": """
-                python3 pacsquery.py    --pfdcm ${HOST_IP}:5015         \\
-                                        --PatientID LILLA-9731          \\
-                                        --PACSservice orthanc
-            """,
-            "callingSyntax3": """
-                python3 pacsquery.py    --pfdcm ${HOST_IP}:5015         \\
-                                        --PatientID LILLA-9731          \\
-                                        --PACSservice orthanc           \\
-                                        --pfurlQuiet                    \\
-                                        --summaryKeys "PatientID,PatientAge,StudyDescription,StudyInstanceUID,SeriesDescription,SeriesInstanceUID,NumberOfSeriesRelatedInstances" \\
-                                        --summaryFile summary.txt       \\
-                                        --resultFile results.json       \\
-                                        --numberOfHitsFile hits.txt     \\
-                                        /tmp
-            """
-        }
-
-        return d_ret
+        return man_get()
 
     def numberOfHitsReport_process(self, *args, **kwargs):
         """
-        Save number of hits
+        Save number of hits (a bare integer), and/or the number of hits, 
+        studies and series (one per line)
         """
         str_hitsFile    = ''
+        str_countsFile  = ''
         hits            = 0
+        studies         = 0
+        series          = 0
         for k,v in kwargs.items():
             if k == 'hitsFile':     str_hitsFile    = v
+            if k == 'countsFile':   str_countsFile  = v
             if k == 'hits':         hits            = v
+            if k == 'studies':      studies         = v
+            if k == 'series':       series          = v
 
         if len(str_hitsFile):
             str_FQhitsFile    = os.path.join(self.str_outputDir, str_hitsFile)
@@ -387,6 +4547,13 @@ class PacsQueryApp(ChrisApp):
             f.write('%d' % hits)
             f.close()
 
+        if len(str_countsFile):
+            str_FQcountsFile  = os.path.join(self.str_outputDir, str_countsFile)
+            self.dp.qprint('Saving number of hits, studies and series to %s' % str_FQcountsFile)
+            f = open(str_FQcountsFile, 'w')
+            f.write('%d hits\n%d studies\n%d series\n' % (hits, studies, series))
+            f.close()
+
     def dataReport_process(self, *args, **kwargs):
         """
         Process data report based on the return from the query.
@@ -396,47 +4563,28 @@ class PacsQueryApp(ChrisApp):
         for k,v in kwargs.items():
             if k == 'resultFile':   self.str_resultFile     = v
             if k == 'results':      d_results               = v
+            if k == 'resultFormat': self.str_resultFormat   = v
+            if k == 'sortKeys':     self.b_resultSortKeys   = v
+            if k == 'indent':       self.resultIndent       = v
 
         if len(self.str_resultFile):
             str_FQresultFile    = os.path.join(self.str_outputDir, self.str_resultFile)
             self.dp.qprint('Saving data results to %s' % str_FQresultFile )
-            f = open(str_FQresultFile, 'w')
-            js_results  = json.dumps(d_results, sort_keys = True, indent = 4)
-            f.write('%s' % js_results)
-            f.close()
-
-    def summaryReport_process(self, *args, **kwargs):
-        """
-        Generate a summary report based on CLI specs
-        """
-
-        l_data                  = []
-        self.str_summaryKeys    = ''
-        for k,v in kwargs.items():
-            if k == 'summaryKeys':  self.str_summaryKeys    = v
-            if k == 'summaryFile':  self.str_summaryFile    = v
-            if k == 'data':         l_data                  = v
-        
-        str_report      = ''
-        l_summaryKeys   = self.str_summaryKeys.split(',')
-
-        if len(l_data):
-            # Header
-            for key in l_summaryKeys:
-                str_report  = str_report + "%-60s\t" % key
-
-            # Body
-            for entry in l_data:
-                str_report  = str_report + "\n"
-                for key in l_summaryKeys:
-                    str_report  = str_report + "%-60s\t" % (entry[key]['value'])
-
-        if len(self.str_summaryFile):
-            str_FQsummaryFile   = os.path.join(self.str_outputDir, self.str_summaryFile) 
-            self.dp.qprint('Saving summary to %s' % str_FQsummaryFile )
-            f = open(str_FQsummaryFile, 'w')
-            f.write(str_report)
-            f.close()
+            f   = self.outputFile_open(self.str_resultFile)
+            if self.str_resultFormat == 'json' and                              \
+                    not isinstance(d_results.get('query', {}).get('data', []), (list, HitStore)):
+                json.dump(  d_results, f,
+                            sort_keys   = self.b_resultSortKeys,
+                            indent      = self.resultIndent)
+                f.close()
+            else:
+                stream  = ResultStream( f,
+                                        format      = self.str_resultFormat,
+                                        sortKeys    = self.b_resultSortKeys,
+                                        indent      = self.resultIndent,
+                                        results     = d_results)
+                stream.write(d_results.get('query', {}).get('data', []))
+                stream.close(d_results)
 
     def manPage_checkAndShow(self, options):
         """
@@ -448,12 +4596,7 @@ class PacsQueryApp(ChrisApp):
         ret = False
         if len(options.str_man):
             ret = True
-            d_man = self.man_get()
-            if options.str_man in d_man:
-                str_help    = d_man[options.str_man]
-                print(str_help)
-            if options.str_man == 'entries':
-                print(d_man.keys())
+            manPage_show(options.str_man)
 
         return ret
 
@@ -476,80 +4619,449 @@ class PacsQueryApp(ChrisApp):
                 self.b_canRun   = False
         return ret
 
+    def filter_checkAndConstruct(self, options):
+        """
+        Checks if user specified any --Modality, --StudyDate or 
+        --SeriesDescription criteria, and if so, compile the hit filter.
+
+        Return True/False accordingly, or None if the criteria are not valid.
+        """
+
+        self.filter = None
+        try:
+            hitFilter   = HitFilter(
+                                modality            = options.str_modality.split(','),
+                                studyDate           = options.str_studyDate,
+                                seriesDescription   = options.str_seriesDescription
+                                )
+        except Exception as e:
+            self.dp.qprint('Invalid query criteria: %s' % e, comms = 'error')
+            return None
+        if hitFilter:
+            self.filter = hitFilter
+        return self.filter is not None
+
+    def hits_filter(self, d_response):
+        """
+        Drop the hits of a (decoded) response that do not meet the query
+        criteria, in place, and return the response.
+        """
+        if not self.filter:
+            return d_response
+        try:
+            l_data  = d_response['query']['data']
+        except (KeyError, TypeError):
+            return d_response
+        if not isinstance(l_data, (list, HitStore)):
+            return d_response
+        with self.metric_time('filter'):
+            l_index = self.filter.select(l_data)
+            if len(l_index) < len(l_data):
+                self.metric_add('count', 'filtered', len(l_data) - len(l_index))
+                d_response['query']['data'] = hits_select(l_data, l_index)
+        return d_response
+
+    def patientIDs_get(self, options):
+        """
+        Return the list of PatientIDs to query, collected from the (comma
+        separated) --PatientID and the --PatientIDFile. Duplicates are
+        dropped, preserving order.
+        """
+
+        l_patientID = options.str_patientID.split(',')
+        if len(options.str_patientIDFile):
+            with open(options.str_patientIDFile) as f:
+                for str_line in f:
+                    if not str_line.strip().startswith('#'):
+                        l_patientID.append(str_line)
+
+        l_ret       = []
+        s_seen      = set()
+        for str_patientID in l_patientID:
+            str_patientID   = str_patientID.strip()
+            if len(str_patientID) and str_patientID not in s_seen:
+                s_seen.add(str_patientID)
+                l_ret.append(str_patientID)
+        return l_ret
+
+    def returnKeys_get(self, options):
+        """
+        Return the list of tags to ask 'pfdcm' to return for each hit, or
+        an empty list for all of them.
+
+        Unless explicitly given, only the summary keys are asked for when
+        no full result file is to be written.
+        """
+
+        str_returnKeys  = options.str_returnKeys.strip()
+        if str_returnKeys == '*':
+            return []
+        if not len(str_returnKeys):
+            if len(options.str_resultFile) or len(options.str_mergedResultFile) or \
+                    len(options.str_indexDB) or \
+                    not len(options.str_summaryKeys) or not len(options.str_summaryFile):
+                return []
+            str_returnKeys  = options.str_summaryKeys
+
+        l_returnKeys    = []
+        # The study and series counts need the UIDs of each hit
+        l_required      = ['StudyInstanceUID', 'SeriesInstanceUID']
+        if self.state:
+            l_required     += ['StudyDate']
+        if len(options.str_studySummaryFile):
+            l_required     += StudyIndex.l_hitTags
+        if self.filter:
+            l_required     += self.filter.tags_get()
+        for key in str_returnKeys.split(',') + l_required:
+            key = key.strip()
+            # The PACSservice of a hit is recorded here, not by 'pfdcm'
+            if len(key) and key not in l_returnKeys and key != 'PACSservice':
+                l_returnKeys.append(key)
+        return l_returnKeys
+
+    def queryMessage_construct(self, str_patientID, str_PACSservice):
+        """
+        Return a 'pfdcm' query message for a single PatientID.
+        """
+
+        d_msg   = {
+            'action':   'PACSinteract',
+            'meta': {
+                'do':   'query',
+                'on': {
+                    'PatientID': str_patientID
+                },
+                "PACS": str_PACSservice.split(',')[0]
+            }
+        }
+        d_on    = d_msg['meta']['on']
+        if self.filter:
+            d_on.update(self.filter.on_get())
+        if self.state:
+            # Only ask for studies on or after the latest one already seen
+            str_since   = self.state.get(str_patientID, str_PACSservice)['lastStudyDate']
+            if len(str_since):
+                str_start, str_sep, str_end = d_on.get('StudyDate', '-').partition('-')
+                d_on['StudyDate']   = '%s-%s' % (max(str_start, str_since), str_end)
+        if len(self.l_returnKeys):
+            d_msg['meta']['returnKeys'] = list(self.l_returnKeys)
+        return d_msg
+
     def queryMessage_checkAndConstruct(self, options):
         """
         Checks if user specified a query from a pattern of command line flags,
-        and if so, construct the message.
+        and if so, construct the message(s).
 
         Return True/False accordingly
         """
 
-        if len(options.str_patientID) and len(options.str_PACSservice):
-            self.str_patientID      = options.str_patientID
-            self.str_PACSservice    = options.str_PACSservice
-            self.d_msg  = {
-                'action':   'PACSinteract',
-                'meta': {
-                    'do':   'query',
-                    'on': {
-                        'PatientID': self.str_patientID
-                    },
-                    "PACS": self.str_PACSservice
-                }
-            }
+        self.l_patientID    = self.patientIDs_get(options)
+        self.l_PACSservice  = []
+        for str_PACSservice in options.str_PACSservice.split(','):
+            str_PACSservice = str_PACSservice.strip()
+            if len(str_PACSservice) and str_PACSservice not in self.l_PACSservice:
+                self.l_PACSservice.append(str_PACSservice)
+        if len(self.l_patientID) and len(self.l_PACSservice):
+            self.str_patientID      = self.l_patientID[0]
+            # The incremental state is kept per PatientID and set of PACS
+            self.str_PACSservice    = ','.join(self.l_PACSservice)
+            self.b_PACSfirstComplete= options.b_PACSfirstComplete
+            self.l_returnKeys       = self.returnKeys_get(options)
+            self.l_msg  = [
+                (str_patientID, self.queryMessage_construct(str_patientID, self.str_PACSservice))
+                for str_patientID in self.l_patientID
+            ]
+            self.d_msg      = self.l_msg[0][1]
             self.b_canRun   = True
 
-    def outputFiles_generate(self, options, hits, d_ret, l_data):
+    def outputFile_open(self, str_file, b_binary = False):
         """
-        Check and generate output files.
+        Open (overwrite) a file in the output dir for writing, compressed 
+        if asked for by --compress.
         """
-        if len(options.str_numberOfHitsFile):
-            self.numberOfHitsReport_process(
-                                        hits        = hits,
-                                        hitsFile    = options.str_numberOfHitsFile
-                                        )
+        if len(self.str_compress):
+            str_suffix  = CompressWriter.d_format[self.str_compress][0]
+            str_name    = str_file if str_file.endswith(str_suffix) else str_file + str_suffix
+            writer      = CompressWriter(os.path.join(self.str_outputDir, str_name),
+                                         self.str_compress, self.compressLevel)
+            self.d_outputFile[str_file] = (str_name, writer)
+            f           = io.BufferedWriter(writer)
+            if b_binary:
+                return f
+            return io.TextIOWrapper(f, encoding = 'utf-8', newline = '')
+        if b_binary:
+            return open(os.path.join(self.str_outputDir, str_file), 'wb')
+        return open(os.path.join(self.str_outputDir, str_file), 'w', newline = '')
+
+    def compress_checkAndConstruct(self, options):
+        """
+        Checks if user asked for --compress'ed output files, if the 
+        format is available, and if the --compressLevel is in its range.
+
+        Return True/False accordingly, or None if the format is not 
+        available or the level is invalid.
+        """
+
+        self.str_compress   = options.str_compress
+        self.compressLevel  = options.compressLevel
+        d_maxLevel          = {'gzip': 9, 'zstd': 22}
+        if len(self.str_compress) and self.compressLevel and \
+                not 1 <= self.compressLevel <= d_maxLevel[self.str_compress]:
+            self.dp.qprint('Invalid --compressLevel %d: %s levels are 1 to %d' % (
+                            self.compressLevel, self.str_compress, d_maxLevel[self.str_compress]),
+                            comms = 'error')
+            return None
+        if self.str_compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                self.dp.qprint('--compress zstd needs the zstandard package (or use --compress gzip)',
+                                comms = 'error')
+                return None
+        return len(self.str_compress) > 0
+
+    def resultRaw_check(self, options, b_chunked):
+        """
+        Checks if user asked for a --resultRaw passthrough, and if it can 
+        be honoured: the result must then be the response to one query of 
+        one PACS, not chunked nor filtered.
+
+        Return True/False accordingly
+        """
+
+        self.b_resultRaw    = False
+        if options.b_resultRaw and len(options.str_resultFile):
+            if len(self.l_msg) > 1 or len(self.l_PACSservice) > 1 or b_chunked or \
+                    self.state or self.filter:
+                self.dp.qprint('--resultRaw needs a single, plain query: re-encoding the results',
+                                comms = 'error')
+            else:
+                self.b_resultRaw    = True
+        return self.b_resultRaw
+
+    def outputStreams_open(self, options, d_ret = None):
+        """
+        Open the streaming writers of the output files requested on the 
+        CLI that are built from the hits, and return them in a dictionary.
+        The query results <d_ret>, if already known, lay out the result 
+        file up front.
+        """
+
+        d_stream    = {}
+        if len(options.str_resultFile) and self.resultBody is not None:
+            self.dp.qprint('Saving raw data results to %s' %
+                            os.path.join(self.str_outputDir, options.str_resultFile))
+            d_stream['results'] = RawResultStream(
+                                    self.outputFile_open(options.str_resultFile, b_binary = True),
+                                    self.resultBody)
+        elif len(options.str_resultFile):
+            self.dp.qprint('Saving data results to %s' %
+                            os.path.join(self.str_outputDir, options.str_resultFile))
+            d_stream['results'] = ResultStream(
+                                    self.outputFile_open(options.str_resultFile),
+                                    format      = options.str_resultFormat,
+                                    sortKeys    = options.b_resultSortKeys,
+                                    indent      = options.resultIndent,
+                                    results     = d_ret)
+
+        if len(options.str_summaryKeys) and len(options.str_summaryFile):
+            self.str_summaryKeys    = options.str_summaryKeys
+            self.l_summaryKeys      = [key.strip() for key in self.str_summaryKeys.split(',')]
+            self.dp.qprint('Saving summary to %s' %
+                            os.path.join(self.str_outputDir, options.str_summaryFile))
+            d_stream['summary'] = SummaryStream(
+                                    self.outputFile_open(options.str_summaryFile),
+                                    keys        = self.l_summaryKeys,
+                                    format      = options.str_summaryFormat)
+
+        if self.index and not options.b_indexLookup:
+            self.dp.qprint('Indexing hits in %s' % options.str_indexDB)
+            d_stream['index']   = IndexStream(self.index)
+
+        # Always kept, for the study and series counts
+        self.studyIndex         = StudyIndex()
+        d_stream['studies']     = self.studyIndex
+        return d_stream
+
+    def outputStreams_write(self, d_stream, l_data):
+        """
+        Write a list of hits to all the open output streams.
+        """
+
+        for str_name, stream in d_stream.items():
+            with self.metric_time('output.%s' % str_name):
+                stream.write(l_data)
 
-        if len(options.str_resultFile):
-            self.dataReport_process     (    
-                                        results     = d_ret,
-                                        resultFile  = options.str_resultFile
+    def outputStreams_close(self, d_stream, options, hits, d_ret):
+        """
+        Close the output streams, and generate the output files that need
+        only the final query state.
+        """
+
+        for str_name, stream in d_stream.items():
+            with self.metric_time('output.%s' % str_name):
+                if str_name == 'results':
+                    stream.close(d_ret)
+                else:
+                    stream.close()
+        if 'results' in d_stream:
+            self.outputFile_measure('output.results', options.str_resultFile)
+        if 'summary' in d_stream:
+            self.outputFile_measure('output.summary', options.str_summaryFile)
+        if 'index' in d_stream:
+            self.metric_add('count', 'output.indexRows', self.index.rows)
+
+        d_studies   = self.studyIndex.stats_get()
+        self.metric_add('count', 'studies', d_studies['studies'])
+        self.metric_add('count', 'series', d_studies['series'])
+        if len(options.str_studySummaryFile):
+            with self.metric_time('output.studySummary'):
+                self.dp.qprint('Saving study summary to %s' %
+                                os.path.join(self.str_outputDir, options.str_studySummaryFile))
+                stream  = SummaryStream(self.outputFile_open(options.str_studySummaryFile),
+                                        keys    = StudyIndex.l_studyKeys,
+                                        format  = options.str_summaryFormat)
+                stream.write(self.studyIndex.rows_get())
+                stream.close()
+            self.outputFile_measure('output.studySummary', options.str_studySummaryFile)
+
+        if len(options.str_numberOfHitsFile) or len(options.str_countsFile):
+            with self.metric_time('output.numberOfHits'):
+                self.numberOfHitsReport_process(
+                                        hits            = hits,
+                                        studies         = d_studies['studies'],
+                                        series          = d_studies['series'],
+                                        hitsFile        = options.str_numberOfHitsFile,
+                                        countsFile      = options.str_countsFile
                                         )
+            self.outputFile_measure('output.numberOfHits', options.str_numberOfHitsFile)
+            self.outputFile_measure('output.counts', options.str_countsFile)
 
-        if len(options.str_summaryKeys):
-            self.summaryReport_process  ( 
-                                        data        = l_data,
-                                        summaryKeys = options.str_summaryKeys,
-                                        summaryFile = options.str_summaryFile
+        if self.state and len(options.str_mergedResultFile):
+            with self.metric_time('output.mergedResults'):
+                l_merged    = []
+                for str_patientID in self.l_patientID:
+                    l_merged.extend(self.state.get(str_patientID, self.str_PACSservice)['hits'].values())
+                self.dataReport_process     (
+                                        results         = {
+                                                            'status':   True,
+                                                            'query':    {
+                                                                'status':   True,
+                                                                'data':     l_merged
+                                                            }
+                                                          },
+                                        resultFile      = options.str_mergedResultFile,
+                                        resultFormat    = options.str_resultFormat,
+                                        sortKeys        = options.b_resultSortKeys,
+                                        indent          = options.resultIndent
                                         )
-       
+            self.outputFile_measure('output.mergedResults', options.str_mergedResultFile)
+
+    def outputFiles_generate(self, options, hits, d_ret, l_data):
+        """
+        Check and generate output files.
+        """
+
+        d_stream    = self.outputStreams_open(options, d_ret)
+        self.outputStreams_write(d_stream, l_data)
+        self.outputStreams_close(d_stream, options, hits, d_ret)
 
     def run(self, options):
         """
         Define the code to be run by this plugin app.
         """
 
+        runTime                 = time.perf_counter()
         d_ret                   = {
             'status': False
         }
-        self.b_pfurlQuiet       = options.b_pfurlQuiet
-        self.str_outputDir      = options.outputdir
+        self.d_metrics          = {'time': {}, 'count': {}}
+        with self.metric_time('arguments'):
+            self.b_pfurlQuiet       = options.b_pfurlQuiet
+            self.str_outputDir      = options.outputdir
+            self.jobs               = options.jobs
+            self.b_async            = options.b_async
+            self.poolSize           = options.poolSize
 
-        if options.b_version:
-            print(str_version)
+            if options.b_version:
+                print(str_version)
+            b_run   = not self.manPage_checkAndShow(options) and not options.b_version
 
-        if not self.manPage_checkAndShow(options) and not options.b_version:
-            if len(options.str_pfdcm):
+        if b_run and len(options.str_submit):
+            # Normally short-circuited before the ChrisApp is even built
+            d_ret['status'] = job_submit(sys.argv[1:]) == 0
+        elif b_run and len(options.str_serve):
+            d_ret   = self.serve(options)
+        elif b_run:
+            if options.b_indexLookup:
+                if self.compress_checkAndConstruct(options) is not None:
+                    d_ret   = self.index_lookup(options)
+                if d_ret['status']:
+                    l_data  = d_ret['query']['data']
+                    self.outputFiles_generate(options, len(l_data), d_ret, l_data)
+                    self.metric_add('count', 'hits', len(l_data))
+                self.metric_add('time', 'total', time.perf_counter() - runTime)
+                self.stats_report()
+                self.metrics_save(options)
+            elif len(options.str_pfdcm):
                 self.str_pfdcm      = options.str_pfdcm
-                if not self.directMessage_checkAndConstruct(options):
-                    self.queryMessage_checkAndConstruct(options)
+                with self.metric_time('message'):
+                    self.state_checkAndConstruct(options)
+                    if self.filter_checkAndConstruct(options) is not None and \
+                            not self.directMessage_checkAndConstruct(options):
+                        self.queryMessage_checkAndConstruct(options)
 
                 if self.b_canRun:
-                    d_ret   = self.service_call(msg = self.d_msg)
-                    l_data  = d_ret['query']['data']
-                    hits    = len(l_data) 
-                    self.dp.qprint('Query returned %d study hits' % hits)
+                    b_chunked       = self.chunk_checkAndConstruct(options)
+                    self.b_canRun   = b_chunked is not None
+                if self.b_canRun:
+                    self.resultRaw_check(options, b_chunked)
+                    self.b_canRun   = self.compress_checkAndConstruct(options) is not None
+                if self.b_canRun:
+                    self.retry_construct(options)
+                    self.scheduler_checkAndConstruct(options, b_chunked)
+                    self.flight_checkAndConstruct(options)
+                    self.session_checkAndConstruct()
+                    self.cache_checkAndConstruct(options)
+                    self.index_checkAndConstruct(options)
+                    if b_chunked:
+                        # Hits are streamed to the outputs chunk by chunk
+                        d_stream    = self.outputStreams_open(options)
+                        with self.metric_time('query'):
+                            d_ret   = self.chunked_call(
+                                                jobList = self.l_msg,
+                                                jobs    = self.jobs,
+                                                streams = d_stream
+                                                )
+                        hits    = d_ret['query']['hits']
+                        self.outputStreams_close(d_stream, options, hits, d_ret)
+                    else:
+                        with self.metric_time('query'):
+                            if len(self.l_msg) > 1 and self.b_async:
+                                d_ret   = self.async_call(
+                                                    jobList = self.l_msg,
+                                                    jobs    = self.jobs
+                                                    )
+                            elif len(self.l_msg) > 1:
+                                d_ret   = self.batch_call(
+                                                    jobList = self.l_msg,
+                                                    jobs    = self.jobs
+                                                    )
+                            elif len(self.l_msg):
+                                d_ret   = self.query_call(self.str_patientID, self.d_msg)
+                            else:
+                                d_ret   = self.hits_filter(self.service_call(msg = self.d_msg))
+                        l_data  = d_ret['query']['data']
+                        hits    = len(l_data) 
+                        self.outputFiles_generate(options, hits, d_ret, l_data)
+                    self.metric_add('count', 'hits', hits)
+                    d_studies   = self.studyIndex.stats_get()
+                    self.dp.qprint('Query returned %d hits: %d series in %d studies' %
+                                    (hits, d_studies['series'], d_studies['studies']))
 
-                    self.outputFiles_generate(options, hits, d_ret, l_data)
+                    self.metric_add('time', 'total', time.perf_counter() - runTime)
+                    self.stats_report()
+                    self.metrics_save(options)
 
         return d_ret
 
@@ -1,7 +1,7 @@
 import sys
-# Make sure we are running python3.5+
-if 10 * sys.version_info[0]  + sys.version_info[1] < 35:
-    sys.exit("Sorry, only Python 3.5+ is supported.")
+# Make sure we are running python3.7+ (asyncio.run)
+if 10 * sys.version_info[0]  + sys.version_info[1] < 37:
+    sys.exit("Sorry, only Python 3.7+ is supported.")
 
 from setuptools import setup
 
@@ -19,7 +19,8 @@ setup(
       author_email     =   'rudolph.pienaar@gmail.com',
       url              =   'https://github.com/FNNDSC/pfmisc',
       packages         =   ['pacsquery'],
-      install_requires =   ['pudb', 'pfmisc', 'chrisapp', 'pfurl', 'pypx'],
+      install_requires =   ['pfmisc', 'chrisapp', 'pfurl'],
+      python_requires  =   '>=3.7',
       test_suite       =   'nose.collector',
       tests_require    =   ['nose'],
       scripts          =   ['pacsquery/pacsquery.py'],
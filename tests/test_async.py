@@ -0,0 +1,162 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The asyncio AsyncPfdcmSession, and the --async batch query it serves,
+which returns the same as the threaded one.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def message_make(str_patientID):
+    return {
+        'action':   'PACSinteract',
+        'meta': {
+            'do':   'query',
+            'on':   {'PatientID': str_patientID},
+            'PACS': 'PACS'
+        }
+    }
+
+
+class AsyncPfdcmSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 5, seriesPerStudy = 5)
+        self.str_pfdcm  = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        session     = pacsquery.AsyncPfdcmSession(pfdcm = self.str_pfdcm)
+
+        async def post():
+            l_body  = []
+            for i in range(5):
+                l_body.append(await session.post(message_make('P%d' % i)))
+            session.close()
+            return l_body
+
+        l_body      = asyncio.run(post())
+        for i, body in enumerate(l_body):
+            self.assertEqual(json.loads(body)['query']['data'][0]['PatientID']['value'], 'P%d' % i)
+        self.assertEqual(session.stats_get(),
+                         {'poolSize': 1, 'requests': 5, 'hits': 4, 'misses': 1})
+
+    def test_concurrentPoolBounded(self):
+        session     = pacsquery.AsyncPfdcmSession(pfdcm = self.str_pfdcm, poolSize = 2)
+
+        async def post():
+            for i in range(3):
+                await asyncio.gather(*[session.post(message_make('P1')) for j in range(4)])
+            # No more kept than the pool holds
+            self.assertLessEqual(len(session.pool), 2)
+            session.close()
+
+        asyncio.run(post())
+        d_stats     = session.stats_get()
+        self.assertEqual(d_stats['requests'], 12)
+        self.assertEqual(d_stats['hits'] + d_stats['misses'], 12)
+
+    def test_errorStatus(self):
+        session     = pacsquery.AsyncPfdcmSession(pfdcm = self.str_pfdcm)
+        self.server.failPACS    = 'PACS'
+
+        async def post():
+            with self.assertRaises(pacsquery.PfdcmHTTPError) as context:
+                await session.post(message_make('P1'))
+            self.assertEqual(context.exception.status, 500)
+            self.server.failPACS    = ''
+            body    = await session.post(message_make('P1'))
+            session.close()
+            return body
+
+        self.assertEqual(len(json.loads(asyncio.run(post()))['query']['data']), 5)
+        # The connection outlives the error status
+        self.assertEqual(session.stats_get()['hits'], 1)
+
+
+class AsyncQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 10, seriesPerStudy = 10, latency = 0.2)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P0,P1,P2,P3,P4,P5',
+                    '--PACSservice',    'PACS',
+                    '--jobs',           '3',
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        startTime   = time.perf_counter()
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        elapsed     = time.perf_counter() - startTime
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            d_result    = json.load(f)
+        return d_ret, d_result, app, elapsed
+
+    def test_sameAsThreaded(self):
+        d_ret, d_threaded, app, elapsed = self.query_run([])
+        d_ret, d_async, app, elapsed    = self.query_run(['--async'])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(d_async, d_threaded)
+        self.assertEqual(len(d_async['query']['data']), 60)
+        self.assertEqual(self.server.requests, 12)
+        # Two rounds of three outstanding queries, rather than six in turn
+        self.assertLess(elapsed, 6 * 0.2 * 0.75)
+
+        d_pool  = app.OUTPUT_META_DICT['pool']
+        self.assertEqual(d_pool['poolSize'], 3)
+        self.assertEqual(d_pool['requests'], 6)
+        self.assertLessEqual(d_pool['misses'], 3)
+        self.assertEqual(d_pool['hits'], 6 - d_pool['misses'])
+        self.assertIsNone(app.session)
+
+    def test_failedBatch(self):
+        self.server.failPACS    = 'PACS'
+        d_ret, d_result, app, elapsed   = self.query_run(['--async'])
+        self.assertFalse(d_ret['status'])
+        self.assertEqual(sorted(d_ret['batch']), ['P0', 'P1', 'P2', 'P3', 'P4', 'P5'])
+        for d_job in d_ret['batch'].values():
+            self.assertFalse(d_job['status'])
+            self.assertIn('500', d_job['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+A batch of PatientIDs is fanned out over --jobs concurrent queries, and
+their hits merged into a single result.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class BatchQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 10, seriesPerStudy = 10, latency = 0.2)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        startTime   = time.perf_counter()
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        return d_ret, time.perf_counter() - startTime
+
+    def test_fanOut(self):
+        l_patientID     = ['P%d' % i for i in range(6)]
+        d_ret, elapsed  = self.query_run(['--PatientID', ','.join(l_patientID), '--jobs', '3'])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(self.server.requests, 6)
+        # Two rounds of three concurrent queries, rather than six in turn
+        self.assertLess(elapsed, 6 * 0.2 * 0.75)
+
+        self.assertEqual(list(d_ret['batch']), l_patientID)
+        for str_patientID in l_patientID:
+            self.assertEqual(d_ret['batch'][str_patientID], {'status': True, 'hits': 10})
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            l_data  = json.load(f)['query']['data']
+        self.assertEqual([d_hit['PatientID']['value'] for d_hit in l_data],
+                         [str_patientID for str_patientID in l_patientID for i in range(10)])
+
+    def test_patientIDFile(self):
+        str_file    = os.path.join(self.str_dir, 'patients.txt')
+        with open(str_file, 'w') as f:
+            f.write('P1\n\nP2\n  P1\n')
+        d_ret, elapsed  = self.query_run(['--PatientID', 'P3,P2', '--PatientIDFile', str_file,
+                                          '--jobs', '2'])
+        self.assertTrue(d_ret['status'])
+        # Duplicates are queried once, in the order first given
+        self.assertEqual(list(d_ret['batch']), ['P3', 'P2', 'P1'])
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(len(d_ret['query']['data']), 30)
+
+    def test_failedBatch(self):
+        self.server.failPACS    = 'PACS'
+        d_ret, elapsed  = self.query_run(['--PatientID', 'P1,P2', '--jobs', '2'])
+        self.assertFalse(d_ret['status'])
+        self.assertEqual(sorted(d_ret['batch']), ['P1', 'P2'])
+        for d_result in d_ret['batch'].values():
+            self.assertFalse(d_result['status'])
+            self.assertIn('500', d_result['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
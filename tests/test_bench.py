@@ -0,0 +1,145 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The mock 'pfdcm' answers queries as 'pfdcm' would, and the end to end
+benchmark runs its scenarios against it.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def message_make(d_on):
+    return {
+        'action':   'PACSinteract',
+        'meta': {
+            'do':   'query',
+            'on':   d_on,
+            'PACS': 'PACS'
+        }
+    }
+
+
+class MockPfdcmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.l_server   = []
+
+    def tearDown(self):
+        for server in self.l_server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def server_start(self, **kwargs):
+        server  = mock_pfdcm.server_start(**kwargs)
+        self.l_server.append(server)
+        return pacsquery.PfdcmSession(pfdcm = '127.0.0.1:%d' % server.server_address[1])
+
+    def test_studyDateCovers(self):
+        self.assertTrue(mock_pfdcm.studyDate_covers({}, '20010101'))
+        self.assertTrue(mock_pfdcm.studyDate_covers({'StudyDate': '20010101'}, '20010101'))
+        self.assertFalse(mock_pfdcm.studyDate_covers({'StudyDate': '20010101'}, '20010102'))
+        self.assertTrue(mock_pfdcm.studyDate_covers({'StudyDate': '20010101-'}, '20300101'))
+        self.assertTrue(mock_pfdcm.studyDate_covers({'StudyDate': '-20010101'}, '19000101'))
+        self.assertFalse(mock_pfdcm.studyDate_covers({'StudyDate': '20000101-20001231'}, '20010101'))
+
+    def test_responseMake(self):
+        d_response  = mock_pfdcm.response_make(message_make({'PatientID': 'P7'}), 60, 10)
+        l_data      = d_response['query']['data']
+        self.assertEqual(len(l_data), 60)
+        self.assertEqual(sorted(l_data[0]), sorted(mock_pfdcm.d_tag))
+        # In the pypx/pfdcm reply layout
+        self.assertEqual(l_data[0]['PatientID'], {'tag': '0x0010,0x0020', 'value': 'P7', 'label': 'PatientID'})
+        self.assertEqual(set(d_hit['PatientID']['value'] for d_hit in l_data), {'P7'})
+        self.assertEqual(len(set(d_hit['StudyInstanceUID']['value'] for d_hit in l_data)), 6)
+
+        l_data      = mock_pfdcm.response_make(
+                            message_make({'PatientID': 'P7', 'StudyDate': '20010101-', 'Modality': 'MR'}),
+                            60, 10)['query']['data']
+        self.assertEqual(sorted(set(d_hit['StudyDate']['value'] for d_hit in l_data)), ['20050606'])
+        self.assertEqual(len(l_data), 10)
+
+    def test_recordedResponse(self):
+        str_response    = os.path.join(self.str_dir, 'response.json')
+        d_response      = mock_pfdcm.response_make(message_make({'PatientID': 'REC'}), 3, 1)
+        with open(str_response, 'w') as f:
+            json.dump(d_response, f)
+        session = self.server_start(response = str_response)
+        # Replayed as recorded, whatever the query
+        self.assertEqual(json.loads(session.post(message_make({'PatientID': 'P1'}))), d_response)
+        session.close()
+
+    def test_failures(self):
+        session = self.server_start(hits = 20, failStudyDate = '20010202')
+        with self.assertRaises(pacsquery.PfdcmHTTPError):
+            session.post(message_make({'PatientID': 'P1'}))
+        d_response  = json.loads(session.post(message_make({'PatientID': 'P1', 'StudyDate': '-20001231'})))
+        self.assertEqual(len(d_response['query']['data']), 10)
+        session.close()
+
+        session = self.server_start(hits = 20, failPACS = 'DOWN')
+        self.assertEqual(len(json.loads(session.post(message_make({'PatientID': 'P1'})))['query']['data']), 20)
+        d_msg   = message_make({'PatientID': 'P1'})
+        d_msg['meta']['PACS']   = 'DOWN'
+        with self.assertRaises(pacsquery.PfdcmHTTPError) as context:
+            session.post(d_msg)
+        self.assertEqual(context.exception.status, 500)
+        session.close()
+
+
+class BenchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.str_dir)
+
+    def test_scenarios(self):
+        str_jsonFile    = os.path.join(self.str_dir, 'bench.json')
+        proc            = subprocess.run(
+                            [sys.executable, os.path.join(str_rootDir, 'bench', 'bench_pacsquery.py'),
+                             '--hits',      '20',
+                             '--queries',   '2',
+                             '--scenarios', 'results,all',
+                             '--jsonFile',  str_jsonFile],
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE,
+                            universal_newlines = True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        with open(str_jsonFile) as f:
+            d_bench = json.load(f)
+        self.assertEqual(d_bench['hits'], 20)
+        self.assertEqual([d_result['scenario'] for d_result in d_bench['results']], ['results', 'all'])
+        for d_result in d_bench['results']:
+            self.assertEqual(d_result['queries'], 2)
+            self.assertGreater(d_result['queriesPerSec'], 0)
+            self.assertGreater(d_result['tracemallocPeak'], 0)
+        self.assertEqual(sorted(d_bench['results'][1]['outputBytes']),
+                         ['hits.txt', 'results.json', 'summary.txt'])
+        self.assertIn('results', proc.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The QueryCache answers repeated queries within its TTL, evicts the least
+recently used entries past its byte limit, and is bypassed by messages
+that are not queries.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def message_make(str_patientID, str_do = 'query'):
+    return {
+        'action':   'PACSinteract',
+        'meta': {
+            'do':   str_do,
+            'on':   {'PatientID': str_patientID},
+            'PACS': 'PACS'
+        }
+    }
+
+
+class QueryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.str_dir)
+
+    def test_putGet(self):
+        cache   = pacsquery.QueryCache(cacheDir = self.str_dir)
+        d_msg   = message_make('P1')
+        self.assertIsNone(cache.get(d_msg))
+        cache.put(d_msg, b'{"status": true}')
+        self.assertEqual(cache.get(d_msg), b'{"status": true}')
+        self.assertIsNone(cache.get(message_make('P2')))
+        self.assertEqual(cache.stats_get(), {'hits': 1, 'misses': 2, 'evictions': 0})
+
+        # A new cache on the same directory finds the entry
+        self.assertEqual(pacsquery.QueryCache(cacheDir = self.str_dir).get(d_msg), b'{"status": true}')
+
+    def test_TTL(self):
+        cache   = pacsquery.QueryCache(cacheDir = self.str_dir, TTL = 0.05)
+        d_msg   = message_make('P1')
+        cache.put(d_msg, b'body')
+        self.assertEqual(cache.get(d_msg), b'body')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(d_msg))
+        # The expired entry is removed
+        self.assertEqual(os.listdir(self.str_dir), [])
+        self.assertEqual(cache.totalBytes, 0)
+
+    def test_LRUEviction(self):
+        cache   = pacsquery.QueryCache(cacheDir = self.str_dir)
+        body    = b'x' * 1000
+        l_msg   = [message_make('P%d' % i) for i in range(3)]
+        cache.put(l_msg[0], body)
+        # Room for two entries (their headers may differ by a few bytes)
+        entrySize       = cache.totalBytes
+        cache.maxBytes  = 2 * entrySize + 100
+        cache.put(l_msg[1], body)
+        # Using P0 makes P1 the least recently used
+        self.assertEqual(cache.get(l_msg[0]), body)
+        cache.put(l_msg[2], body)
+
+        self.assertIsNone(cache.get(l_msg[1]))
+        self.assertEqual(cache.get(l_msg[0]), body)
+        self.assertEqual(cache.get(l_msg[2]), body)
+        self.assertEqual(cache.stats_get()['evictions'], 1)
+        self.assertLessEqual(cache.totalBytes, cache.maxBytes)
+        self.assertEqual(len(os.listdir(self.str_dir)), 2)
+
+    def test_isCacheable(self):
+        self.assertTrue(pacsquery.QueryCache.isCacheable(message_make('P1')))
+        self.assertFalse(pacsquery.QueryCache.isCacheable(message_make('P1', 'retrieve')))
+        self.assertFalse(pacsquery.QueryCache.isCacheable({'action': 'hello'}))
+
+
+class CachedQueryTest(unittest.TestCase):
+    '''
+    Repeated runs against the mock 'pfdcm', sharing a --cacheDir.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_cache  = os.path.join(self.str_dir, 'cache')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--cacheDir',       self.str_cache,
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            return d_ret, json.load(f)
+
+    def test_queryCached(self):
+        l_args          = ['--PatientID', 'P1', '--PACSservice', 'PACS']
+        d_ret, d_first  = self.query_run(l_args)
+        d_ret, d_second = self.query_run(l_args)
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(d_second, d_first)
+        self.assertEqual(len(d_second['query']['data']), 20)
+
+    def test_otherMessageBypasses(self):
+        l_args          = ['--msg', json.dumps(message_make('P1', 'retrieve'))]
+        for i in range(2):
+            d_ret, d_result = self.query_run(l_args)
+            self.assertTrue(d_ret['status'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual([name for name in os.listdir(self.str_cache) if name.endswith('.cache')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Chunked and incremental queries, end to end against the mock 'pfdcm'.
+"""
+
+import os
+import sys
+import json
+import shutil
+import datetime
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def query_run(l_argv):
+    """
+    Run one query through a new PacsQueryApp, with its log silenced.
+    """
+    app     = pacsquery.PacsQueryApp()
+    options = app.parse_args(l_argv)
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        return app.run(options)
+
+
+class ChunkedIncrementalTest(unittest.TestCase):
+    '''
+    The mock has one study a year, from 20000101 to 20050606, of 10 series
+    each. A chunked query has one chunk per year.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 60, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_state  = os.path.join(self.str_dir, 'state')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def run_incremental(self):
+        return query_run([
+            '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+            '--PatientID',      'P1',
+            '--PACSservice',    'PACS',
+            '--chunkDays',      '366',
+            '--chunkStudyDate', '20000101-20051231',
+            '--incremental',
+            '--stateDir',       self.str_state,
+            '--retries',        '0',
+            '--resultFile',     'results.json',
+            '--pfurlQuiet',
+            self.str_dir
+        ])
+
+    def studyDates_get(self):
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            l_data  = json.load(f)['query']['data']
+        return sorted(set(d_hit['StudyDate']['value'] for d_hit in l_data))
+
+    def test_failedChunkKeepsState(self):
+        self.server.failStudyDate   = '20000101'
+        d_ret       = self.run_incremental()
+        self.assertFalse(d_ret['status'])
+        self.assertEqual(d_ret['query']['hits'], 50)
+        d_state     = pacsquery.QueryState(stateDir = self.str_state).get('P1', 'PACS')
+        self.assertEqual(d_state['lastStudyDate'], '')
+
+        # The next run still asks for (and reports) the failed window
+        self.server.failStudyDate   = ''
+        d_ret       = self.run_incremental()
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(d_ret['query']['hits'], 60)
+        self.assertIn('20000101', self.studyDates_get())
+        d_state     = pacsquery.QueryState(stateDir = self.str_state).get('P1', 'PACS')
+        self.assertEqual(d_state['lastStudyDate'], '20050606')
+        self.assertEqual(len(d_state['hits']), 60)
+
+    def test_defaultRange(self):
+        d_ret       = query_run([
+            '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+            '--PatientID',      'P1',
+            '--PACSservice',    'PACS',
+            '--chunkDays',      '3650',
+            '--retries',        '0',
+            '--pfurlQuiet',
+            self.str_dir
+        ])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(d_ret['query']['hits'], 60)
+        self.assertIn('-19891231', [d_chunk['StudyDate'] for d_chunk in d_ret['chunks']])
+
+    def test_completeChunksSaveState(self):
+        d_ret       = self.run_incremental()
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(d_ret['query']['hits'], 60)
+
+        # Only the latest study is asked for again, and it is already known
+        d_ret       = self.run_incremental()
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(d_ret['query']['hits'], 0)
+        self.assertEqual(len(d_ret['chunks']), 1)
+
+
+class ChunkWindowTest(unittest.TestCase):
+    '''
+    The StudyDate windows of a chunked query.
+    '''
+
+    def setUp(self):
+        self.app        = pacsquery.PacsQueryApp()
+        self.app.l_msg  = [('P1', {})]
+
+    def chunks_make(self, l_args, str_studyDate = ''):
+        options = self.app.parse_args(['--pfdcm', 'localhost:4005', '--chunkDays', '3650'] +
+                                      l_args + ['out'])
+        self.assertTrue(self.app.chunk_checkAndConstruct(options))
+        d_msg   = {'meta': {'on': {'PatientID': 'P1'}}}
+        if len(str_studyDate):
+            d_msg['meta']['on']['StudyDate']    = str_studyDate
+        return [self.app.chunkStudyDate_get(d_chunk) for d_chunk in self.app.chunks_make('P1', d_msg)]
+
+    def test_openStart(self):
+        l_range     = self.chunks_make([])
+        self.assertEqual(l_range[:3], ['-19891231', '19900101-19991229', '19991230-20091226'])
+        self.assertTrue(l_range[-1].endswith(datetime.date.today().strftime('%Y%m%d')))
+        self.assertEqual(self.chunks_make([], '-19851231'), ['-19851231'])
+
+    def test_closedStart(self):
+        self.assertEqual(self.chunks_make(['--chunkStudyDate', '19800101-19991231']),
+                         ['19800101-19891228', '19891229-19991226', '19991227-19991231'])
+        self.assertEqual(self.chunks_make([], '19950101-19991231'), ['19950101-19991231'])
+
+    def test_openStartSplit(self):
+        l_chunk     = self.app.chunk_split({'start': None, 'end': datetime.date(1989, 12, 31),
+                                            'Modality': ''})
+        self.assertEqual([self.app.chunkStudyDate_get(d_chunk) for d_chunk in l_chunk],
+                         ['-19441231', '19450101-19891231'])
+
+
+class FirstCompleteIncrementalTest(unittest.TestCase):
+    '''
+    Of the two PACS queried, 'DOWN' always fails: with --PACSfirstComplete
+    the hits of 'PACS' are reported, but the state is not advanced.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10, failPACS = 'DOWN')
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_state  = os.path.join(self.str_dir, 'state')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def run_incremental(self, l_args = []):
+        return query_run([
+            '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+            '--PatientID',      'P1',
+            '--PACSservice',    'PACS,DOWN',
+            '--PACSfirstComplete',
+            '--incremental',
+            '--stateDir',       self.str_state,
+            '--retries',        '0',
+            '--pfurlQuiet',
+            self.str_dir
+        ] + l_args)
+
+    def state_get(self):
+        return pacsquery.QueryState(stateDir = self.str_state).get('P1', 'PACS,DOWN')
+
+    def test_singleQueryKeepsState(self):
+        d_ret       = self.run_incremental()
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(len(d_ret['query']['data']), 20)
+        self.assertEqual(self.state_get()['lastStudyDate'], '')
+        self.assertEqual(len(self.state_get()['hits']), 0)
+
+    def test_incompleteReason(self):
+        app         = pacsquery.PacsQueryApp()
+        d_PACS      = {'PACS': {'status': True}, 'DOWN': {'status': False}, 'OFF': {'status': False}}
+        self.assertEqual(app.response_incomplete({'status': True, 'PACS': d_PACS}),
+                         '2 of 3 PACS failed (DOWN, OFF)')
+        del d_PACS['OFF']
+        self.assertEqual(app.response_incomplete({'status': True, 'PACS': d_PACS}),
+                         'PACS DOWN failed')
+        self.assertEqual(app.response_incomplete({'status': False}), 'the query failed')
+        self.assertEqual(app.response_incomplete({'status': True, 'PACS': {'PACS': {'status': True}}}), '')
+
+    def test_chunkedQueryKeepsState(self):
+        d_ret       = self.run_incremental(['--chunkDays', '366',
+                                            '--chunkStudyDate', '20000101-20011231'])
+        self.assertEqual(d_ret['query']['hits'], 20)
+        self.assertEqual(self.state_get()['lastStudyDate'], '')
+        self.assertEqual(len(self.state_get()['hits']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+--compress'ed output files hold what the uncompressed ones would, and a
+format that is not available is an error rather than a silent fallback.
+"""
+
+import os
+import sys
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+try:
+    import zstandard
+except ImportError:
+    zstandard   = None
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, str_outputDir, l_args = []):
+        os.makedirs(str_outputDir)
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--summaryKeys',    'PatientID,StudyDate,Modality',
+                    '--summaryFile',    'summary.txt',
+                    '--pfurlQuiet',
+                    str_outputDir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        return d_ret, app
+
+    def file_read(self, str_outputDir, str_file, decompress = lambda data: data):
+        with open(os.path.join(self.str_dir, str_outputDir, str_file), 'rb') as f:
+            return decompress(f.read())
+
+    def assertSameOutput(self, str_compress, str_suffix, decompress):
+        d_ret, app  = self.query_run(os.path.join(self.str_dir, 'plain'))
+        self.assertTrue(d_ret['status'])
+        d_ret, app  = self.query_run(os.path.join(self.str_dir, str_compress),
+                                     ['--compress', str_compress])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.str_dir, str_compress))),
+                         ['results.json' + str_suffix, 'summary.txt' + str_suffix])
+        for str_file in ['results.json', 'summary.txt']:
+            data    = self.file_read('plain', str_file)
+            self.assertEqual(self.file_read(str_compress, str_file + str_suffix, decompress), data)
+            self.assertEqual(
+                app.d_metrics['count']['output.%sUncompressedBytes' % str_file.split('.')[0]],
+                len(data))
+
+    def test_gzip(self):
+        self.assertSameOutput('gzip', '.gz', gzip.decompress)
+
+    @unittest.skipUnless(zstandard, 'needs the zstandard package')
+    def test_zstd(self):
+        self.assertSameOutput('zstd', '.zst',
+                              lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data))
+
+    @unittest.skipIf(zstandard, 'the zstandard package is installed')
+    def test_zstdMissing(self):
+        d_ret, app  = self.query_run(os.path.join(self.str_dir, 'zstd'), ['--compress', 'zstd'])
+        self.assertFalse(d_ret['status'])
+        self.assertEqual(self.server.requests, 0)
+        self.assertEqual(os.listdir(os.path.join(self.str_dir, 'zstd')), [])
+
+    def test_levelOutOfRange(self):
+        d_ret, app  = self.query_run(os.path.join(self.str_dir, 'gzip'),
+                                     ['--compress', 'gzip', '--compressLevel', '10'])
+        self.assertFalse(d_ret['status'])
+        self.assertEqual(self.server.requests, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+--version and --man are answered without importing the plugin framework
+or any of the service client modules.
+"""
+
+import os
+import sys
+import unittest
+import subprocess
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import importtime
+
+
+class FastPathTest(unittest.TestCase):
+
+    def app_run(self, l_args):
+        """
+        Run the plugin script under '-X importtime', and return its output
+        and the modules it imported.
+        """
+        proc        = subprocess.run(
+                            [sys.executable, '-X', 'importtime', importtime.str_app] + l_args,
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE,
+                            universal_newlines = True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        importUs, s_module  = importtime.importtime_parse(proc.stderr)
+        return proc.stdout, s_module
+
+    def assertFastPath(self, s_module):
+        self.assertEqual(sorted(m for m in importtime.l_fastPathForbidden if m in s_module), [])
+
+    def test_version(self):
+        str_out, s_module   = self.app_run(['--version'])
+        self.assertEqual(str_out.strip(), pacsquery.str_version)
+        self.assertFastPath(s_module)
+
+    def test_man(self):
+        str_out, s_module   = self.app_run(['--man', 'synopsis'])
+        self.assertEqual(str_out.strip(), pacsquery.man_get()['synopsis'].strip())
+        self.assertFastPath(s_module)
+
+        str_out, s_module   = self.app_run(['--version', '--man=entries'])
+        self.assertEqual(str_out.splitlines()[0], pacsquery.str_version)
+        self.assertIn('callingSyntax1', str_out)
+        self.assertFastPath(s_module)
+
+    def test_otherFlagsNeedParser(self):
+        self.assertFalse(pacsquery.fastPath_checkAndRun(['--version', '--pfdcm', 'localhost:5015']))
+        self.assertFalse(pacsquery.fastPath_checkAndRun(['--man']))
+        self.assertFalse(pacsquery.fastPath_checkAndRun([]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The HitFilter keeps only the hits that meet the --Modality, --StudyDate
+and --SeriesDescription criteria, whatever else the query writes out.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def hit_make(d_value):
+    return {str_tag: {'value': value} for str_tag, value in d_value.items()}
+
+
+class HitFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.l_data     = [
+            hit_make({'Modality': 'MR', 'StudyDate': '20010203', 'SeriesDescription': 'T1 axial'}),
+            hit_make({'Modality': 'ct', 'StudyDate': '20010203', 'SeriesDescription': 'head'}),
+            hit_make({'Modality': 'MR', 'StudyDate': '1999.12.31', 'SeriesDescription': 'T2 axial'}),
+            hit_make({'Modality': 'US', 'StudyDate': '', 'SeriesDescription': 'T1 sag'}),
+            hit_make({'StudyDate': '20050101', 'SeriesDescription': 'T1 cor'})
+        ]
+
+    def select(self, **kwargs):
+        hitFilter   = pacsquery.HitFilter(**kwargs)
+        l_index     = hitFilter.select(self.l_data)
+        self.assertEqual(hitFilter.select(pacsquery.HitStore(self.l_data)), l_index)
+        return l_index
+
+    def test_modality(self):
+        self.assertEqual(self.select(modality = ['mr', ' CT']), [0, 1, 2])
+
+    def test_studyDate(self):
+        self.assertEqual(self.select(studyDate = '20000101-20051231'), [0, 1, 4])
+        self.assertEqual(self.select(studyDate = '-19991231'), [2])
+        self.assertEqual(self.select(studyDate = '20010203'), [0, 1])
+
+    def test_seriesDescription(self):
+        self.assertEqual(self.select(seriesDescription = '^T1 '), [0, 3, 4])
+
+    def test_allCriteria(self):
+        # A hit without a tag filtered on is dropped
+        self.assertEqual(self.select(modality = ['MR', 'US'], seriesDescription = 'T1'), [0, 3])
+        self.assertEqual(self.select(modality = ['MR'], studyDate = '19990101-'), [0, 2])
+
+    def test_pushDown(self):
+        self.assertEqual(pacsquery.HitFilter(modality = ['mr'], studyDate = '20000101-').on_get(),
+                         {'Modality': 'MR', 'StudyDate': '20000101-'})
+        self.assertEqual(pacsquery.HitFilter(modality = ['MR', 'CT']).on_get(), {})
+        self.assertFalse(pacsquery.HitFilter(modality = [''], seriesDescription = ''))
+
+
+class FilteredQueryTest(unittest.TestCase):
+    '''
+    The mock has one study a year, from 20000101 to 20050606, of 10 series
+    each, of Modality MR, CT, US, CR, DX and MR again.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 60, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            l_data  = json.load(f)['query']['data']
+        return d_ret, l_data, app
+
+    def test_filtered(self):
+        d_ret, l_data, app  = self.query_run(['--Modality', 'MR,CT',
+                                              '--StudyDate', '20010101-',
+                                              '--SeriesDescription', ' (MR|CT)$'])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(sorted(set(d_hit['StudyDate']['value'] for d_hit in l_data)),
+                         ['20010202', '20050606'])
+        self.assertEqual(len(l_data), 20)
+        self.assertEqual(app.d_metrics['count']['filtered'], 30)
+
+    def test_filterDisablesRaw(self):
+        d_ret, l_data, app  = self.query_run(['--SeriesDescription', '^Series 1[0-9] ',
+                                              '--resultRaw'])
+        self.assertTrue(d_ret['status'])
+        self.assertFalse(app.b_resultRaw)
+        self.assertEqual([d_hit['SeriesDescription']['value'][:9] for d_hit in l_data],
+                         ['Series %d' % i for i in range(10, 20)])
+
+        d_ret, l_data, app  = self.query_run(['--resultRaw'])
+        self.assertTrue(app.b_resultRaw)
+        self.assertEqual(len(l_data), 60)
+
+    def test_incrementalKeepsFilteredHits(self):
+        str_state   = os.path.join(self.str_dir, 'state')
+        l_args      = ['--incremental', '--stateDir', str_state]
+        d_ret, l_data, app  = self.query_run(l_args + ['--Modality', 'MR'])
+        self.assertEqual(len(l_data), 20)
+        d_state     = pacsquery.QueryState(stateDir = str_state).get('P1', 'PACS')
+        self.assertEqual(len(d_state['hits']), 20)
+        self.assertEqual(d_state['lastStudyDate'], '20050606')
+
+        # The state is kept whatever the criteria: the next run only asks
+        # for studies since the last MR one, and has seen them all
+        d_ret, l_data, app  = self.query_run(l_args)
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(l_data, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
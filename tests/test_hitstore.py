@@ -0,0 +1,142 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The HitStore gives back exactly the hits it was built from, whether it is
+compacted from a decoded list or streamed from a 'pfdcm' response body.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def hits_make(hits):
+    """
+    Return <hits> mock hits, then a few that are laid out differently.
+    """
+    l_data  = mock_pfdcm.response_make({'meta': {'on': {'PatientID': 'P1'}}}, hits, 5)['query']['data']
+    l_odd   = [dict(d_hit) for d_hit in l_data[:3]]
+    del l_odd[0]['Modality']
+    l_odd[1]['Comment']         = {'tag': '0x0020,0x4000', 'value': 'extra', 'label': 'Comment'}
+    l_odd[2]['StudyDate']       = {'value': '20010101'}
+    return l_data + l_odd + l_data[:2]
+
+
+class HitStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.l_data     = hits_make(20)
+        self.str_body   = json.dumps({
+                                'status':   True,
+                                'query':    {'status': True, 'data': self.l_data}
+                          })
+
+    def test_roundTrip(self):
+        self.l_data.append(dict(self.l_data[0], PatientID = 'P1'))
+        store   = pacsquery.HitStore(self.l_data)
+        self.assertEqual(len(store), len(self.l_data))
+        self.assertEqual(list(store), self.l_data)
+        self.assertEqual(store[-1], self.l_data[-1])
+        for index, d_hit in enumerate(self.l_data):
+            self.assertEqual(store.hit_get(index), d_hit)
+
+    def test_columns(self):
+        store   = pacsquery.HitStore(self.l_data)
+        for str_tag in ['StudyDate', 'Modality', 'Comment']:
+            self.assertEqual(
+                store.column_get(str_tag),
+                [d_hit[str_tag]['value'] if isinstance(d_hit.get(str_tag), dict) else ''
+                    for d_hit in self.l_data])
+        l_index = [0, 21, 22, 3]
+        self.assertEqual(list(store.select(l_index)), [self.l_data[i] for i in l_index])
+
+        store.column_set('PACSservice', ['PACS'] * len(self.l_data))
+        store.append(self.l_data[0])
+        self.assertEqual(store[-1], self.l_data[0])
+        self.assertEqual(store.column_get('PACSservice')[-2:], ['PACS', ''])
+
+    def test_extend(self):
+        store   = pacsquery.HitStore(self.l_data[:22])
+        store.extend(pacsquery.HitStore(self.l_data[22:]))
+        self.assertEqual(list(store), self.l_data)
+
+    def test_streamedDecode(self):
+        d_response, b_trimmed   = pacsquery.hits_decode(self.str_body.encode('utf-8'))
+        self.assertFalse(b_trimmed)
+        self.assertIsInstance(d_response['query']['data'], pacsquery.HitStore)
+        self.assertEqual(list(d_response['query']['data']), self.l_data)
+        self.assertEqual({k: v for k, v in d_response.items() if k != 'query'}, {'status': True})
+
+    def test_streamedDecodeTrims(self):
+        l_keys                  = ['PatientID', 'StudyDate', 'Comment']
+        d_response, b_trimmed   = pacsquery.hits_decode(self.str_body.encode('utf-8'), l_keys)
+        self.assertTrue(b_trimmed)
+        self.assertEqual(
+            list(d_response['query']['data']),
+            [{key: d_hit[key] for key in l_keys if key in d_hit} for d_hit in self.l_data])
+
+    def test_streamedDecodeFallback(self):
+        # Hits that are not all tag dicts are left as the decoded list
+        l_data      = self.l_data[:2] + [dict(self.l_data[0], PatientID = 'P1')]
+        body        = json.dumps({'status': True, 'query': {'data': l_data}}).encode('utf-8')
+        d_response, b_trimmed   = pacsquery.hits_decode(body)
+        self.assertEqual(d_response['query']['data'], l_data)
+
+
+class HitStoreQueryTest(unittest.TestCase):
+    '''
+    A query against the mock 'pfdcm' writes out the hits it was sent.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 200, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def test_resultMatchesResponse(self):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--resultFile',     'results.json',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ])
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertTrue(d_ret['status'])
+
+        l_sent  = mock_pfdcm.response_make({'meta': {'on': {'PatientID': 'P1'}}}, 200, 10)['query']['data']
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            l_data  = json.load(f)['query']['data']
+        self.assertEqual(len(l_data), len(l_sent))
+        for d_hit, d_sent in zip(l_data, l_sent):
+            self.assertEqual(d_hit, {key: d_sent[key] for key in d_hit})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+An --incremental query returns only the hits new since the last run, and
+persists what it has seen in the --stateDir.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class IncrementalQueryTest(unittest.TestCase):
+    '''
+    The mock starts with 3 studies of 10 series each, from 20000101 to
+    20020303, and is given 3 more (to 20050606) between runs.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 30, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_state  = os.path.join(self.str_dir, 'state')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',              '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',          'P1',
+                    '--PACSservice',        'PACS',
+                    '--incremental',
+                    '--stateDir',           self.str_state,
+                    '--mergedResultFile',   'merged.json',
+                    '--retries',            '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ])
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertTrue(d_ret['status'])
+        with open(os.path.join(self.str_dir, 'merged.json')) as f:
+            l_merged    = json.load(f)['query']['data']
+        return d_ret, l_merged
+
+    def state_get(self):
+        return pacsquery.QueryState(stateDir = self.str_state).get('P1', 'PACS')
+
+    def test_delta(self):
+        d_ret, l_merged = self.query_run()
+        self.assertEqual(len(d_ret['query']['data']), 30)
+        self.assertEqual(len(l_merged), 30)
+        d_state         = self.state_get()
+        self.assertEqual(d_state['lastStudyDate'], '20020303')
+        self.assertEqual(len(d_state['hits']), 30)
+
+        # The next run asks only from the last study seen: of its 10 series,
+        # already known, and the 30 of the new studies, only those are new
+        self.server.hits    = 60
+        d_ret, l_merged = self.query_run()
+        l_data          = d_ret['query']['data']
+        self.assertEqual(d_ret['incremental'],
+                         {'since': '20020303', 'newHits': 30, 'knownHits': 60})
+        self.assertEqual(sorted(set(d_hit['StudyDate']['value'] for d_hit in l_data)),
+                         ['20030404', '20040505', '20050606'])
+        self.assertEqual(len(l_merged), 60)
+        self.assertEqual(self.state_get()['lastStudyDate'], '20050606')
+
+        # Nothing new since
+        d_ret, l_merged = self.query_run()
+        self.assertEqual(len(d_ret['query']['data']), 0)
+        self.assertEqual(self.server.requests, 3)
+
+    def test_failedRunKeepsState(self):
+        self.query_run()
+        self.server.hits            = 60
+        self.server.failPACS        = 'PACS'
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1,P2',
+                    '--PACSservice',    'PACS',
+                    '--incremental',
+                    '--stateDir',       self.str_state,
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ])
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertFalse(d_ret['status'])
+        self.assertFalse(d_ret['batch']['P1']['status'])
+        self.assertEqual(self.state_get()['lastStudyDate'], '20020303')
+        self.assertEqual(len(self.state_get()['hits']), 30)
+
+        # The new hits are still new once the PACS is back
+        self.server.failPACS        = ''
+        d_ret, l_merged = self.query_run()
+        self.assertEqual(d_ret['incremental']['newHits'], 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
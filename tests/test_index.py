@@ -0,0 +1,115 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The hits of a query are kept in the SQLite --indexDB across runs, and can
+be looked up there with --indexLookup instead of querying 'pfdcm'.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class HitIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.index      = pacsquery.HitIndex(indexDB = os.path.join(self.str_dir, 'db', 'hits.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.str_dir)
+
+    def test_upsert(self):
+        l_hits  = mock_pfdcm.response_make({'meta': {'on': {'PatientID': 'P1'}}}, 20, 10)['query']['data']
+        self.index.put(l_hits[::-1])
+        self.index.put(pacsquery.HitStore(l_hits[:5]))
+        self.assertEqual(self.index.rows, 25)
+        # The hits are kept once each, in StudyDate order
+        self.assertEqual(self.index.get('P1'), l_hits)
+        self.assertEqual(self.index.get('P2'), [])
+        self.assertEqual([d_hit['SeriesDescription']['value'] for d_hit in self.index.get('P1', 'series 1_ %')],
+                         ['Series %d CT' % i for i in range(10, 20)])
+
+
+class IndexQueryTest(unittest.TestCase):
+    '''
+    The mock has 2 studies of 10 series each.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_db     = os.path.join(self.str_dir, 'hits.db')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PACSservice',    'PACS',
+                    '--indexDB',        self.str_db,
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        return d_ret, app
+
+    def test_lookup(self):
+        d_ret, app  = self.query_run(['--PatientID', 'P1,P2', '--jobs', '2'])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(app.d_metrics['count']['output.indexRows'], 40)
+        self.assertEqual(self.server.requests, 2)
+
+        d_ret, app  = self.query_run(['--PatientID', 'P2,P3', '--indexLookup',
+                                      '--lookupSeriesDescription', 'Series 1%',
+                                      '--numberOfHitsFile', 'hits.txt'])
+        self.assertTrue(d_ret['status'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(d_ret['batch'], {'P2': {'status': True, 'hits': 11},
+                                          'P3': {'status': True, 'hits': 0}})
+        self.assertEqual(set(d_hit['PatientID']['value'] for d_hit in d_ret['query']['data']), {'P2'})
+        with open(os.path.join(self.str_dir, 'hits.txt')) as f:
+            self.assertEqual(f.read(), '11')
+
+    def test_lookupFiltered(self):
+        self.query_run(['--PatientID', 'P1'])
+        d_ret, app  = self.query_run(['--PatientID', 'P1', '--indexLookup', '--Modality', 'CT'])
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual([d_hit['SeriesInstanceUID']['value'].split('.')[-1] for d_hit in d_ret['query']['data']],
+                         [str(i) for i in range(10, 20)])
+
+    def test_lookupNeedsIndex(self):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args(['--pfdcm', 'localhost:1', '--PatientID', 'P1', '--indexLookup',
+                                  self.str_dir])
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertFalse(d_ret['status'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The output files of a query, other than the result file, written from
+its hits against the mock 'pfdcm'.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class OutputFileTest(unittest.TestCase):
+    '''
+    The mock has 6 studies of 10 series each.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 60, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertTrue(d_ret['status'])
+        return d_ret, app
+
+    def file_read(self, str_file):
+        with open(os.path.join(self.str_dir, str_file)) as f:
+            return f.read()
+
+    def test_numberOfHits(self):
+        self.query_run(['--numberOfHitsFile', 'hits.txt', '--countsFile', 'counts.txt'])
+        # A bare integer, as read by downstream plugins
+        self.assertEqual(self.file_read('hits.txt'), '60')
+        self.assertEqual(self.file_read('counts.txt'), '60 hits\n6 studies\n60 series\n')
+
+    def test_numberOfHitsOnly(self):
+        self.query_run(['--numberOfHitsFile', 'hits.txt'])
+        self.assertEqual(os.listdir(self.str_dir), ['hits.txt'])
+        self.assertEqual(int(self.file_read('hits.txt')), 60)
+
+    def test_summaryFormats(self):
+        str_keys    = 'PatientID,Modality,NoSuchTag,StudyDate'
+        for str_format, str_header, str_first in [
+                ('csv', 'PatientID,Modality,NoSuchTag,StudyDate', 'P1,MR,,20000101'),
+                ('tsv', 'PatientID\tModality\tNoSuchTag\tStudyDate', 'P1\tMR\t\t20000101'),
+                ('fixed',
+                 'PatientID\tModality\tNoSuchTag\tStudyDate',
+                 'P1       \tMR      \t         \t20000101 ')]:
+            self.query_run(['--summaryKeys', str_keys, '--summaryFile', 'summary.txt',
+                            '--summaryFormat', str_format])
+            l_line  = self.file_read('summary.txt').splitlines()
+            self.assertEqual(len(l_line), 61, str_format)
+            self.assertEqual(l_line[0].rstrip(), str_header)
+            self.assertEqual(l_line[1], str_first)
+
+    def test_studySummary(self):
+        self.query_run(['--studySummaryFile', 'studies.csv', '--summaryFormat', 'csv'])
+        l_line  = self.file_read('studies.csv').splitlines()
+        self.assertEqual(l_line[0], ','.join(pacsquery.StudyIndex.l_studyKeys))
+        self.assertEqual(len(l_line), 7)
+        # Ten series of 1 + 37i (mod 300) instances each in every study
+        self.assertTrue(l_line[1].startswith('P1,20000101,'))
+        self.assertTrue(l_line[1].endswith(',MR,10,%d' % sum(1 + (i * 37) % 300 for i in range(10))))
+
+    def test_metricsFile(self):
+        d_ret, app  = self.query_run(['--summaryKeys', 'PatientID,StudyDate',
+                                      '--summaryFile', 'summary.txt',
+                                      '--metricsFile', 'metrics.json'])
+        with open(os.path.join(self.str_dir, 'metrics.json')) as f:
+            d_meta  = json.load(f)
+        d_metrics   = d_meta['metrics']
+        self.assertEqual(d_metrics, json.loads(json.dumps(app.d_metrics)))
+        self.assertEqual(d_metrics['count']['hits'], 60)
+        self.assertEqual(d_metrics['count']['studies'], 6)
+        self.assertEqual(d_metrics['count']['series'], 60)
+        self.assertEqual(d_metrics['count']['output.summaryBytes'],
+                         os.path.getsize(os.path.join(self.str_dir, 'summary.txt')))
+        for str_phase in ['network', 'decode', 'query', 'output.summary', 'total']:
+            self.assertGreater(d_metrics['time'][str_phase], 0, str_phase)
+        # The phases are all timed within the run
+        self.assertLessEqual(d_metrics['time']['network'], d_metrics['time']['total'])
+        self.assertEqual(d_meta['retry']['attempts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+A query asks 'pfdcm' for only the --returnKeys (or the --summaryKeys, when
+the summary is all that is written), and trims the hits to them itself if
+'pfdcm' returns every tag regardless.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class ProjectionTest(unittest.TestCase):
+    '''
+    The mock ignores the 'returnKeys' of a query.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def query_run(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertTrue(d_ret['status'])
+        return d_ret, app
+
+    def test_returnKeys(self):
+        d_ret, app  = self.query_run(['--returnKeys', 'PatientID, Modality,PACSservice',
+                                      '--resultFile', 'results.json'])
+        l_keys      = ['PatientID', 'Modality', 'StudyInstanceUID', 'SeriesInstanceUID']
+        self.assertEqual(app.d_msg['meta']['returnKeys'], l_keys)
+        with open(os.path.join(self.str_dir, 'results.json')) as f:
+            l_data  = json.load(f)['query']['data']
+        self.assertEqual(len(l_data), 20)
+        for d_hit in l_data:
+            self.assertEqual(sorted(d_hit), sorted(l_keys))
+        self.assertEqual(l_data[0]['Modality']['value'], 'MR')
+        self.assertEqual(app.d_metrics['count']['projectionFallback'], 1)
+
+    def test_summaryKeys(self):
+        d_ret, app  = self.query_run(['--summaryKeys', 'PatientID,StudyDate',
+                                      '--summaryFile', 'summary.txt',
+                                      '--summaryFormat', 'csv'])
+        self.assertEqual(app.d_msg['meta']['returnKeys'],
+                         ['PatientID', 'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID'])
+        with open(os.path.join(self.str_dir, 'summary.txt')) as f:
+            l_line  = f.read().splitlines()
+        self.assertEqual(l_line[:2], ['PatientID,StudyDate', 'P1,20000101'])
+        self.assertEqual(len(l_line), 21)
+        self.assertEqual(app.d_metrics['count']['studies'], 2)
+
+    def test_allTags(self):
+        # Every tag is needed for a result file, or when asked for with '*'
+        d_ret, app  = self.query_run(['--summaryKeys', 'PatientID', '--summaryFile', 'summary.txt',
+                                      '--resultFile', 'results.json'])
+        self.assertNotIn('returnKeys', app.d_msg['meta'])
+        d_ret, app  = self.query_run(['--returnKeys', '*', '--resultFile', 'results.json'])
+        self.assertNotIn('returnKeys', app.d_msg['meta'])
+        self.assertEqual(len(d_ret['query']['data'][0]), len(mock_pfdcm.d_tag))
+        self.assertNotIn('projectionFallback', app.d_metrics['count'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+A streamed result file is byte for byte the document json.dump writes of
+the same results, and an NDJSON one has one hit per line.
+"""
+
+import io
+import os
+import sys
+import json
+import unittest
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class Output(io.StringIO):
+    '''
+    A result file that keeps its contents once closed.
+    '''
+
+    def close(self):
+        self.str_value  = self.getvalue()
+        super().close()
+
+
+class ResultStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.l_data     = mock_pfdcm.response_make(
+                                {'meta': {'on': {'PatientID': 'P1'}}}, 5, 2)['query']['data']
+
+    def stream_write(self, d_results, l_data, b_known, **kwargs):
+        """
+        Stream <l_data> in two batches, the results known either from
+        the start or only on close, and return the file written.
+        """
+        f       = Output()
+        stream  = pacsquery.ResultStream(f, results = d_results if b_known else None, **kwargs)
+        stream.write(l_data[:2])
+        stream.write(l_data[2:])
+        stream.close(d_results)
+        return f.str_value
+
+    def assertDumped(self, d_results, l_data, d_expected):
+        for b_sortKeys in [False, True]:
+            for indent in [None, 0, 4]:
+                str_expected    = json.dumps(d_expected, sort_keys = b_sortKeys, indent = indent)
+                for b_known in [False, True]:
+                    self.assertEqual(
+                        self.stream_write(d_results, l_data, b_known,
+                                          sortKeys = b_sortKeys, indent = indent),
+                        str_expected,
+                        (b_sortKeys, indent, b_known))
+
+    def test_keyOrder(self):
+        d_results   = {
+            'status':   True,
+            'query':    {'status': True, 'data': self.l_data, 'hits': 5},
+            'PACS':     {'PACS': True},
+            'batch':    {'P1': {'status': True}}
+        }
+        self.assertDumped(d_results, self.l_data, d_results)
+
+    def test_noHits(self):
+        d_results   = {'status': True, 'query': {'status': True, 'data': []}}
+        self.assertDumped(d_results, [], d_results)
+
+    def test_noQuery(self):
+        # Nothing is made up for results without a query
+        d_results   = {'status': False, 'error': 'no PACS'}
+        self.assertDumped(d_results, [], d_results)
+        d_results   = {'status': True, 'query': {'status': True}}
+        f           = Output()
+        pacsquery.ResultStream(f, results = d_results).close(d_results)
+        self.assertEqual(f.str_value, json.dumps(d_results))
+
+    def test_spooledHitsAreData(self):
+        # As for a chunked query, whose results only count the hits
+        d_results   = {'status': True, 'query': {'status': True, 'hits': 5}, 'chunks': []}
+        d_expected  = {'status': True, 'query': {'status': True, 'hits': 5, 'data': self.l_data},
+                       'chunks': []}
+        self.assertEqual(self.stream_write(d_results, self.l_data, False, sortKeys = True, indent = 4),
+                         json.dumps(d_expected, sort_keys = True, indent = 4))
+
+    def test_ndjson(self):
+        str_result  = self.stream_write({'status': True}, self.l_data, False,
+                                        format = 'ndjson', indent = 4)
+        self.assertEqual([json.loads(str_line) for str_line in str_result.splitlines()], self.l_data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The RetryEngine retries transient failures of idempotent calls a bounded
+number of times, gives up on a stalled attempt at its timeout, and takes
+the answer of a hedged duplicate.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import threading
+import unittest
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+
+import pacsquery
+
+
+class Stub(object):
+    '''
+    A 'pfdcm' call that behaves, call after call, as scripted: 'fail'
+    raises <error>, 'hang' stalls until released, and anything else is
+    returned. The last behaviour is repeated.
+    '''
+
+    def __init__(self, l_behaviour, error = None):
+        self.l_behaviour    = l_behaviour
+        self.error          = error or OSError('connection reset')
+        self.release        = threading.Event()
+        self.lock           = threading.Lock()
+        self.l_thread       = []
+
+    def __call__(self):
+        with self.lock:
+            behaviour   = self.l_behaviour[min(len(self.l_thread), len(self.l_behaviour) - 1)]
+            self.l_thread.append(threading.current_thread())
+        if behaviour == 'fail':
+            raise self.error
+        if behaviour == 'hang':
+            self.release.wait(10)
+            return 'late'
+        return behaviour
+
+    def calls(self):
+        with self.lock:
+            return len(self.l_thread)
+
+
+class RetryEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.l_stub     = []
+
+    def tearDown(self):
+        for stub in self.l_stub:
+            stub.release.set()
+
+    def stub_make(self, l_behaviour, error = None):
+        stub    = Stub(l_behaviour, error)
+        self.l_stub.append(stub)
+        return stub
+
+    def test_retriesBounded(self):
+        retry   = pacsquery.RetryEngine(retries = 3, backoff = 0.001)
+        stub    = self.stub_make(['fail'])
+        with self.assertRaises(OSError):
+            retry.call(stub, b_idempotent = True)
+        self.assertEqual(stub.calls(), 4)
+        d_stats = retry.stats_get()
+        self.assertEqual((d_stats['calls'], d_stats['attempts'], d_stats['retries'], d_stats['failures']),
+                         (1, 4, 3, 1))
+
+    def test_recovers(self):
+        retry   = pacsquery.RetryEngine(retries = 3, backoff = 0.001)
+        stub    = self.stub_make(['fail', 'fail', 'answer'])
+        self.assertEqual(retry.call(stub, b_idempotent = True), 'answer')
+        self.assertEqual(stub.calls(), 3)
+
+    def test_onlyTransientRetried(self):
+        retry   = pacsquery.RetryEngine(retries = 3, backoff = 0.001)
+        stub    = self.stub_make(['fail'], pacsquery.PfdcmHTTPError(404, 'Not Found'))
+        with self.assertRaises(pacsquery.PfdcmHTTPError):
+            retry.call(stub, b_idempotent = True)
+        self.assertEqual(stub.calls(), 1)
+
+    def test_notIdempotent(self):
+        retry   = pacsquery.RetryEngine(retries = 3, backoff = 0.001)
+        stub    = self.stub_make(['fail'])
+        with self.assertRaises(OSError):
+            retry.call(stub)
+        self.assertEqual(stub.calls(), 1)
+
+        # Unless the request was never sent
+        stub    = self.stub_make(['fail', 'answer'], pacsquery.PfdcmNotSentError('refused'))
+        self.assertEqual(retry.call(stub), 'answer')
+        self.assertEqual(stub.calls(), 2)
+
+    def test_timeout(self):
+        retry       = pacsquery.RetryEngine(timeout = 0.1, retries = 2, backoff = 0.001)
+        stub        = self.stub_make(['hang'])
+        startTime   = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            retry.call(stub, b_idempotent = True)
+        self.assertLess(time.perf_counter() - startTime, 1)
+        self.assertEqual(retry.stats_get()['timeouts'], 3)
+        # One abandoned daemon thread per attempt, and no more
+        self.assertEqual(stub.calls(), 3)
+        self.assertEqual(len(set(stub.l_thread)), 3)
+        self.assertTrue(all(thread.daemon for thread in stub.l_thread))
+
+    def test_deadline(self):
+        retry       = pacsquery.RetryEngine(timeout = 0.1, deadline = 0.25, retries = 100,
+                                            backoff = 0.001)
+        stub        = self.stub_make(['hang'])
+        startTime   = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            retry.call(stub, b_idempotent = True)
+        self.assertLess(time.perf_counter() - startTime, 0.5)
+        self.assertLessEqual(stub.calls(), 3)
+
+    def test_hedge(self):
+        retry   = pacsquery.RetryEngine(timeout = 2, hedgePercentile = 50)
+        for i in range(retry.HEDGE_MINSAMPLES):
+            retry.latency_add(0.02)
+        stub    = self.stub_make(['hang', 'hedged'])
+        self.assertEqual(retry.call(stub, b_idempotent = True), 'hedged')
+        self.assertEqual(stub.calls(), 2)
+        d_stats = retry.stats_get()
+        self.assertEqual((d_stats['attempts'], d_stats['hedges'], d_stats['hedgeWins']), (1, 1, 1))
+
+        # A call that is not idempotent is never hedged
+        stub    = self.stub_make(['hang'])
+        retry.timeout   = 0.2
+        with self.assertRaises(TimeoutError):
+            retry.call(stub)
+        self.assertEqual(stub.calls(), 1)
+
+    def test_acall(self):
+        retry   = pacsquery.RetryEngine(timeout = 0.1, retries = 2, backoff = 0.001)
+        l_call  = []
+        async def hang():
+            l_call.append(True)
+            await asyncio.sleep(10)
+        with self.assertRaises(TimeoutError):
+            asyncio.run(retry.acall(hang, b_idempotent = True))
+        self.assertEqual(len(l_call), 3)
+
+        l_call  = []
+        async def flaky():
+            l_call.append(True)
+            if len(l_call) < 3:
+                raise OSError('connection reset')
+            return 'answer'
+        self.assertEqual(asyncio.run(retry.acall(flaky, b_idempotent = True)), 'answer')
+        self.assertEqual(len(l_call), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
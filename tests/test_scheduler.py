@@ -0,0 +1,202 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The QueryScheduler keeps calls within their limits, and admits them by
+priority class and then in arrival order, from threads and asyncio tasks.
+"""
+
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class Tracker(object):
+    '''
+    Count the calls in flight, and record the order calls started in.
+    '''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.inFlight   = 0
+        self.maxInFlight= 0
+        self.l_order    = []
+
+    def enter(self, name):
+        with self.lock:
+            self.inFlight      += 1
+            self.maxInFlight    = max(self.maxInFlight, self.inFlight)
+            self.l_order.append(name)
+
+    def leave(self):
+        with self.lock:
+            self.inFlight      -= 1
+
+
+class QuerySchedulerTest(unittest.TestCase):
+
+    def calls_run(self, scheduler, l_call, hold = 0.02):
+        """
+        Run each (name, priority class) call in a thread, holding its slot
+        for <hold> seconds, and return the tracker.
+        """
+        tracker     = Tracker()
+        def call(name, str_class):
+            with scheduler.slot('PACS', str_class):
+                tracker.enter(name)
+                time.sleep(hold)
+                tracker.leave()
+        l_thread    = [threading.Thread(target = call, args = t_call) for t_call in l_call]
+        for thread in l_thread:
+            thread.start()
+        for thread in l_thread:
+            thread.join()
+        return tracker
+
+    def queue_behind(self, scheduler, l_call):
+        """
+        Queue the calls (in order) behind one that holds the only slot, and
+        return the order they were admitted in.
+        """
+        tracker     = Tracker()
+        held        = threading.Event()
+        go          = threading.Event()
+        def hold():
+            with scheduler.slot('PACS', 'bulk'):
+                held.set()
+                go.wait()
+        def call(name, str_class):
+            with scheduler.slot('PACS', str_class):
+                tracker.enter(name)
+                tracker.leave()
+        l_thread    = [threading.Thread(target = hold)]
+        l_thread[0].start()
+        held.wait()
+        for t_call in l_call:
+            l_thread.append(threading.Thread(target = call, args = t_call))
+            l_thread[-1].start()
+            # Wait for this call to be queued before the next one
+            while len(scheduler.d_queue['PACS']) < len(l_thread) - 1:
+                time.sleep(0.001)
+        go.set()
+        for thread in l_thread:
+            thread.join()
+        return tracker.l_order
+
+    def test_maxInFlight(self):
+        scheduler   = pacsquery.QueryScheduler(maxInFlight = 2)
+        tracker     = self.calls_run(scheduler, [(i, 'bulk') for i in range(8)])
+        self.assertEqual(tracker.maxInFlight, 2)
+        self.assertEqual(scheduler.stats_get()['bulk']['calls'], 8)
+
+    def test_rateLimit(self):
+        scheduler   = pacsquery.QueryScheduler(rate = 50, burst = 1)
+        startTime   = time.perf_counter()
+        self.calls_run(scheduler, [(i, 'bulk') for i in range(6)], hold = 0)
+        # The first call takes the burst token, then one every 20 ms
+        self.assertGreaterEqual(time.perf_counter() - startTime, 5 / 50 * 0.9)
+
+    def test_priorityFirst(self):
+        scheduler   = pacsquery.QueryScheduler(maxInFlight = 1)
+        l_order     = self.queue_behind(scheduler, [
+                            ('bulk0', 'bulk'), ('bulk1', 'bulk'), ('interactive', 'interactive')])
+        self.assertEqual(l_order, ['interactive', 'bulk0', 'bulk1'])
+
+    def test_arrivalOrder(self):
+        scheduler   = pacsquery.QueryScheduler(maxInFlight = 1)
+        l_call      = [('bulk%d' % i, 'bulk') for i in range(5)]
+        self.assertEqual(self.queue_behind(scheduler, l_call), [name for name, str_class in l_call])
+
+    def test_asyncLimitsWithoutPolling(self):
+        scheduler   = pacsquery.QueryScheduler(maxInFlight = 2)
+        tracker     = Tracker()
+        l_admit     = []
+        admit       = scheduler.admit
+        def admit_count(*args):
+            l_admit.append(True)
+            return admit(*args)
+        scheduler.admit = admit_count
+
+        async def call(name):
+            async with scheduler.aslot('PACS', 'bulk'):
+                tracker.enter(name)
+                await asyncio.sleep(0.1)
+                tracker.leave()
+        async def calls_run():
+            await asyncio.gather(*[call(i) for i in range(6)])
+        asyncio.run(calls_run())
+
+        self.assertEqual(tracker.maxInFlight, 2)
+        self.assertEqual(sorted(tracker.l_order), list(range(6)))
+        # Waiting calls are woken by releases: a 5 ms poll over the 0.3 s
+        # run would make over a hundred attempts
+        self.assertLess(len(l_admit), 40)
+        self.assertEqual(len(scheduler.s_awaiter), 0)
+
+
+class ScheduledQueryTest(unittest.TestCase):
+    '''
+    Scheduled batch queries against the mock 'pfdcm'.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 10, seriesPerStudy = 10, latency = 0.05)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def run_batch(self, l_args):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      ','.join('P%d' % i for i in range(8)),
+                    '--PACSservice',    'PACS',
+                    '--jobs',           '8',
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ] + l_args)
+        startTime   = time.perf_counter()
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        return d_ret, time.perf_counter() - startTime, app
+
+    def test_maxInFlight(self):
+        for l_async in [[], ['--async']]:
+            d_ret, elapsed, app = self.run_batch(['--maxInFlight', '2'] + l_async)
+            self.assertTrue(d_ret['status'])
+            self.assertEqual(len(d_ret['query']['data']), 80)
+            # Four rounds of two calls of 50 ms each
+            self.assertGreaterEqual(elapsed, 0.2)
+            self.assertEqual(app.scheduler.stats_get()['bulk']['calls'], 8)
+
+    def test_rateLimit(self):
+        d_ret, elapsed, app = self.run_batch(['--rateLimit', '20', '--async'])
+        self.assertTrue(d_ret['status'])
+        self.assertGreaterEqual(elapsed, 7 / 20 * 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Served query jobs keep the 'pfdcm' session and cache of the process warm
+from one job to the next.
+"""
+
+import io
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import contextlib
+from unittest import mock
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class ServeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.app        = pacsquery.PacsQueryApp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def job_line(self, l_args = []):
+        return json.dumps({'args': [
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1',
+                    '--PACSservice',    'PACS',
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+               ] + l_args}) + '\n'
+
+    def serve_stdin(self, l_line):
+        """
+        Serve the job lines from stdin, returning the replies and the
+        'pfdcm' session and cache after each job.
+        """
+        l_state     = []
+        job_run     = self.app.job_run
+        def job_record(str_line):
+            reply   = job_run(str_line)
+            l_state.append((self.app.session, self.app.cache))
+            return reply
+        self.app.job_run    = job_record
+        options     = self.app.parse_args(['--serve', '-', self.str_dir])
+        f_reply     = io.StringIO()
+        with mock.patch('sys.stdin', io.StringIO(''.join(l_line))), \
+             contextlib.redirect_stdout(f_reply), \
+             contextlib.redirect_stderr(io.StringIO()):
+            self.assertTrue(self.app.run(options)['status'])
+        l_reply     = [json.loads(str_reply) for str_reply in f_reply.getvalue().splitlines()
+                        if str_reply.startswith('{')]
+        return l_reply, l_state
+
+    def test_sessionKeptAcrossJobs(self):
+        l_reply, l_state    = self.serve_stdin([self.job_line(), self.job_line()])
+        self.assertEqual([d_reply['hits'] for d_reply in l_reply], [20, 20])
+        session     = l_state[0][0]
+        self.assertIsInstance(session, pacsquery.PfdcmSession)
+        self.assertIs(l_state[1][0], session)
+        # The second job reused the connection of the first
+        self.assertEqual(session.stats_get()['requests'], 2)
+        self.assertEqual(session.stats_get()['hits'], 1)
+
+    def test_cacheTakesJobSettings(self):
+        str_cache   = os.path.join(self.str_dir, 'cache')
+        l_reply, l_state    = self.serve_stdin([
+                    self.job_line(['--cacheDir', str_cache]),
+                    self.job_line(['--cacheDir', str_cache, '--cacheTTL', '0',
+                                   '--cacheMaxBytes', '1'])])
+        cache       = l_state[0][1]
+        self.assertIs(l_state[1][1], cache)
+        self.assertEqual((cache.TTL, cache.maxBytes), (0, 1))
+        # Not answered from the expired entry, and the new one is evicted
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual([name for name in os.listdir(str_cache) if name.endswith('.cache')], [])
+
+    def test_socketOwnerOnly(self):
+        str_socket  = os.path.join(self.str_dir, 'serve.sock')
+        options     = self.app.parse_args(['--serve', str_socket, self.str_dir])
+        l_mode      = []
+        bind        = socket.socket.bind
+        def bind_record(sock, address):
+            bind(sock, address)
+            l_mode.append(stat.S_IMODE(os.lstat(address).st_mode))
+        def serve():
+            with mock.patch('socket.socket.bind', bind_record), \
+                 contextlib.redirect_stdout(io.StringIO()):
+                self.app.run(options)
+        thread      = threading.Thread(target = serve)
+        thread.start()
+        while not os.path.exists(str_socket):
+            time.sleep(0.01)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str_socket)
+            sock.sendall(b'{"shutdown": true}\n')
+        thread.join()
+        # Owner-only as soon as it is bound, before the chmod
+        self.assertEqual(l_mode, [0o600])
+        self.assertFalse(os.path.exists(str_socket))
+
+
+if __name__ == '__main__':
+    unittest.main()
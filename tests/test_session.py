@@ -0,0 +1,126 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+The PfdcmSession reuses its pooled keep-alive connections, and counts how
+often it could.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import contextlib
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+def message_make(str_patientID):
+    return {
+        'action':   'PACSinteract',
+        'meta': {
+            'do':   'query',
+            'on':   {'PatientID': str_patientID},
+            'PACS': 'PACS'
+        }
+    }
+
+
+class PfdcmSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 5, seriesPerStudy = 5)
+        self.str_pfdcm  = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        session     = pacsquery.PfdcmSession(pfdcm = self.str_pfdcm)
+        for i in range(5):
+            d_response  = json.loads(session.post(message_make('P%d' % i)))
+            self.assertEqual(d_response['query']['data'][0]['PatientID']['value'], 'P%d' % i)
+        self.assertEqual(session.stats_get(),
+                         {'poolSize': 1, 'requests': 5, 'hits': 4, 'misses': 1})
+        session.close()
+
+    def test_concurrentPoolBounded(self):
+        session     = pacsquery.PfdcmSession(pfdcm = self.str_pfdcm, poolSize = 2)
+        def post():
+            for i in range(5):
+                session.post(message_make('P1'))
+        l_thread    = [threading.Thread(target = post) for i in range(4)]
+        for thread in l_thread:
+            thread.start()
+        for thread in l_thread:
+            thread.join()
+        d_stats     = session.stats_get()
+        self.assertEqual(d_stats['requests'], 20)
+        self.assertEqual(d_stats['hits'] + d_stats['misses'], 20)
+        # At most one new connection per thread, and no more kept than the pool holds
+        self.assertLessEqual(d_stats['misses'], 4)
+        self.assertLessEqual(session.pool.qsize(), 2)
+        session.close()
+
+    def test_errorStatus(self):
+        session     = pacsquery.PfdcmSession(pfdcm = self.str_pfdcm)
+        self.server.failPACS    = 'PACS'
+        with self.assertRaises(pacsquery.PfdcmHTTPError) as context:
+            session.post(message_make('P1'))
+        self.assertEqual(context.exception.status, 500)
+        # The connection outlives the error status
+        self.server.failPACS    = ''
+        session.post(message_make('P1'))
+        self.assertEqual(session.stats_get()['hits'], 1)
+        session.close()
+
+
+class PooledQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 5, seriesPerStudy = 5)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def test_poolStats(self):
+        app     = pacsquery.PacsQueryApp()
+        options = app.parse_args([
+                    '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                    '--PatientID',      'P1,P2,P3,P4,P5,P6',
+                    '--PACSservice',    'PACS',
+                    '--jobs',           '2',
+                    '--retries',        '0',
+                    '--pfurlQuiet',
+                    self.str_dir
+                  ])
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+            d_ret   = app.run(options)
+        self.assertTrue(d_ret['status'])
+        d_pool  = app.OUTPUT_META_DICT['pool']
+        self.assertEqual(d_pool['poolSize'], 2)
+        self.assertEqual(d_pool['requests'], 6)
+        self.assertLessEqual(d_pool['misses'], 2)
+        self.assertEqual(d_pool['hits'], 6 - d_pool['misses'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Identical queries made at the same time by several processes sharing a
+--coalesceDir are coalesced into a single 'pfdcm' call.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+
+str_selfDir     = os.path.dirname(os.path.abspath(__file__))
+str_rootDir     = os.path.dirname(str_selfDir)
+sys.path.insert(0, os.path.join(str_rootDir, 'pacsquery'))
+sys.path.insert(0, os.path.join(str_rootDir, 'bench'))
+
+import pacsquery
+import mock_pfdcm
+
+
+class SingleFlightTest(unittest.TestCase):
+    '''
+    Two SingleFlight instances on the same directory stand in for two
+    processes (their lock files are opened, and so locked, separately).
+    '''
+
+    def setUp(self):
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.str_dir)
+
+    def call_thread(self, flight, fn, d_result):
+        """
+        Call <fn> through <flight> in a thread, recording its result (or
+        exception) in <d_result> under the flight.
+        """
+        def call():
+            try:
+                d_result[flight]    = flight.call('key', fn)
+            except Exception as e:
+                d_result[flight]    = e
+        thread  = threading.Thread(target = call)
+        thread.start()
+        return thread
+
+    def test_sharedResult(self):
+        l_flight    = [pacsquery.SingleFlight(flightDir = self.str_dir) for i in range(2)]
+        l_call      = []
+        started     = threading.Event()
+        def fn():
+            l_call.append(True)
+            started.set()
+            time.sleep(0.2)
+            return b'result'
+        d_result    = {}
+        l_thread    = [self.call_thread(l_flight[0], fn, d_result)]
+        started.wait()
+        l_thread.append(self.call_thread(l_flight[1], fn, d_result))
+        for thread in l_thread:
+            thread.join()
+        self.assertEqual([d_result[flight] for flight in l_flight], [b'result', b'result'])
+        self.assertEqual(len(l_call), 1)
+        self.assertEqual(l_flight[1].stats_get()['crossProcess'], 1)
+        self.assertEqual(sorted(os.listdir(self.str_dir)), ['key.result'])
+
+    def test_failedLeaderHandsOver(self):
+        l_flight    = [pacsquery.SingleFlight(flightDir = self.str_dir) for i in range(3)]
+        started     = threading.Event()
+        def fail():
+            started.set()
+            time.sleep(0.2)
+            raise IOError('pfdcm down')
+        d_result    = {}
+        l_thread    = [self.call_thread(l_flight[0], fail, d_result)]
+        started.wait()
+        l_thread   += [self.call_thread(flight, lambda: b'result', d_result)
+                        for flight in l_flight[1:]]
+        for thread in l_thread:
+            thread.join()
+        self.assertIsInstance(d_result[l_flight[0]], IOError)
+        self.assertEqual([d_result[flight] for flight in l_flight[1:]], [b'result', b'result'])
+        # One of the waiters led in place of the failed leader
+        self.assertEqual(sum(flight.stats_get()['leaders'] for flight in l_flight[1:]), 1)
+        self.assertEqual(sorted(os.listdir(self.str_dir)), ['key.result'])
+
+    def test_sweep(self):
+        flight          = pacsquery.SingleFlight(flightDir = self.str_dir)
+        f, result       = flight.lock_acquire('old')
+        flight.result_save('old', f, b'old')
+        flight.lock_release('old', f)
+        staleTime       = time.time() - 2 * flight.STALE
+        os.utime(flight.path_get('old', 'result'), (staleTime, staleTime))
+
+        # Not swept before it is due, then swept with the next result saved
+        self.assertEqual(flight.call('new', lambda: b'new'), b'new')
+        self.assertEqual(sorted(os.listdir(self.str_dir)), ['new.result', 'old.result'])
+        flight.sweepTime   -= flight.STALE
+        self.assertEqual(flight.call('newer', lambda: b'newer'), b'newer')
+        self.assertEqual(sorted(os.listdir(self.str_dir)), ['new.result', 'newer.result'])
+
+
+class CrossProcessQueryTest(unittest.TestCase):
+    '''
+    Several runs of the plugin make the same query of the (slow) mock
+    'pfdcm' at the same time.
+    '''
+
+    def setUp(self):
+        self.server     = mock_pfdcm.server_start(hits = 20, seriesPerStudy = 10, latency = 1.5)
+        self.str_dir    = tempfile.mkdtemp(prefix = 'pacsquery-test-')
+        self.str_flight = os.path.join(self.str_dir, 'coalesce')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.str_dir)
+
+    def test_oneCall(self):
+        l_process   = []
+        l_outputDir = []
+        for i in range(3):
+            l_outputDir.append(os.path.join(self.str_dir, 'out%d' % i))
+            os.makedirs(l_outputDir[-1])
+            l_process.append(subprocess.Popen([
+                sys.executable, os.path.join(str_rootDir, 'pacsquery', 'pacsquery.py'),
+                '--pfdcm',          '127.0.0.1:%d' % self.server.server_address[1],
+                '--PatientID',      'P1',
+                '--PACSservice',    'PACS',
+                '--coalesceDir',    self.str_flight,
+                '--resultFile',     'results.json',
+                '--pfurlQuiet',
+                '--saveoutputmeta',
+                l_outputDir[-1]
+            ], stdout = subprocess.DEVNULL))
+        for process in l_process:
+            self.assertEqual(process.wait(timeout = 60), 0)
+
+        self.assertEqual(self.server.requests, 1)
+        l_coalesce  = []
+        for str_outputDir in l_outputDir:
+            with open(os.path.join(str_outputDir, 'results.json')) as f:
+                self.assertEqual(len(json.load(f)['query']['data']), 20)
+            with open(os.path.join(str_outputDir, 'output.meta.json')) as f:
+                l_coalesce.append(json.load(f)['coalesce'])
+        self.assertEqual(sorted(d['leaders'] for d in l_coalesce), [0, 0, 1])
+        self.assertEqual(sorted(d['crossProcess'] for d in l_coalesce), [0, 1, 1])
+        self.assertEqual([name for name in os.listdir(self.str_flight) if name.endswith('.lock')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()